@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# Glass-to-motor latency benchmark. Runs the whole control loop on one machine:
+#
+#   SyntheticCapture -> frame_service (loopback) -> tracker -> pin_service
+#   (loopback) -> StepperMotor on gpiozero's MockFactory
+#
+# The synthetic target jumps between two positions either side of the frame
+# centre, so every jump must flip the yaw direction. Latency is measured from
+# the capture time of the first frame showing a jump to the first
+# StepperMotor.speed call with the new direction. The PC side mirrors
+# pc/turret_pc.py: a tracking loop plus a steering loop sending the latest delta
+# every STEERING_PERIOD.
+import argparse
+import itertools
+import logging
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Thread
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / 'src'), str(ROOT / 'pi'), str(ROOT / 'pc')]
+
+import cv2
+import numpy as np
+import zmq
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+import frame_service
+import pin_service
+import turret_pc
+from turret.metrics import Metrics
+from turret.tracking import DEFAULT_TRACKER, TRACKERS, parse_tracking_scale
+
+logger = logging.getLogger('bench')
+
+MODES = ('request', 'stream')
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+# What the crosshair covers of a frame, so locking on picks the whole target
+TARGET_WIDTH = turret_pc.CV_XHAIR_SIZE[0] * FRAME_WIDTH // turret_pc.CV_FRAME_WIDTH
+TARGET_HEIGHT = turret_pc.CV_XHAIR_SIZE[1] * FRAME_HEIGHT // turret_pc.CV_FRAME_HEIGHT
+TARGET_OFFSET = TARGET_WIDTH * 3 // 10 # px either side of the centre
+SWITCH_PERIOD = 0.5
+WARMUP = 1.0
+STARTUP_TIMEOUT = 5.0 # seconds to wait for the first frame and the target lock
+
+
+class SyntheticCapture():
+	# Stands in for cv2.VideoCapture: a textured square on a noisy background,
+	# delivered at a fixed frame rate like a real camera would.
+	def __init__(self, fps: int=60, width: int=FRAME_WIDTH, height: int=FRAME_HEIGHT) -> None:
+		rng = np.random.default_rng(0)
+		self.fps = fps
+		self.width = width
+		self.height = height
+		self.background = (rng.integers(0, 255, (height, width, 3), dtype=np.uint8) // 4)
+		self.texture = rng.integers(0, 255, (TARGET_HEIGHT, TARGET_WIDTH, 3), dtype=np.uint8)
+		self.next_frame = time.monotonic()
+		self.started = None
+		self.side = 0 # centred under the crosshair until the motion starts
+		self.jumps = [] # (capture time, side the target jumped to)
+		self.opened = True
+
+	def start_motion(self) -> None:
+		self.started = time.time()
+
+	def target_bbox(self, side: int) -> tuple:
+		x = (self.width - TARGET_WIDTH) // 2 + side * TARGET_OFFSET
+		y = (self.height - TARGET_HEIGHT) // 2
+		return (x, y, TARGET_WIDTH, TARGET_HEIGHT)
+
+	def isOpened(self):
+		return self.opened
+
+	def set(self, prop, value):
+		return False
+
+	def get(self, prop):
+		return dict({
+			cv2.CAP_PROP_FPS: self.fps,
+			cv2.CAP_PROP_FRAME_WIDTH: self.width,
+			cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+		}).get(prop, 0)
+
+	def read(self):
+		if not self.opened:
+			return False, None
+		self.next_frame += 1 / self.fps
+		delay = self.next_frame - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		now = time.time()
+		side = 0
+		if self.started is not None:
+			side = -1 if int((now - self.started) / SWITCH_PERIOD) % 2 == 0 else 1
+		if side != self.side:
+			self.side = side
+			if self.started is not None:
+				self.jumps.append((now, side))
+		frame = self.background.copy()
+		x, y, w, h = self.target_bbox(side)
+		frame[y:y + h, x:x + w] = self.texture
+		return True, frame
+
+	def release(self):
+		self.opened = False
+
+
+class RecordingMotor(pin_service.StepperMotor):
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self.calls = [] # (time, dir, speed)
+
+	def speed(self, dir, speed):
+		self.calls.append((time.time(), dir, speed))
+		return super().speed(dir, speed)
+
+
+@dataclass()
+class Config():
+	mode: str
+	codec: str
+	tracker: str
+	scale: float
+
+	def __str__(self) -> str:
+		return f'{self.mode:7} {self.codec:4} {self.tracker:5} {self.scale:4.2f}'
+
+
+@dataclass()
+class Result():
+	config: Config
+	latencies: list = field(default_factory=list)
+	frames: int = 0
+	duration: float = 0
+	missed: int = 0
+
+	def report(self) -> str:
+		fps = self.frames / self.duration if self.duration else 0
+		if not self.latencies:
+			return f'{self.config}  fps {fps:6.1f}  no jumps matched ({self.missed} missed)'
+		p50, p95, p99 = np.percentile(np.array(self.latencies) * 1000, (50, 95, 99))
+		return f'{self.config}  fps {fps:6.1f}  p50 {p50:6.1f}ms  p95 {p95:6.1f}ms  p99 {p99:6.1f}ms  n={len(self.latencies)} missed={self.missed}'
+
+
+def run_service(target, zmq_socket: zmq.Socket, *args):
+	try:
+		target(zmq_socket, *args)
+	except (zmq.ContextTerminated, zmq.ZMQError):
+		pass
+	except Exception as e:
+		logger.debug('Service stopped: %s', e)
+	finally:
+		zmq_socket.close(linger=0)
+
+class BenchReactor(turret_pc.Reactor):
+	# Notes when tracking finishes a newly captured frame. Frames replaced
+	# while the tracker was busy never count, nor does a frame served twice.
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self.frames = []
+		self._last_captured = None
+
+	def _on_tracking_result(self) -> bool:
+		changed = super()._on_tracking_result()
+		tracked = self.tracking.tracked
+		if tracked is not None and tracked[0] != self._last_captured:
+			self._last_captured = tracked[0]
+			self.frames.append(tracked[2])
+		return changed
+
+def run_reactor(argv: list, reactors: list):
+	# Sockets stay on the thread that made them
+	reactor = BenchReactor(turret_pc.parse_args(argv), Metrics())
+	reactors.append(reactor)
+	reactor.run()
+
+def wait_until(condition, timeout: float=STARTUP_TIMEOUT) -> bool:
+	deadline = time.monotonic() + timeout
+	while not condition():
+		if time.monotonic() > deadline:
+			return False
+		time.sleep(0.01)
+	return True
+
+def match_jumps(jumps: list, calls: list, since: float) -> tuple:
+	latencies = []
+	missed = 0
+	for (jump_time, side), next_jump in itertools.zip_longest(jumps, jumps[1:], fillvalue=(float('inf'), 0)):
+		if jump_time < since:
+			continue
+		# Target right of centre means negative yaw, which the pin service maps to dir 1
+		expected_dir = 1 if side > 0 else 0
+		reaction = next((t for t, dir, speed in calls if jump_time <= t < next_jump[0] and dir == expected_dir and speed > 1), None)
+		if reaction is None:
+			missed += 1
+		else:
+			latencies.append(reaction - jump_time)
+	return latencies, missed
+
+def run_config(config: Config, duration: float, fps: int, prediction: bool=True) -> Result:
+	camera = SyntheticCapture(fps)
+	cameras = {frame_service.DEFAULT_CAMERA: frame_service.Camera(frame_service.DEFAULT_CAMERA, camera)}
+	cameras[frame_service.DEFAULT_CAMERA].start()
+	motor_yaw = RecordingMotor(12, 16, 20, 21)
+	motor_pitch = RecordingMotor(5, 6, 13, 19)
+
+	service_context = zmq.Context()
+	if config.mode == 'stream':
+		frame_socket = service_context.socket(zmq.XPUB)
+		frame_socket.setsockopt(zmq.SNDHWM, frame_service.STREAM_HWM)
+		frame_target = (frame_service.stream_frames, cameras, config.codec, None)
+	else:
+		frame_socket = service_context.socket(zmq.REP)
+		frame_target = (frame_service.process_requests, cameras, config.codec, None)
+	frame_port = frame_socket.bind_to_random_port('tcp://127.0.0.1')
+	steering_socket = service_context.socket(zmq.ROUTER)
+	steering_port = steering_socket.bind_to_random_port('tcp://127.0.0.1')
+	services = [
+		Thread(target=run_service, args=(frame_target[0], frame_socket, *frame_target[1:]), daemon=True),
+		Thread(target=run_service, args=(pin_service.process_requests, steering_socket, motor_yaw, motor_pitch), daemon=True),
+	]
+	for service in services:
+		service.start()
+
+	# The PC side connects to its module's endpoints, pointed at the services here
+	turret_pc.ZMQ_INTERFACE_FRAMES = turret_pc.ZMQ_INTERFACE_FRAME_STREAM = f'tcp://127.0.0.1:{frame_port}'
+	turret_pc.ZMQ_INTERFACE_STEERING = f'tcp://127.0.0.1:{steering_port}'
+	argv = ['--headless', '--tracker', config.tracker, '--tracking-scale', str(config.scale)]
+	if config.mode == 'stream':
+		argv.append('--stream')
+	if config.codec != 'raw':
+		argv.extend(['--codec', config.codec])
+	if not prediction:
+		argv.append('--no-prediction')
+	reactors = []
+	pc = Thread(target=run_reactor, args=(argv, reactors))
+	pc.start()
+	frames = []
+	if wait_until(lambda: reactors and reactors[0].last_frame_info[1] is not None):
+		reactor = reactors[0]
+		frames = reactor.frames
+		# Same as pressing cross with the target under the crosshair
+		reactor.tracking.command(turret_pc.TRACK_INIT)
+		if wait_until(lambda: frames):
+			camera.start_motion()
+			time.sleep(duration)
+		else:
+			logger.error('%s: never locked on the target', config)
+	else:
+		logger.error('%s: no frame reached the PC side', config)
+	if reactors:
+		reactors[0].sleep = True
+	pc.join()
+
+	service_context.term()
+	for service in services:
+		service.join()
+	for source in cameras.values():
+		source.close()
+	for motor in (motor_yaw, motor_pitch):
+		motor.sleep()
+		motor.close()
+
+	result = Result(config)
+	if camera.started is None:
+		return result
+	since = camera.started + WARMUP
+	counted = [t for t in frames if t >= since]
+	result.frames = len(counted)
+	result.duration = max(0, (frames[-1] if frames else since) - since)
+	result.latencies, result.missed = match_jumps(camera.jumps, motor_yaw.calls, since)
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--mode', choices=MODES, action='append', help='frame transport, repeatable (default: all)')
+	parser.add_argument('--codec', choices=frame_service.CODECS, action='append', help='frame encoding, repeatable (default: raw)')
+	parser.add_argument('--tracker', choices=TRACKERS, action='append', help='tracker backend, repeatable (default: csrt)')
+	parser.add_argument('--scale', type=parse_tracking_scale, action='append', help='tracking scale, repeatable (default: 1.0)')
+	parser.add_argument('--duration', type=float, default=10, help='seconds per configuration')
+	parser.add_argument('--fps', type=int, default=60, help='synthetic camera frame rate')
+	parser.add_argument('--no-prediction', action='store_true', help='steer towards where the target was seen, like turret_pc.py --no-prediction')
+	parser.add_argument('-v', '--verbose', action='store_true')
+	args = parser.parse_args()
+	# The services configured the root logger on import, only adjust levels
+	logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+	for name in (frame_service.__name__, pin_service.__name__, turret_pc.__name__):
+		logging.getLogger(name).setLevel(logging.DEBUG if args.verbose else logging.ERROR)
+	Device.pin_factory = MockFactory()
+
+	configs = [
+		Config(*values) for values in itertools.product(
+			args.mode or MODES,
+			args.codec or ['raw'],
+			args.tracker or [DEFAULT_TRACKER],
+			args.scale or [1.0]
+		)
+	]
+	print(f'{len(configs)} configurations, {args.duration:.0f}s each, camera {FRAME_WIDTH}x{FRAME_HEIGHT}@{args.fps}fps')
+	for config in configs:
+		print(run_config(config, args.duration, args.fps, not args.no_prediction).report(), flush=True)
+
+if __name__ == '__main__':
+	main()
@@ -3,9 +3,12 @@ from traceback import print_exc
 
 import zmq
 
+from turret.protocol import SequenceCounter, SteeringCommand, unpack_ack
+
 ZMQ_INTERFACE = 'tcp://192.168.42.199:42001'
 COMMANDS = ['steps', 'speed', 'sleep']
 MOTORS = ['yaw', 'pitch']
+sequence = SequenceCounter()
 
 def main():
 	try:
@@ -36,19 +39,19 @@ def handle_input(zmq_socket: zmq.Socket):
 			print('Allowed motors:', ','.join(MOTORS))
 			return
 		value = int(args.pop(0))
-		if command == 'steps':
-			value = str(value)
 	except IndexError:
 		pass
-	payload = {
-		'token': 'dupa',
-		'yaw': value if motor == 'yaw' else 0,
-		'pitch': value if motor == 'pitch' else 0,
-		'sleep': 1 if command == 'sleep' else 0
-	}
+	payload = SteeringCommand(
+		yaw=value if motor == 'yaw' else 0,
+		pitch=value if motor == 'pitch' else 0,
+		yaw_steps=command == 'steps' and motor == 'yaw',
+		pitch_steps=command == 'steps' and motor == 'pitch',
+		sleep=command == 'sleep',
+		sequence=sequence.next()
+	)
 	print(payload)
-	zmq_socket.send_json(payload)
-	print(zmq_socket.recv_string())
+	zmq_socket.send(payload.pack())
+	print(unpack_ack(zmq_socket.recv()))
 
 
 if __name__ == '__main__':
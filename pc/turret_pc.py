@@ -0,0 +1,922 @@
+#!/usr/bin/env python3
+import argparse
+import errno
+import json
+import logging
+import time
+from enum import Enum
+from pathlib import Path
+from threading import Condition, Thread
+from typing import Optional
+
+import cv2
+import numpy as np
+import zmq
+
+from turret.joystick import (IN_ATTRIB, IN_CREATE, IN_DELETE, JOYSTICK_PREFIX,
+                             JS_EVENT_INIT, Inotify, Joystick, is_joystick)
+from turret.metrics import (STAGE_CAPTURE_TO_SEND, STAGE_COMMAND_ROUND_TRIP,
+                            STAGE_RECEIVE_TO_TRACKED, STAGE_SEND_TO_RECEIVE,
+                            STAGE_TRACKED_TO_COMMAND, Metrics, MetricsServer)
+from turret.prediction import TargetPredictor
+from turret.protocol import SequenceCounter, SteeringCommand, unpack_ack
+from turret.recording import (REPLAY_RECORDED, REPLAY_SPEEDS, FrameRecorder,
+                              FrameReplay)
+from turret.render import RenderThread
+from turret.tracking import (DEFAULT_TRACKER, DEFAULT_TRACKING_SCALE, TRACKERS,
+                             ScaledTracker, next_tracker, parse_tracking_scale,
+                             scale_bbox)
+
+logging.basicConfig(
+	format='[%(asctime)s] %(levelname)s-> %(message)s',
+	datefmt='%T',
+	level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+# Per-tick steering chatter, see RateLimitFilter
+steering_logger = logging.getLogger(f'{__name__}.steering')
+zmq_context = zmq.Context()
+
+CV_WINDOW_NAME = 'the-turret'
+CV_FRAME_WIDTH = 1280
+CV_FRAME_HEIGHT = 720
+CV_BLUE = (255, 0, 0)
+CV_GREEN = (0, 255, 0)
+CV_RED = (0, 0, 255)
+CV_PINK = (255, 0, 255)
+CV_XHAIR_SIZE = (100, 100)
+ZMQ_INTERFACE_FRAMES = 'tcp://192.168.42.199:42000'
+ZMQ_INTERFACE_FRAME_STREAM = 'tcp://192.168.42.199:42002'
+ZMQ_STREAM_HWM = 1 # one frame, HWMs count whole multipart messages
+ZMQ_INTERFACE_STEERING = 'tcp://192.168.42.199:42001'
+ZMQ_TRACKING_RESULTS = 'inproc://tracking-results'
+ZMQ_INTERFACE_EDGE_CONTROL = 'tcp://192.168.42.199:42004'
+ZMQ_INTERFACE_EDGE_STATE = 'tcp://192.168.42.199:42005'
+EDGE_TOPIC_STATE = b'state'
+EDGE_TOPIC_THUMBNAIL = b'thumbnail'
+DEFAULT_CAMERA = 'main'
+STATS_REFRESH = 0.5 # seconds between stats line updates
+WHOLE_FRAME_INTERVAL = 1.0 # seconds between whole frames while only the tracking window is requested
+STEERING_THRESHOLD = 2 # percentage points yaw or pitch must move to be sent
+HEARTBEAT_INTERVAL = 0.5 # seconds, resend unchanged values, the Pi sleeps the motors after a few missed ones
+STEERING_LINGER = 1000 # ms to flush the last command when quitting
+LOG_INTERVAL = 1.0 # seconds between steering log records from the same line
+TRACK_INIT = 'init' # start tracking whatever is under the crosshair
+TRACK_DROP = 'drop'
+TRACK_CYCLE = 'cycle' # switch to the next tracker backend
+TRACK_ALIVE = 'alive' # edge mode only, the Pi drops the target without these
+TRACKING_STARTED = b'started' # the tracking thread took a frame
+TRACKING_DONE = b'done' # the tracking thread finished a frame
+TRACKING_RESET = b'reset' # the target was dropped or re-initialised
+DEADZONE_X = 0.01 # fraction of the frame width the target may be off centre
+DEADZONE_Y = 0.05 # as above, of the height
+EVENT_TYPE_BUTTON = 1
+EVENT_TYPE_AXIS = 2
+BUTTON_CODE = {
+	0: "btn_cross",
+	1: "btn_circle",
+	2: "btn_triangle",
+	3: "btn_square",
+	4: "btn_L1",
+	5: "btn_R1",
+	6: "btn_L2",
+	7: "btn_R2",
+	8: "btn_select",
+	9: "btn_start",
+	10: "btn_ps",
+	11: "btn_analog_left",
+	12: "btn_analog_right",
+	13: "btn_dpad_up",
+	14: "btn_dpad_down",
+	15: "btn_dpad_left",
+	16: "btn_dpad_right"
+}
+AXIS_CODE = {
+	0: "left_x",
+	1: "left_y",
+	2: "left_trigger",
+	3: "right_x",
+	4: "right_y",
+	5: "right_trigger"
+}
+
+class RateLimitFilter(logging.Filter):
+	# Lets one record per call site through every `interval` seconds
+	def __init__(self, interval: float=LOG_INTERVAL) -> None:
+		super().__init__()
+		self.interval = interval
+		self._last = {}
+
+	def filter(self, record: logging.LogRecord) -> bool:
+		key = (record.pathname, record.lineno)
+		now = time.monotonic()
+		if now - self._last.get(key, -self.interval) < self.interval:
+			return False
+		self._last[key] = now
+		return True
+
+steering_logger.addFilter(RateLimitFilter())
+
+# Controller state layout: last update, axes, buttons, then per-button press
+# and release counters. Counters only grow, so a reader comparing two of its
+# own snapshots sees every edge exactly once, however late it looks.
+STATE_LAST_UPDATE = 0
+STATE_AXES = 1
+STATE_BUTTONS = STATE_AXES + len(AXIS_CODE)
+STATE_PRESSES = STATE_BUTTONS + len(BUTTON_CODE)
+STATE_RELEASES = STATE_PRESSES + len(BUTTON_CODE)
+STATE_SIZE = STATE_RELEASES + len(BUTTON_CODE)
+STATE_INDEX = dict(
+	last_update=STATE_LAST_UPDATE,
+	**{name: STATE_AXES + code for code, name in AXIS_CODE.items()},
+	**{name: STATE_BUTTONS + code for code, name in BUTTON_CODE.items()}
+)
+
+class ControllerSnapshot():
+	# Immutable view of the controller, fields are read as attributes
+	__slots__ = ('values', 'sequence')
+
+	def __init__(self, values: np.ndarray, sequence: int) -> None:
+		self.values = values
+		self.sequence = sequence
+
+	def __getattr__(self, name: str) -> int:
+		try:
+			return int(self.values[STATE_INDEX[name]])
+		except KeyError:
+			raise AttributeError(name) from None
+
+	def pressed(self, button: str, since: 'ControllerSnapshot'=None) -> bool:
+		# Pressed at least once after `since` was taken, or held when there is none
+		code = STATE_INDEX[button] - STATE_BUTTONS
+		if since is None:
+			return bool(self.values[STATE_BUTTONS + code])
+		return self.values[STATE_PRESSES + code] != since.values[STATE_PRESSES + code]
+
+	def released(self, button: str, since: 'ControllerSnapshot'=None) -> bool:
+		code = STATE_INDEX[button] - STATE_BUTTONS
+		if since is None:
+			return not self.values[STATE_BUTTONS + code]
+		return self.values[STATE_RELEASES + code] != since.values[STATE_RELEASES + code]
+
+class ControllerState():
+	# Single writer (the reactor), any number of readers. Writes
+	# are bracketed by a seqlock counter, odd while a write is in progress.
+	# Readers copy the whole array and retry if the counter moved, so they
+	# never block the writer and never see half of a batch of events.
+	def __init__(self) -> None:
+		self._values = np.zeros(STATE_SIZE, dtype=np.int64)
+		self._sequence = 0
+
+	def push(self, events: list) -> None:
+		# events are (time, value, type, number) as read from the joystick
+		self._sequence += 1
+		values = self._values
+		for timestamp, value, type_, code in events:
+			values[STATE_LAST_UPDATE] = timestamp
+			if type_ == EVENT_TYPE_BUTTON and code in BUTTON_CODE:
+				if bool(value) != bool(values[STATE_BUTTONS + code]):
+					values[(STATE_PRESSES if value else STATE_RELEASES) + code] += 1
+				values[STATE_BUTTONS + code] = value
+			elif type_ == EVENT_TYPE_AXIS and code in AXIS_CODE:
+				values[STATE_AXES + code] = value
+		self._sequence += 1
+
+	def snapshot(self) -> ControllerSnapshot:
+		while True:
+			sequence = self._sequence
+			if sequence & 1:
+				time.sleep(0)
+				continue
+			values = self._values.copy()
+			if self._sequence == sequence:
+				return ControllerSnapshot(values, sequence)
+
+class ControllerReader():
+	# Joystick and inotify for /dev/input, read by the reactor whenever its
+	# poller finds one of their fds readable. Every event reaches the state as
+	# soon as the kernel has it and a controller plugged in later is picked up
+	# without polling the directory.
+	INPUTS = Path('/dev/input/')
+
+	def __init__(self, poller: zmq.Poller) -> None:
+		self.poller = poller
+		self.state = ControllerState()
+		self.joystick = None
+		self.inotify = Inotify()
+		try:
+			# Permissions are set by udev after the node shows up, hence IN_ATTRIB
+			self.inotify.add_watch(self.INPUTS, IN_CREATE | IN_ATTRIB | IN_DELETE)
+		except OSError as e:
+			# No input subsystem (containers, CI), replays and headless runs
+			# still work without a controller
+			logger.warning('Running without a controller: %s', e)
+			self.inotify.close()
+			self.inotify = None
+			return
+		self.poller.register(self.inotify.fileno(), zmq.POLLIN)
+		self._open_joystick(sorted(path.name for path in self.INPUTS.glob(f'{JOYSTICK_PREFIX}*')))
+
+	def handle(self, fd: int) -> bool:
+		# True if fd is one of ours, the state may have changed
+		if self.inotify is not None and fd == self.inotify.fileno():
+			events = self.inotify.read()
+			if self.joystick is None:
+				self._open_joystick([name for event_mask, name in events if not event_mask & IN_DELETE])
+			return True
+		if self.joystick is not None and fd == self.joystick.fileno():
+			self._read_joystick()
+			return True
+		return False
+
+	def _open_joystick(self, names: list) -> None:
+		for name in names:
+			if not is_joystick(name):
+				continue
+			try:
+				self.joystick = Joystick(self.INPUTS / name)
+			except OSError as e:
+				logger.debug('Cannot open %s yet: %s', name, e)
+				continue
+			self.poller.register(self.joystick.fileno(), zmq.POLLIN)
+			logger.info('Controller connected: %s', self.joystick.path)
+			return
+
+	def _read_joystick(self) -> None:
+		try:
+			events = self.joystick.read()
+		except OSError as e:
+			if e.errno != errno.ENODEV:
+				raise
+			logger.info('Controller disconnected: %s', self.joystick.path)
+			self._close_joystick()
+			return
+		self.state.push([(timestamp, value, type_ & ~JS_EVENT_INIT, code) for timestamp, value, type_, code in events])
+
+	def _close_joystick(self) -> None:
+		if self.joystick is None:
+			return
+		self.poller.unregister(self.joystick.fileno())
+		self.joystick.close()
+		self.joystick = None
+
+	def close(self) -> None:
+		self._close_joystick()
+		if self.inotify is not None:
+			self.poller.unregister(self.inotify.fileno())
+			self.inotify.close()
+
+class TrackingThread(Thread):
+	# Tracks the latest frame handed in by the reactor and tells it over an
+	# inproc socket when a frame is done or the target was reset. Sleeps on a
+	# condition while there is nothing to do, a frame submitted while another
+	# one is tracked replaces whatever was still waiting.
+	class TRACKER_STATE(Enum):
+		WAITING = 0
+		INITIALIZING = 1
+		TRACKING = 2
+
+	def __init__(self, tracking_scale: float=DEFAULT_TRACKING_SCALE, tracking_roi: float=None, tracker: str=DEFAULT_TRACKER, keyframes: bool=False, metrics: Metrics=None, show_stats: bool=False, edge: bool=False, headless: bool=False):
+		super().__init__(name="Tracking Thread")
+		self.keep_running = True
+		# Tracking runs on the received frame scaled by tracking_scale, display
+		# always happens at CV_FRAME_WIDTH x CV_FRAME_HEIGHT
+		self.tracking_scale = tracking_scale
+		self.tracking_roi = tracking_roi
+		self.tracker = tracker
+		self.keyframes = keyframes
+		self.metrics = metrics if metrics is not None else Metrics()
+		self.show_stats = show_stats
+		self.headless = headless
+		self._stats = ''
+		self._stats_updated = 0
+		# In edge mode the Pi tracks, frames are its thumbnails and only the
+		# latest target state it published is drawn on them
+		self.edge = edge
+		self.edge_state = None
+		# Capture, receive and tracking timestamps of the latest tracking
+		# result, the steering loop passes them on with the command
+		self.tracked = None
+		self.predictor = TargetPredictor()
+		self.delta_x = 0
+		self.delta_y = 0
+		self._condition = Condition()
+		self._frame = None # frame, capture timestamp, receive time, region
+		self._background = None
+		# Window and size the frame service may cut the next frame down to,
+		# None while not tracking
+		self.region = None
+		self._commands = []
+
+	def submit(self, frame: np.ndarray, captured: float, received: float, region: tuple=None) -> bool:
+		# True if a frame still waiting to be tracked was dropped for this one.
+		# region is (window, whole frame size) for frames cut out by the frame
+		# service.
+		with self._condition:
+			dropped = self._frame is not None
+			self._frame = (frame, captured, received, region)
+			self._condition.notify()
+		return dropped
+
+	def command(self, command: str) -> None:
+		# One of the TRACK_* commands, applied before the next frame
+		with self._condition:
+			self._commands.append(command)
+			self._condition.notify()
+
+	def run(self) -> None:
+		try:
+			self._run()
+		except KeyboardInterrupt:
+			return
+
+	def _run(self) -> None:
+		results = zmq_context.socket(zmq.PAIR)
+		results.connect(ZMQ_TRACKING_RESULTS)
+		# Headless runs draw nothing at all, not even the overlays
+		renderer = None if self.headless else RenderThread(CV_WINDOW_NAME)
+		if renderer is not None:
+			renderer.start()
+		tracker = ScaledTracker(self.tracker, self.tracking_scale, self.tracking_roi, self.keyframes)
+		tracker_state = self.TRACKER_STATE.WAITING
+		xhair_top_left, _ = self._get_xhair_rect(CV_XHAIR_SIZE)
+		try:
+			while True:
+				with self._condition:
+					self._condition.wait_for(lambda: self._frame is not None or self._commands or not self.keep_running)
+					if not self.keep_running:
+						break
+					pending, self._frame = self._frame, None
+					commands, self._commands = self._commands, []
+				if pending is not None:
+					results.send(TRACKING_STARTED)
+				# - TRIANGLE CYCLES TRACKER BACKENDS, EVEN MID-TRACK
+				for command in commands:
+					if command == TRACK_CYCLE:
+						tracker.set_backend(next_tracker(tracker.backend))
+						continue
+					tracker_state = self.TRACKER_STATE.INITIALIZING if command == TRACK_INIT else self.TRACKER_STATE.WAITING
+					self._drop_target()
+					results.send(TRACKING_RESET)
+				if pending is None:
+					continue
+				source, captured, received, region = pending
+				to_display_x, to_display_y = self._display_scale(source, region)
+				target = None # bbox in display coordinates and its label
+
+				# - UPDATE TRACKING
+				if self.edge:
+					state = self.edge_state
+					if state is not None and state['tracking']:
+						target = (scale_bbox(state['bbox'], to_display_x, to_display_y), f"{state['confidence']:.2f}")
+				elif tracker_state == self.TRACKER_STATE.TRACKING:
+					ret, bbox = tracker.update(source, region[0] if region is not None else None)
+					if not ret:
+						logger.info('Target lost')
+						tracker_state = self.TRACKER_STATE.WAITING
+						self._drop_target()
+						results.send(TRACKING_DONE)
+						continue
+					tracked = time.time()
+					self.metrics.observe(STAGE_RECEIVE_TO_TRACKED, tracked - received)
+					bbox = scale_bbox(bbox, to_display_x, to_display_y)
+					target = (bbox, None)
+					vec_x_1 = bbox[0] + bbox[2] // 2
+					vec_y_1 = bbox[1] + bbox[3] // 2
+					self.delta_x, self.delta_y = apply_deadzone(CV_FRAME_WIDTH // 2 - vec_x_1, CV_FRAME_HEIGHT // 2 - vec_y_1)
+					# Capture timestamps keep network jitter out of the motion model,
+					# replayed frames fall back to the receive time
+					self.predictor.update((vec_x_1, vec_y_1), captured or received)
+					# Replayed frames carry no capture time the Pi could compare against
+					self.tracked = (captured or 0.0, received, tracked)
+				elif tracker_state == self.TRACKER_STATE.INITIALIZING and region is None:
+					# Picking a target takes the whole frame
+					tracker.init(source, scale_bbox((*xhair_top_left, *CV_XHAIR_SIZE), 1 / to_display_x, 1 / to_display_y))
+					tracker_state = self.TRACKER_STATE.TRACKING
+				self.region = tracker.region() if tracker_state == self.TRACKER_STATE.TRACKING else None
+				# Steering goes out before the frame is drawn
+				results.send(TRACKING_DONE)
+				if renderer is not None:
+					renderer.show(self._draw(source, region, target))
+		finally:
+			if renderer is not None:
+				renderer.quit()
+				renderer.join()
+			results.close()
+
+	def _draw(self, source: np.ndarray, region: tuple, target: tuple) -> np.ndarray:
+		# Display frame with the overlays on it, handed over to the renderer
+		frame = self._display_frame(source, region)
+		# - DRAW TARGET
+		if target is not None:
+			bbox, label = target
+			cv2.rectangle(frame, bbox[:2], (bbox[0] + bbox[2], bbox[1] + bbox[3]), CV_RED, 2)
+			if label is not None:
+				cv2.putText(frame, label, (bbox[0], bbox[1] - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, CV_RED, 1)
+			else:
+				vec_x_0 = CV_FRAME_WIDTH // 2
+				vec_y_0 = CV_FRAME_HEIGHT // 2
+				vec_x_1 = bbox[0] + bbox[2] // 2
+				vec_y_1 = bbox[1] + bbox[3] // 2
+				cv2.arrowedLine(frame, (vec_x_0, vec_y_0), (vec_x_1, vec_y_0), CV_PINK, 1)
+				cv2.arrowedLine(frame, (vec_x_0, vec_y_0), (vec_x_0, vec_y_1), CV_PINK, 1)
+		# - DRAW CROSSHAIR
+		cv2.rectangle(frame, *self._get_xhair_rect(CV_XHAIR_SIZE), CV_PINK, 2)
+		if self.show_stats:
+			if time.monotonic() - self._stats_updated > STATS_REFRESH:
+				self._stats = self.metrics.stats_line()
+				self._stats_updated = time.monotonic()
+			cv2.putText(frame, self._stats, (10, CV_FRAME_HEIGHT - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, CV_GREEN, 1)
+		return frame
+
+	def predicted_delta(self, horizon: float) -> tuple:
+		# Target offset from the frame centre `horizon` seconds after the capture
+		# of the latest tracked frame, the raw delta until the filter has data
+		position = self.predictor.predict(horizon) if self.tracked is not None else None
+		if position is None:
+			return self.delta_x, self.delta_y
+		return apply_deadzone(CV_FRAME_WIDTH // 2 - position[0], CV_FRAME_HEIGHT // 2 - position[1])
+
+	def _display_scale(self, source: np.ndarray, region: tuple) -> tuple:
+		# Scale from source coordinates to the display's, which steering is
+		# worked out in whether or not anything is displayed
+		width, height = region[1] if region is not None else (source.shape[1], source.shape[0])
+		return CV_FRAME_WIDTH / width, CV_FRAME_HEIGHT / height
+
+	def _display_frame(self, source: np.ndarray, region: tuple) -> np.ndarray:
+		# A cut out window is pasted over the last whole frame, which goes stale
+		# around it until the next whole frame arrives
+		if region is None:
+			frame = cv2.resize(source, (CV_FRAME_WIDTH, CV_FRAME_HEIGHT))
+			self._background = frame.copy()
+			return frame
+		window = region[0]
+		to_display_x, to_display_y = self._display_scale(source, region)
+		if self._background is None:
+			self._background = np.zeros((CV_FRAME_HEIGHT, CV_FRAME_WIDTH) + source.shape[2:], source.dtype)
+		frame = self._background.copy()
+		x, y, w, h = scale_bbox(window, to_display_x, to_display_y)
+		w, h = min(w, CV_FRAME_WIDTH - x), min(h, CV_FRAME_HEIGHT - y)
+		if w > 0 and h > 0:
+			frame[y:y + h, x:x + w] = cv2.resize(source, (w, h))
+		return frame
+
+	def _drop_target(self) -> None:
+		self.delta_x = 0
+		self.delta_y = 0
+		self.tracked = None
+		self.region = None
+		self.predictor.reset()
+
+	def _get_xhair_rect(self, xhair) -> tuple:
+		return (
+			(
+				(CV_FRAME_WIDTH - xhair[0]) // 2,
+				(CV_FRAME_HEIGHT - xhair[1]) // 2
+			),
+			(
+				(CV_FRAME_WIDTH + xhair[0]) // 2,
+				(CV_FRAME_HEIGHT + xhair[1]) // 2
+			)
+		)
+
+	def quit(self) -> None:
+		with self._condition:
+			self.keep_running = False
+			self._condition.notify()
+
+class Reactor():
+	# Runs the PC side on one thread. A single zmq.Poller multiplexes frames,
+	# the joystick and /dev/input fds, tracking results and steering acks, and
+	# each is handled as soon as it is readable. The only timers are the
+	# steering heartbeat and the recorded timing of a replay, so an idle
+	# turret sleeps in poll().
+	def __init__(self, args: argparse.Namespace, metrics: Metrics) -> None:
+		self.args = args
+		self.metrics = metrics
+		self.poller = zmq.Poller()
+		self.controller = ControllerReader(self.poller)
+		self.controller_state = self.controller.state.snapshot()
+		self.results = zmq_context.socket(zmq.PAIR)
+		self.results.bind(ZMQ_TRACKING_RESULTS)
+		self.poller.register(self.results, zmq.POLLIN)
+		self.tracking = TrackingThread(
+			tracking_scale=args.tracking_scale,
+			tracking_roi=args.tracking_roi,
+			tracker=args.tracker,
+			keyframes=args.keyframes,
+			metrics=metrics,
+			show_stats=args.stats,
+			edge=args.edge,
+			headless=args.headless
+		)
+		self.tracking_frames = 0 # submitted and not yet done
+		# Frames can come from a recording instead of the frame service, and
+		# whatever is received can be recorded for later replay
+		self.replay = None
+		self.frame_socket = None
+		if args.replay:
+			self.replay = FrameReplay(args.replay, args.replay_speed)
+		else:
+			self.frame_socket = self._connect()
+			self.poller.register(self.frame_socket, zmq.POLLIN)
+		self.recorder = FrameRecorder(args.record) if args.record else None
+		self.last_frame_info = (None, None) # capture timestamp, sequence
+		self.last_sent = None
+		self.last_region = None
+		self.request_frames = self.frame_socket is not None and not (args.stream or args.edge)
+		self.requested = False # a frame request is in flight
+		# Recordings need whole frames of one size
+		self.crop = not (args.stream or args.no_server_crop or args.record)
+		self.last_whole_frame = 0.0
+		# DEALER so acks can be collected asynchronously, the pin service's
+		# ROUTER sees the same empty delimiter a REQ socket would send
+		self.steering:zmq.Socket = zmq_context.socket(zmq.DEALER)
+		self.steering.setsockopt(zmq.LINGER, STEERING_LINGER)
+		self.steering.connect(ZMQ_INTERFACE_STEERING)
+		self.poller.register(self.steering, zmq.POLLIN)
+		# Edge mode picks and drops targets on the Pi, which tracks and steers
+		self.edge_control = None
+		self.edge_frame_size = None
+		self.edge_thumbnail = None
+		if args.edge:
+			self.edge_control = zmq_context.socket(zmq.DEALER)
+			self.edge_control.setsockopt(zmq.LINGER, STEERING_LINGER)
+			self.edge_control.connect(ZMQ_INTERFACE_EDGE_CONTROL)
+			self.poller.register(self.edge_control, zmq.POLLIN)
+		self.sequence = SequenceCounter()
+		self.sleep = False
+		self.last_tracked = None
+		self.last_values = None
+		self.last_command = None
+
+	def run(self) -> None:
+		self.tracking.start()
+		try:
+			if self.request_frames:
+				self._request_frame()
+			self._steer()
+			while not self.sleep:
+				ready = self.poller.poll(self._timeout())
+				steer = False
+				for item, _ in ready:
+					if item is self.frame_socket:
+						self._on_frame()
+					elif item is self.results:
+						steer |= self._on_tracking_result()
+					elif item is self.steering:
+						recv_acks(self.steering, self.metrics, self.last_command)
+					elif item is self.edge_control:
+						recv_edge_replies(self.edge_control)
+					else:
+						steer |= self._on_controller(item)
+				if self.replay is not None and not self._replay_frame():
+					logger.info('Replay finished')
+					break
+				if steer or time.time() - self.last_command.sent >= HEARTBEAT_INTERVAL:
+					self._steer()
+		finally:
+			logger.info('Quitting')
+			self.close()
+
+	def _timeout(self) -> float:
+		# ms until the next timer fires
+		deadlines = [self.last_command.sent + HEARTBEAT_INTERVAL - time.time()]
+		if self.replay is not None and (self.args.replay_speed == REPLAY_RECORDED or not self.tracking_frames):
+			delay = self.replay.delay()
+			if delay is not None:
+				deadlines.append(delay)
+		return max(0.0, min(deadlines)) * 1000
+
+	def _on_frame(self) -> None:
+		if self.args.edge:
+			self._on_edge_state()
+			return
+		frame = self._recv_frame(self.frame_socket)
+		if self.args.stream:
+			# Drop whatever queued up while we were busy, only the newest matters
+			while self.frame_socket.poll(0, zmq.POLLIN):
+				frame = self._recv_frame(self.frame_socket)
+		else:
+			self.requested = False
+		if frame is None:
+			return
+		received = time.time()
+		captured = self.last_frame_info[0]
+		self.metrics.observe_between(STAGE_CAPTURE_TO_SEND, captured, self.last_sent)
+		# Spans both machines, only meaningful with synchronised clocks
+		self.metrics.observe_between(STAGE_SEND_TO_RECEIVE, self.last_sent, received)
+		if self.recorder is not None:
+			self.recorder.write(frame, *self.last_frame_info)
+		self._submit(frame, captured, received, self.last_region)
+
+	def _on_edge_state(self) -> None:
+		# Every state redraws the latest thumbnail, so the target box moves at
+		# the tracking rate however seldom the thumbnails come
+		messages = [self.frame_socket.recv_multipart()]
+		while self.frame_socket.poll(0, zmq.POLLIN):
+			messages.append(self.frame_socket.recv_multipart())
+		received = time.time()
+		for topic, metadata, *payload in messages:
+			metadata = json.loads(metadata)
+			if topic == EDGE_TOPIC_THUMBNAIL:
+				self.edge_thumbnail = cv2.imdecode(np.frombuffer(payload[0], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+				height, width = metadata['source_shape'][:2]
+				self.edge_frame_size = (width, height)
+				continue
+			self.tracking.edge_state = metadata
+			self.edge_frame_size = tuple(metadata['frame_size'])
+			self.metrics.observe_between(STAGE_CAPTURE_TO_SEND, metadata['timestamp'], metadata['sent'])
+			self.metrics.observe_between(STAGE_SEND_TO_RECEIVE, metadata['sent'], received)
+		if self.edge_thumbnail is not None:
+			width, height = self.edge_frame_size
+			self._submit(self.edge_thumbnail, metadata['timestamp'], received, ((0, 0, width, height), (width, height)))
+
+	def _replay_frame(self) -> bool:
+		# False once the recording is over. At REPLAY_MAX the next frame goes
+		# out when the tracker is done with the last one, so no frame is skipped.
+		delay = self.replay.delay()
+		if delay is None:
+			return False
+		if delay > 0 or (self.args.replay_speed != REPLAY_RECORDED and self.tracking_frames):
+			return True
+		captured = self.replay.read_captured()
+		self._submit(captured.frame, None, time.time())
+		return True
+
+	def _submit(self, frame: np.ndarray, captured: float, received: float, region: tuple=None) -> None:
+		if not self.tracking.submit(frame, captured, received, region):
+			self.tracking_frames += 1
+
+	def _on_tracking_result(self) -> bool:
+		# True if the target may have changed
+		changed = False
+		while self.results.poll(0, zmq.POLLIN):
+			result = self.results.recv()
+			if result == TRACKING_STARTED:
+				if self.request_frames and not self.requested:
+					# The next frame travels while this one is tracked
+					self._request_frame()
+				continue
+			if result == TRACKING_DONE:
+				self.tracking_frames -= 1
+			changed = True
+		return changed
+
+	def _on_controller(self, fd: int) -> bool:
+		if not self.controller.handle(fd):
+			return False
+		last_state, self.controller_state = self.controller_state, self.controller.state.snapshot()
+		# - CROSS PICKS THE TARGET UNDER THE CROSSHAIR, SQUARE DROPS IT
+		if self.controller_state.pressed('btn_cross', last_state):
+			self._track_command(TRACK_INIT)
+		if self.controller_state.pressed('btn_square', last_state):
+			self._track_command(TRACK_DROP)
+		if self.controller_state.pressed('btn_triangle', last_state):
+			self._track_command(TRACK_CYCLE)
+		if self.controller_state.pressed('btn_circle', last_state):
+			self.sleep = True
+		return True
+
+	def _track_command(self, command: str) -> None:
+		if self.edge_control is None:
+			self.tracking.command(command)
+			return
+		request = dict(token='dupa', command=command, camera=self.args.camera)
+		if command == TRACK_INIT:
+			if self.edge_frame_size is None:
+				logger.warning('Nothing seen from the Pi yet to pick a target in')
+				return
+			# Whatever is under the crosshair, in the camera's frame coordinates
+			width, height = self.edge_frame_size
+			top_left = ((CV_FRAME_WIDTH - CV_XHAIR_SIZE[0]) // 2, (CV_FRAME_HEIGHT - CV_XHAIR_SIZE[1]) // 2)
+			request['bbox'] = scale_bbox((*top_left, *CV_XHAIR_SIZE), width / CV_FRAME_WIDTH, height / CV_FRAME_HEIGHT)
+		elif command == TRACK_DROP:
+			request['sleep'] = self.sleep
+		self.edge_control.send_multipart([b'', json.dumps(request).encode()])
+
+	def _steer(self) -> None:
+		tracked = self.tracking.tracked
+		sent = time.time()
+		delta_x, delta_y = self.tracking.delta_x, self.tracking.delta_y
+		if tracked is not None and not self.args.no_prediction:
+			delta_x, delta_y = self.tracking.predicted_delta(estimate_latency(self.metrics, tracked, sent))
+
+		# In edge mode the Pi steers, only the sticks go out from here
+		horizontal = self._edge_axis(0) if self.args.edge else round(delta_x_to_percentage(delta_x*4))
+		if self.controller_state.left_x:
+			horizontal = round(analog_to_percentage(self.controller_state.left_x))
+
+		vertical = self._edge_axis(1) if self.args.edge else round(delta_y_to_percentage(-delta_y))
+		if self.controller_state.left_y:
+			vertical = round(analog_to_percentage(self.controller_state.left_y))
+
+		values = (horizontal, vertical, self.sleep)
+		if not steering_changed(self.last_values, values) and sent - self.last_command.sent < HEARTBEAT_INTERVAL:
+			return
+		if tracked is not None and tracked is not self.last_tracked:
+			self.metrics.observe(STAGE_TRACKED_TO_COMMAND, sent - tracked[2])
+		self.last_tracked = tracked
+		self.last_command = SteeringCommand(
+			yaw=horizontal,
+			pitch=vertical,
+			sleep=self.sleep,
+			sequence=self.sequence.next(),
+			captured=tracked[0] if tracked is not None else 0.0,
+			sent=sent
+		)
+		self.steering.send_multipart([b'', self.last_command.pack()])
+		steering_logger.info('Sent %s', self.last_command)
+		self.last_values = values
+		if self.edge_control is not None:
+			# Rides along with the heartbeat
+			self._track_command(TRACK_ALIVE)
+
+	def _edge_axis(self, axis: int) -> Optional[int]:
+		# None leaves the motor alone, so a stick coming back to neutral sends
+		# one 0 to stop it before handing the axis back to the Pi
+		if self.last_values is None or not self.last_values[axis]:
+			return None
+		return 0
+
+	def _connect(self) -> zmq.Socket:
+		if self.args.edge:
+			zmq_socket:zmq.Socket = zmq_context.socket(zmq.SUB)
+			zmq_socket.setsockopt(zmq.LINGER, 0)
+			zmq_socket.setsockopt(zmq.SUBSCRIBE, EDGE_TOPIC_STATE)
+			zmq_socket.setsockopt(zmq.SUBSCRIBE, EDGE_TOPIC_THUMBNAIL)
+			zmq_socket.connect(ZMQ_INTERFACE_EDGE_STATE)
+			return zmq_socket
+		if not self.args.stream:
+			zmq_socket:zmq.Socket = zmq_context.socket(zmq.REQ)
+			zmq_socket.setsockopt(zmq.LINGER, 0)
+			zmq_socket.connect(ZMQ_INTERFACE_FRAMES)
+			return zmq_socket
+		zmq_socket:zmq.Socket = zmq_context.socket(zmq.SUB)
+		zmq_socket.setsockopt(zmq.RCVHWM, ZMQ_STREAM_HWM)
+		zmq_socket.setsockopt(zmq.LINGER, 0)
+		# Camera and variant are NUL terminated on the wire, see
+		# frame_service.camera_topic and frame_service.Variant
+		variant = ','.join(f'{name}={value}' for name, value in (('codec', self.args.codec), ('quality', self.args.quality)) if value is not None)
+		zmq_socket.setsockopt(zmq.SUBSCRIBE, f'{self.args.camera}\0{variant}\0'.encode())
+		zmq_socket.connect(ZMQ_INTERFACE_FRAME_STREAM)
+		return zmq_socket
+
+	def _request_frame(self) -> None:
+		request = dict(
+			token='dupa',
+			request_string='send me a frame, please',
+			camera=self.args.camera
+		)
+		if self.args.codec:
+			request.update(codec=self.args.codec, quality=self.args.quality)
+		region = self.tracking.region if self.crop else None
+		if region is not None and time.monotonic() - self.last_whole_frame < WHOLE_FRAME_INTERVAL:
+			# Locked on: only the tracker's window, already at tracking scale
+			window, size = region
+			request.update(roi=list(window), size=list(size))
+		else:
+			self.last_whole_frame = time.monotonic()
+		self.frame_socket.send_json(request)
+		self.requested = True
+
+	def _recv_frame(self, zmq_socket:zmq.Socket) -> Optional[np.ndarray]:
+		if self.args.stream:
+			zmq_socket.recv() # camera topic
+		metadata = zmq_socket.recv_json()
+		if 'error' in metadata:
+			zmq_socket.recv() # empty payload
+			logger.warning('No frame from the Pi: %s', metadata['error'])
+			return None
+		# No capture time rather than ours, the stages must not mix clocks
+		self.last_frame_info = (metadata.get('timestamp'), metadata.get('sequence'))
+		self.last_sent = metadata.get('sent')
+		self.last_region = None
+		if 'roi' in metadata:
+			height, width = metadata['source_shape'][:2]
+			self.last_region = (tuple(metadata['roi']), (width, height))
+		message = zmq_socket.recv(0, copy=True, track=False)
+		buffer = memoryview(message)
+		if metadata.get('codec', 'raw') != 'raw':
+			return cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+		np_array = np.frombuffer(buffer, dtype=metadata['dtype'])
+		return np_array.reshape(metadata['shape'])
+
+	def close(self) -> None:
+		self.tracking.quit()
+		if self.tracking.is_alive():
+			self.tracking.join()
+		self.controller.close()
+		self.results.close()
+		self.steering.close()
+		if self.edge_control is not None:
+			# Quitting must not leave the Pi steering on its own
+			self._track_command(TRACK_DROP)
+			self.edge_control.close()
+		if self.frame_socket is not None:
+			self.frame_socket.close()
+		if self.replay is not None:
+			self.replay.close()
+		if self.recorder is not None:
+			self.recorder.close()
+
+def create_mapping_function(input_min: int, input_max: int, output_min: int, output_max: int):
+	input_span = input_max - input_min
+	output_span = output_max - output_min
+	scale = output_span / input_span
+
+	def mapper(value):
+		if value < input_min:
+			value = input_min
+		elif input_max < value:
+			value = input_max
+		return output_min + (value - input_min) * scale
+
+	return mapper
+
+def apply_deadzone(delta_x: float, delta_y: float) -> tuple:
+	if abs(delta_x) < DEADZONE_X*CV_FRAME_WIDTH:
+		delta_x = 0
+	if abs(delta_y) < DEADZONE_Y*CV_FRAME_HEIGHT:
+		delta_y = 0
+	return delta_x, delta_y
+
+def estimate_latency(metrics: Metrics, tracked: tuple, sent: float) -> float:
+	# How old the tracked frame will be once the command is applied, only from
+	# stages timed on one clock: capture to send on the Pi, what passed since
+	# the frame was received, and half a steering round trip. Send to receive
+	# compares the Pi's clock with ours, without NTP it is way off.
+	stages = metrics.percentiles()
+	capture_to_send = np.nan_to_num(stages.get(STAGE_CAPTURE_TO_SEND, 0.0))
+	return float(capture_to_send + (sent - tracked[1]) + np.nan_to_num(stages.get(STAGE_COMMAND_ROUND_TRIP, 0.0)) / 2)
+
+def steering_changed(last: tuple, values: tuple) -> bool:
+	# values are yaw, pitch, sleep. Stopping and reversing always count, no
+	# matter how small the step.
+	if last is None or last[2] != values[2]:
+		return True
+	for old, new in zip(last[:2], values[:2]):
+		# None leaves the axis alone
+		if (old is None) != (new is None):
+			return True
+		if new is None:
+			continue
+		if abs(new - old) >= STEERING_THRESHOLD or (old > 0) != (new > 0) or (old < 0) != (new < 0):
+			return True
+	return False
+
+def recv_acks(zmq_socket: zmq.Socket, metrics: Metrics, last_command: SteeringCommand) -> None:
+	# Acks are read as they come, the loop never waits for the Pi
+	while zmq_socket.poll(0, zmq.POLLIN):
+		status, sequence, applied = unpack_ack(zmq_socket.recv_multipart()[-1])
+		if last_command is not None and sequence == last_command.sequence:
+			metrics.observe(STAGE_COMMAND_ROUND_TRIP, time.time() - last_command.sent)
+		steering_logger.debug('Ack %d: status %d', sequence, status)
+
+def recv_edge_replies(zmq_socket: zmq.Socket) -> None:
+	while zmq_socket.poll(0, zmq.POLLIN):
+		reply = json.loads(zmq_socket.recv_multipart()[-1])
+		if reply.get('status') != 'ok':
+			logger.warning('The Pi refused an edge command: %s', reply.get('status'))
+
+analog_to_percentage = create_mapping_function(-32768, 32767, -100, 100)
+delta_y_to_percentage = create_mapping_function(-CV_FRAME_HEIGHT//2, CV_FRAME_HEIGHT//2, -100, 100)
+delta_x_to_percentage = create_mapping_function(-CV_FRAME_WIDTH//2, CV_FRAME_WIDTH//2, -100, 100)
+
+def parse_args(argv: list=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--stream', action='store_true', help='subscribe to the streaming frame service')
+	parser.add_argument('--camera', default=DEFAULT_CAMERA, help='name of the camera to take frames from')
+	parser.add_argument('--codec', choices=('raw', 'jpeg', 'png'), default=None, help='frame encoding to request')
+	parser.add_argument('--quality', type=int, default=None, help='JPEG quality or PNG compression level')
+	parser.add_argument('--tracker', choices=TRACKERS, default=DEFAULT_TRACKER, help='tracker backend, triangle cycles through them at runtime')
+	parser.add_argument('--record', default=None, help='write every received frame to this recording directory')
+	parser.add_argument('--replay', default=None, help='take frames from a recording instead of the frame service')
+	parser.add_argument('--replay-speed', choices=REPLAY_SPEEDS, default=REPLAY_RECORDED)
+	parser.add_argument('--tracking-scale', type=parse_tracking_scale, default=DEFAULT_TRACKING_SCALE, help='scale of the received frame the tracker runs on, independent of the display size')
+	parser.add_argument('--tracking-roi', type=float, default=None, help='only track inside a window padded by this many target sizes around the target')
+	parser.add_argument('--keyframes', action='store_true', help='run the tracker only every few frames, as many as the frame rate needs, and follow the target with optical flow in between')
+	parser.add_argument('--no-server-crop', action='store_true', help='always request whole frames, instead of only the tracking window while locked on')
+	parser.add_argument('--edge', action='store_true', help='let the Pi track and steer (turret_daemon.py --edge), only pick targets and watch its thumbnails')
+	parser.add_argument('--metrics-port', type=int, default=None, help='serve per-stage latency histograms on this local port')
+	parser.add_argument('--stats', action='store_true', help='show median per-stage latencies on screen')
+	parser.add_argument('--headless', action='store_true', help='open no window and draw nothing, for unattended runs and benchmarks')
+	parser.add_argument('--no-prediction', action='store_true', help='steer towards where the target was seen instead of where it is predicted to be')
+	args = parser.parse_args(argv)
+	if args.edge and (args.stream or args.record or args.replay):
+		parser.error('--edge takes no frames to stream, record or replay')
+	return args
+
+def main():
+	args = parse_args()
+	metrics = Metrics()
+	if args.metrics_port:
+		MetricsServer(metrics, args.metrics_port).start()
+	reactor = Reactor(args, metrics)
+	try:
+		reactor.run()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,253 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+import cv2
+import numpy as np
+import zmq
+
+from frame_service import TOKEN, select_camera
+from pin_service import apply_command
+from turret.codec import CODEC_JPEG, encode_frame
+from turret.metrics import STAGE_CAPTURE_TO_APPLIED, Metrics
+from turret.protocol import SteeringCommand
+from turret.tracking import (DEFAULT_TRACKER, DEFAULT_TRACKING_SCALE,
+                             AppearanceCheck, ScaledTracker, next_tracker)
+
+ZMQ_INTERFACE_CONTROL = 'tcp://0.0.0.0:42004'
+ZMQ_INTERFACE_STATE = 'tcp://0.0.0.0:42005'
+TOPIC_STATE = b'state'
+TOPIC_THUMBNAIL = b'thumbnail'
+# Same names the PC uses for its own tracking thread
+COMMAND_INIT = 'init' # start tracking bbox, in the camera's frame coordinates
+COMMAND_DROP = 'drop'
+COMMAND_CYCLE = 'cycle' # switch to the next tracker backend
+COMMAND_ALIVE = 'alive' # keeps the target while the PC has nothing else to say
+COMMANDS = (COMMAND_INIT, COMMAND_DROP, COMMAND_CYCLE, COMMAND_ALIVE)
+CONTACT_TIMEOUT = 2.0 # seconds without a command before the target is dropped
+FRAME_TIMEOUT = 1.0 # seconds to wait for a frame before looking at commands again
+THUMBNAIL_INTERVAL = 0.5 # seconds between thumbnails of the whole frame
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_QUALITY = 60
+# Steering matches what the PC sends for the same offset
+DEADZONE_X = 0.01 # fraction of the frame width the target may be off centre
+DEADZONE_Y = 0.05 # as above, of the height
+YAW_GAIN = 4
+
+logger = logging.getLogger(__name__)
+
+class EdgeTracker(Thread):
+	# Tracks next to the capture loop and steers the motors straight from the
+	# results, so the control loop never leaves the Pi. Only the target state
+	# is published, plus a small JPEG of the whole frame every
+	# THUMBNAIL_INTERVAL so the PC can show what is going on and pick targets.
+	# Commands are queued by serve_edge_control and applied between frames.
+	def __init__(self, cameras: dict, motors: tuple, backend: str=DEFAULT_TRACKER, scale: float=DEFAULT_TRACKING_SCALE, roi_margin: float=None, keyframes: bool=False, metrics: Metrics=None):
+		super().__init__(name="Edge Tracking Thread", daemon=True)
+		self.cameras = cameras
+		self.camera = next(iter(cameras.values()))
+		self.motors = motors
+		self.tracker = ScaledTracker(backend, scale, roi_margin, keyframes)
+		self.check = AppearanceCheck()
+		self.metrics = metrics
+		self.keep_running = True
+		self.tracking = False
+		self.manual = False # the sticks steer, tracking only reports
+		self.last_contact = time.monotonic()
+		self._lock = Lock()
+		self._commands = []
+		self._init_bbox = None # picked, initialised on the next frame
+		self._steering = None # yaw and pitch last applied
+		self._last_thumbnail = 0.0
+
+	def command(self, request: dict) -> None:
+		# A request accepted by parse_edge_request
+		with self._lock:
+			self.last_contact = time.monotonic()
+			if request['command'] != COMMAND_ALIVE:
+				self._commands.append(request)
+
+	@contextmanager
+	def override(self, command: SteeringCommand):
+		# Wraps the steering paths applying their newest command, so the
+		# tracker never steers in between. Values for either axis, or a sleep,
+		# take the motors over. The first command leaving both alone hands them
+		# back, and the tracker's speed is applied afresh on the next frame.
+		with self._lock:
+			manual = command.yaw is not None or command.pitch is not None or command.sleep
+			if manual != self.manual:
+				logger.info('Manual steering %s', 'on' if manual else 'off')
+			if manual or self.manual:
+				self._steering = None
+			self.manual = manual
+			yield
+
+	def run(self) -> None:
+		zmq_socket:zmq.Socket = zmq.Context.instance().socket(zmq.PUB)
+		zmq_socket.setsockopt(zmq.LINGER, 0)
+		zmq_socket.bind(ZMQ_INTERFACE_STATE)
+		sequence = -1
+		try:
+			while self.keep_running:
+				camera = self.camera
+				captured = camera.capture.read_after(sequence, FRAME_TIMEOUT)
+				with self._lock:
+					commands, self._commands = self._commands, []
+					silent = time.monotonic() - self.last_contact
+				for request in commands:
+					self._apply(request)
+				if self.tracking and silent > CONTACT_TIMEOUT:
+					# Same dead man's switch as the TCP stepper
+					logger.warning('No word from the PC for %.1fs, dropping the target', silent)
+					self._drop(sleep=True)
+				if captured is None:
+					if not camera.capture.is_alive():
+						logger.error('Camera %s stopped, giving up edge tracking', camera.name)
+						return
+					continue
+				if self.camera is not camera:
+					sequence = -1
+					continue
+				frame, timestamp, sequence = captured.frame, captured.timestamp, captured.sequence
+				if self.tracking or self._init_bbox is not None:
+					self._track(zmq_socket, frame, timestamp, sequence)
+				if time.monotonic() - self._last_thumbnail >= THUMBNAIL_INTERVAL:
+					self._send_thumbnail(zmq_socket, frame, timestamp, sequence)
+		finally:
+			self._drop()
+			zmq_socket.close()
+
+	def _apply(self, request: dict) -> None:
+		command = request['command']
+		if command == COMMAND_CYCLE:
+			self.tracker.set_backend(next_tracker(self.tracker.backend))
+			return
+		self._drop(sleep=request.get('sleep', False))
+		if command == COMMAND_INIT:
+			if 'camera' in request:
+				self.camera = select_camera(request, self.cameras)
+			self._init_bbox = tuple(request['bbox'])
+
+	def _track(self, zmq_socket: zmq.Socket, frame: np.ndarray, timestamp: float, sequence: int) -> None:
+		height, width = frame.shape[:2]
+		if self._init_bbox is not None:
+			bbox, self._init_bbox = clamp_bbox(self._init_bbox, width, height), None
+			if bbox is None:
+				logger.warning('Target picked outside the frame')
+				return
+			self.tracker.init(frame, bbox)
+			self.check.init(frame, bbox)
+			self.tracking = True
+			logger.info('Tracking %s on %s with %s', bbox, self.camera.name, self.tracker.backend)
+		else:
+			ret, bbox = self.tracker.update(frame)
+			if not ret:
+				logger.info('Target lost')
+				self._drop()
+				self._send_state(zmq_socket, dict(tracking=False), width, height, timestamp, sequence)
+				return
+		delta_x = width // 2 - (bbox[0] + bbox[2] // 2)
+		delta_y = height // 2 - (bbox[1] + bbox[3] // 2)
+		yaw, pitch = steering_for(delta_x, delta_y, width, height)
+		# Steering first, reporting is off the critical path. Under the lock, so
+		# nothing is applied once override() returned.
+		with self._lock:
+			if not self.manual and (yaw, pitch) != self._steering:
+				apply_command(SteeringCommand(yaw=yaw, pitch=pitch), *self.motors)
+				self._steering = (yaw, pitch)
+		if self.metrics is not None:
+			self.metrics.observe_between(STAGE_CAPTURE_TO_APPLIED, timestamp, time.time())
+		state = dict(
+			tracking=True,
+			bbox=bbox,
+			delta=(delta_x, delta_y),
+			confidence=self.check.score(frame, bbox),
+			yaw=yaw,
+			pitch=pitch,
+			tracker=self.tracker.backend
+		)
+		self._send_state(zmq_socket, state, width, height, timestamp, sequence)
+
+	def _drop(self, sleep: bool=False) -> None:
+		self.tracking = False
+		self._init_bbox = None
+		with self._lock:
+			if sleep:
+				for motor in self.motors:
+					motor.sleep()
+			elif self._steering not in (None, (0, 0)):
+				# Ramp down, motors never driven from here are left alone
+				apply_command(SteeringCommand(yaw=0, pitch=0), *self.motors)
+			self._steering = None
+
+	def _send_state(self, zmq_socket: zmq.Socket, state: dict, width: int, height: int, timestamp: float, sequence: int) -> None:
+		state.update(
+			camera=self.camera.name,
+			frame_size=(width, height),
+			timestamp=timestamp,
+			sequence=sequence,
+			sent=time.time()
+		)
+		zmq_socket.send_multipart([TOPIC_STATE, json.dumps(state).encode()])
+		self.camera.observe(state)
+
+	def _send_thumbnail(self, zmq_socket: zmq.Socket, frame: np.ndarray, timestamp: float, sequence: int) -> None:
+		self._last_thumbnail = time.monotonic()
+		height, width = frame.shape[:2]
+		size = (THUMBNAIL_WIDTH, round(height * THUMBNAIL_WIDTH / width))
+		thumbnail = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+		metadata = dict(
+			camera=self.camera.name,
+			timestamp=timestamp,
+			sequence=sequence,
+			source_shape=frame.shape,
+			dtype=str(thumbnail.dtype),
+			shape=thumbnail.shape,
+			codec=CODEC_JPEG,
+			sent=time.time()
+		)
+		zmq_socket.send_multipart([TOPIC_THUMBNAIL, json.dumps(metadata).encode(), encode_frame(thumbnail, CODEC_JPEG, THUMBNAIL_QUALITY)], copy=False)
+
+	def quit(self) -> None:
+		self.keep_running = False
+
+def parse_edge_request(message: bytes):
+	# Returns the request, or None and why it was refused
+	try:
+		request = json.loads(message)
+	except ValueError:
+		return None, 'invalid json'
+	if not isinstance(request, dict):
+		return None, 'invalid request'
+	if request.get('token') != TOKEN:
+		logger.warning('Invalid token: %s', request.get('token'))
+		return None, 'bad token'
+	if request.get('command') not in COMMANDS:
+		logger.warning('Invalid edge command: %s', request.get('command'))
+		return None, 'unknown command'
+	bbox = request.get('bbox')
+	if request['command'] == COMMAND_INIT and not (isinstance(bbox, list) and len(bbox) == 4 and all(isinstance(v, int) for v in bbox) and bbox[2] > 0 and bbox[3] > 0):
+		logger.warning('Invalid bbox: %s', bbox)
+		return None, 'invalid bbox'
+	return request, None
+
+def clamp_bbox(bbox: tuple, width: int, height: int):
+	# bbox cut down to the frame, None if nothing of it is inside
+	x, y, w, h = bbox
+	x0, y0 = max(0, x), max(0, y)
+	x1, y1 = min(width, x + w), min(height, y + h)
+	if x1 <= x0 or y1 <= y0:
+		return None
+	return (x0, y0, x1 - x0, y1 - y0)
+
+def steering_for(delta_x: int, delta_y: int, width: int, height: int) -> tuple:
+	# Yaw and pitch speed percentages for the target's offset from the centre
+	if abs(delta_x) < DEADZONE_X * width:
+		delta_x = 0
+	if abs(delta_y) < DEADZONE_Y * height:
+		delta_y = 0
+	yaw = round(np.clip(delta_x * YAW_GAIN / (width / 2), -1, 1) * 100)
+	pitch = round(np.clip(-delta_y / (height / 2), -1, 1) * 100)
+	return int(yaw), int(pitch)
@@ -1,11 +1,33 @@
 #!/usr/bin/env python3
+import argparse
+import json
 import logging
+import time
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, fields, replace
+from threading import Event, Lock
+from typing import Optional
 
 import cv2
+import numpy as np
 import zmq
 
+from turret.capture import CapturedFrame, CaptureThread
+from turret.codec import CODECS, encode_frame, quality_is_valid
+from turret.exceptions import VideoCaptureError
+from turret.metrics import STAGE_CAPTURE_TO_SEND, Metrics
+
 ZMQ_INTERFACE = 'tcp://0.0.0.0:42000'
+ZMQ_INTERFACE_STREAM = 'tcp://0.0.0.0:42002'
+# HWMs count whole multipart messages (camera topic, metadata, payload is one),
+# so subscribers hold at most one stale frame
+STREAM_HWM = 1
+DEFAULT_CAMERA = 'main'
+STATS_INTERVAL = 10 # seconds between capture counter reports
+FPS_TOLERANCE = 0.25 # fraction of a variant's period a frame may come early
+FRAME_TIMEOUT = 1.0 # seconds a camera may stall before reads fail
 TOKEN = 'dupa'
 MAGIC_WORD = 'send me a frame, please'
 
@@ -16,58 +38,405 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class Camera():
+	# A capture device published as its own named stream. Keeps what is needed
+	# to report every camera's frame rate and capture to send latency apart.
+	def __init__(self, name: str, cv2_capture: cv2.VideoCapture):
+		self.name = name
+		self.cv2_capture = cv2_capture
+		self.capture = CaptureThread(cv2_capture, f"Capture Thread {name}")
+		self.metrics = Metrics()
+		self._last_report = (time.monotonic(), 0)
+
+	def start(self) -> None:
+		self.capture.start()
+
+	def read(self, wait_for_new: bool=False) -> CapturedFrame:
+		captured = self.capture.read(wait_for_new, FRAME_TIMEOUT)
+		if captured is None:
+			raise self.capture.error or VideoCaptureError(f'Failed to read frame of video from {self.name}')
+		return captured
+
+	def observe(self, metadata: dict) -> None:
+		self.metrics.observe_between(STAGE_CAPTURE_TO_SEND, metadata['timestamp'], metadata['sent'])
+
+	def fps(self) -> float:
+		# Capture rate since the previous call
+		now, captured = time.monotonic(), self.capture.captured
+		last_time, last_captured = self._last_report
+		self._last_report = (now, captured)
+		return (captured - last_captured) / (now - last_time) if now > last_time else 0.0
+
+	def close(self) -> None:
+		self.capture.quit()
+		self.capture.join()
+		if self.capture.error is not None:
+			logger.error('Camera %s: %s', self.name, self.capture.error)
+		print_camera_stats(self)
+		self.cv2_capture.release()
+
+@dataclass(frozen=True)
+class Variant():
+	# How a subscriber wants a camera's frames. Zero sizes keep the captured
+	# size (or its aspect ratio when only one is given), zero fps every frame,
+	# no codec the service default. Subscribers ask for one by subscribing to
+	# camera_topic(camera, variant.spec()).
+	width: int = 0
+	height: int = 0
+	codec: Optional[str] = None
+	quality: Optional[int] = None
+	fps: float = 0
+
+	@classmethod
+	def parse(cls, spec: str) -> 'Variant':
+		# spec is comma separated name=value pairs, e.g. width=320,codec=jpeg,fps=15
+		types = {field.name: field.type for field in fields(cls)}
+		values = {}
+		for pair in filter(None, spec.split(',')):
+			name, _, value = pair.partition('=')
+			if name not in types:
+				raise ValueError(f'Unknown variant field: {name}')
+			values[name] = value if name == 'codec' else (float(value) if name == 'fps' else int(value))
+		variant = cls(**values)
+		if variant.codec is not None and variant.codec not in CODECS:
+			raise ValueError(f'Unsupported codec: {variant.codec}')
+		if not quality_is_valid(variant.codec, variant.quality):
+			raise ValueError(f'Invalid {variant.codec} quality: {variant.quality}')
+		return variant
+
+	def spec(self) -> str:
+		return ','.join(f'{field.name}={getattr(self, field.name)}' for field in fields(self) if getattr(self, field.name) != field.default)
+
+	def output_size(self, shape: tuple) -> tuple:
+		height, width = shape[:2]
+		if self.width and not self.height:
+			return self.width, round(height * self.width / width)
+		if self.height and not self.width:
+			return round(width * self.height / height), self.height
+		return self.width or width, self.height or height
+
+class FanOut():
+	# Captures once, publishes to everyone. The variants to publish are
+	# whatever the XPUB socket reports subscriptions for, and each of them is
+	# resized and encoded at most once per frame, however many subscribers
+	# share it. 0MQ itself copies nothing per subscriber.
+	def __init__(self, codec: str='raw', quality: int=None):
+		self.codec = codec
+		self.quality = quality
+		self.subscriptions = {} # topic -> camera name, variant
+		self._due = {} # camera name, variant -> when the next frame is due
+
+	def subscription(self, message: bytes) -> None:
+		# One message read from the XPUB socket, which passes on the first
+		# subscription to a topic and the last unsubscription from it
+		subscribe, topic = message[0], bytes(message[1:])
+		if not subscribe:
+			camera, variant = self.subscriptions.pop(topic, (None, None))
+			if variant is not None and (camera, variant) not in self.subscriptions.values():
+				self._due.pop((camera, variant), None)
+				logger.info('Stopped publishing %s as %s', camera, variant.spec() or 'captured')
+			return
+		parts = topic.split(b'\0')
+		if len(parts) != 3 or parts[2]:
+			# A whole camera or everything, served by the variants others asked for
+			return
+		try:
+			variant = Variant.parse(parts[1].decode())
+		except ValueError as e:
+			logger.warning('Invalid variant requested: %s', e)
+			return
+		if variant.codec is None:
+			variant = replace(variant, codec=self.codec, quality=self.quality if variant.quality is None else variant.quality)
+			if not quality_is_valid(variant.codec, variant.quality):
+				logger.warning('Invalid %s quality requested: %s', variant.codec, variant.quality)
+				return
+		camera = parts[0].decode()
+		self.subscriptions[topic] = (camera, variant)
+		logger.info('Publishing %s as %s', camera, variant.spec() or 'captured')
+
+	def due(self, camera: str, timestamp: float) -> dict:
+		# Variant -> topics, for every variant of `camera` due a frame captured at `timestamp`
+		variants = defaultdict(list)
+		for topic, (name, variant) in self.subscriptions.items():
+			if name == camera:
+				variants[variant].append(topic)
+		for variant in list(variants):
+			if not variant.fps:
+				continue
+			period = 1 / variant.fps
+			due = self._due.get((camera, variant), timestamp)
+			if timestamp < due - period * FPS_TOLERANCE:
+				del variants[variant]
+				continue
+			# Keep the cadence, unless the camera fell a whole period behind it
+			self._due[(camera, variant)] = due + period if timestamp - due < period else timestamp + period
+		return variants
+
+	def render(self, camera: str, frame: np.ndarray, timestamp: float, sequence: int, variants: dict) -> list:
+		# (topics, metadata, payload) per variant. Variants differing only in
+		# codec share the resized frame.
+		resized = {}
+		messages = []
+		for variant, topics in variants.items():
+			size = variant.output_size(frame.shape)
+			image = resized.get(size)
+			if image is None:
+				image = frame if size == (frame.shape[1], frame.shape[0]) else cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+				resized[size] = image
+			metadata = dict(
+				dtype=str(image.dtype),
+				shape=image.shape,
+				timestamp=timestamp,
+				sequence=sequence,
+				camera=camera,
+				variant=variant.spec()
+			)
+			payload = image
+			if variant.codec != 'raw':
+				metadata['codec'] = variant.codec
+				payload = encode_frame(image, variant.codec, variant.quality)
+			messages.append((topics, metadata, payload))
+		return messages
+
 def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--stream', action='store_true', help='publish frames as soon as they are captured')
+	parser.add_argument('--codec', choices=CODECS, default='raw', help='frame encoding, requests may ask for another one')
+	parser.add_argument('--quality', type=int, default=None, help='JPEG quality or PNG compression level')
+	parser.add_argument('--camera', action='append', type=parse_camera, help=f'NAME=DEVICE to capture from, repeatable (default: {DEFAULT_CAMERA}=0)')
+	args = parser.parse_args()
+	if not quality_is_valid(args.codec, args.quality):
+		parser.error(f'--quality out of range for {args.codec}')
 	try:
-		listen_for_requests()
+		listen_for_requests(args.stream, args.codec, args.quality, dict(args.camera or [(DEFAULT_CAMERA, 0)]))
 	except Exception as e:
 		logger.error(e)
 
-def listen_for_requests():
+def parse_camera(value: str) -> tuple:
+	name, _, device = value.rpartition('=')
+	if not name or not device:
+		raise argparse.ArgumentTypeError(f'Expected NAME=DEVICE, got {value}')
+	return name, int(device) if device.isdigit() else device
+
+def listen_for_requests(stream: bool=False, codec: str='raw', quality: int=None, devices: dict=None):
 	zmq_context = zmq.Context()
-	zmq_socket:zmq.Socket = zmq_context.socket(zmq.REP)
-	zmq_socket.bind(ZMQ_INTERFACE)
-	cv2_capture = cv2.VideoCapture(0)
-	cv2_capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-	cv2_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-	cv2_capture.set(cv2.CAP_PROP_FPS, 60)
-	print_capture_info(cv2_capture)
+	if stream:
+		# XPUB, so subscriptions tell which variants to publish
+		zmq_socket:zmq.Socket = zmq_context.socket(zmq.XPUB)
+		zmq_socket.setsockopt(zmq.SNDHWM, STREAM_HWM)
+		zmq_socket.setsockopt(zmq.LINGER, 0)
+		zmq_socket.bind(ZMQ_INTERFACE_STREAM)
+	else:
+		zmq_socket:zmq.Socket = zmq_context.socket(zmq.REP)
+		zmq_socket.bind(ZMQ_INTERFACE)
+	cameras = open_cameras(devices or {DEFAULT_CAMERA: 0})
 	try:
-		process_requests(zmq_socket, cv2_capture)
+		if stream:
+			stream_frames(zmq_socket, cameras, codec, quality)
+		else:
+			process_requests(zmq_socket, cameras, codec, quality)
 	except:
 		logger.error('Something went wrong when processing requests: %s', traceback.format_exc())
-	cv2_capture.release()
+	for camera in cameras.values():
+		camera.close()
 	zmq_socket.close()
 	zmq_context.destroy()
 
-def print_capture_info(capture: cv2.VideoCapture):
+def open_cameras(devices: dict) -> dict:
+	# Every camera gets its own capture thread, so a slow or stalled device
+	# never holds up the others
+	cameras = {}
+	for name, device_id in devices.items():
+		cameras[name] = Camera(name, open_capture(device_id))
+		cameras[name].start()
+	return cameras
+
+def open_capture(device_id: int=0) -> cv2.VideoCapture:
+	cv2_capture = cv2.VideoCapture(device_id)
+	cv2_capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+	cv2_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+	cv2_capture.set(cv2.CAP_PROP_FPS, 60)
+	cv2_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+	print_capture_info(cv2_capture, device_id)
+	return cv2_capture
+
+def print_capture_info(capture: cv2.VideoCapture, device_id: int=0):
 	fps = capture.get(cv2.CAP_PROP_FPS)
 	width = capture.get(cv2.CAP_PROP_FRAME_WIDTH)
 	height = capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
-	logger.info('Capture device initialized: %dx%d@%dfps', width, height, fps)
+	logger.info('Capture device %s initialized: %dx%d@%dfps', device_id, width, height, fps)
 
-def process_requests(zmq_socket: zmq.Socket, cv2_capture: cv2.VideoCapture):
+def print_camera_stats(camera: Camera):
+	latency = camera.metrics.percentiles(50).get(STAGE_CAPTURE_TO_SEND, float('nan'))
+	latency_p95 = camera.metrics.percentiles(95).get(STAGE_CAPTURE_TO_SEND, float('nan'))
+	logger.info(
+		'Camera %s: %.1ffps, capture to send p50 %.1fms p95 %.1fms, frames captured: %d, dropped: %d, duplicated: %d',
+		camera.name, camera.fps(), latency * 1000, latency_p95 * 1000, camera.capture.captured, camera.capture.dropped, camera.capture.duplicates
+	)
+
+def process_requests(zmq_socket: zmq.Socket, cameras: dict, codec: str='raw', quality: int=None):
+	last_stats = time.monotonic()
 	while True:
-		request = zmq_socket.recv_json()
-		if not request_is_valid(request):
+		# REP must answer every request before it can receive the next one
+		try:
+			request = json.loads(zmq_socket.recv())
+		except ValueError:
+			zmq_socket.send_multipart(error_reply('invalid json'))
+			continue
+		if not isinstance(request, dict) or not request_is_valid(request):
+			zmq_socket.send_multipart(error_reply('bad request'))
 			continue
-		ret, frame = cv2_capture.read()
-		if not ret:
-			raise Exception('Failed to read frame of video')
-		metadata = dict(
-			dtype=str(frame.dtype),
-			shape=frame.shape
-		)
-		zmq_socket.send_json(metadata, flags=zmq.SNDMORE)
-		zmq_socket.send(frame, flags=0, copy=True, track=False)
+		camera = select_camera(request, cameras)
+		try:
+			metadata, frame = read_frame_message(camera, *negotiate_codec(request, codec, quality), False, *negotiate_region(request))
+		except VideoCaptureError as e:
+			# A stalled camera must not take the others down with it
+			logger.warning('Camera %s: %s', camera.name, e)
+			zmq_socket.send_multipart(error_reply(str(e)))
+			continue
+		send_frame(zmq_socket, metadata, frame)
+		camera.observe(metadata)
+		if time.monotonic() - last_stats > STATS_INTERVAL:
+			for camera in cameras.values():
+				print_camera_stats(camera)
+			last_stats = time.monotonic()
+
+def stream_frames(zmq_socket: zmq.Socket, cameras: dict, codec: str='raw', quality: int=None):
+	# One publisher thread per camera, each woken by its own capture thread.
+	# They share the XPUB socket, which is not thread safe, and the fan-out
+	# state, so both are only touched under a lock. Resizing and encoding
+	# happen outside of it. Runs until every camera stopped.
+	lock = Lock()
+	stop = Event()
+	fan_out = FanOut(codec, quality)
+	with ThreadPoolExecutor(len(cameras), thread_name_prefix='Publisher') as executor:
+		publishers = [executor.submit(publish_frames, zmq_socket, lock, stop, camera, fan_out) for camera in cameras.values()]
+		try:
+			while not all(publisher.done() for publisher in publishers):
+				wait(publishers, STATS_INTERVAL)
+				for camera in cameras.values():
+					print_camera_stats(camera)
+		finally:
+			stop.set()
+	for publisher in publishers:
+		publisher.result()
+	raise VideoCaptureError('Every camera stopped')
+
+def publish_frames(zmq_socket: zmq.Socket, lock: Lock, stop: Event, camera: Camera, fan_out: FanOut):
+	# XPUB never blocks: when a subscriber is still busy with the previous
+	# frame the new one is dropped for that subscriber only. A failing camera
+	# only ends its own publisher.
+	while not stop.is_set() and camera.capture.is_alive():
+		try:
+			captured = camera.read(wait_for_new=True)
+			with lock:
+				while zmq_socket.poll(0, zmq.POLLIN):
+					fan_out.subscription(zmq_socket.recv())
+				variants = fan_out.due(camera.name, captured.timestamp)
+			if not variants:
+				continue
+			messages = fan_out.render(camera.name, captured.frame, captured.timestamp, captured.sequence, variants)
+			with lock:
+				for topics, metadata, payload in messages:
+					for topic in topics:
+						send_frame(zmq_socket, metadata, payload, topic)
+			camera.observe(metadata)
+		except VideoCaptureError as e:
+			logger.warning('Camera %s: %s', camera.name, e)
+		except zmq.ContextTerminated:
+			raise
+		except Exception:
+			logger.error('Something went wrong when publishing %s: %s', camera.name, traceback.format_exc())
+	if not stop.is_set():
+		logger.error('Camera %s stopped, no longer publishing it', camera.name)
+
+def camera_topic(name: str, variant: str='') -> bytes:
+	# Both parts are terminated, so subscribing to 'wide' does not also match
+	# 'wide2', nor the captured size the downscaled variants
+	return name.encode() + b'\0' + variant.encode() + b'\0'
+
+def select_camera(request: dict, cameras: dict) -> Camera:
+	# The first camera unless the request names another one
+	name = request.get('camera')
+	if name is not None and name not in cameras:
+		logger.warning('Unknown camera requested: %s', name)
+	return cameras.get(name, next(iter(cameras.values())))
+
+def read_frame_message(camera: Camera, codec: str='raw', quality: int=None, wait_for_new: bool=False, roi: tuple=None, size: tuple=None):
+	captured = camera.read(wait_for_new)
+	frame = captured.frame
+	metadata = dict(
+		timestamp=captured.timestamp,
+		sequence=captured.sequence,
+		camera=camera.name
+	)
+	if roi is not None or size is not None:
+		# Tells the client where the pixels it got sit in the whole frame
+		metadata['source_shape'] = frame.shape
+		frame, metadata['roi'] = crop_frame(frame, roi, size)
+	metadata.update(dtype=str(frame.dtype), shape=frame.shape)
+	if codec != 'raw':
+		metadata['codec'] = codec
+		frame = encode_frame(frame, codec, quality)
+	return metadata, frame
+
+def crop_frame(frame: np.ndarray, roi: tuple=None, size: tuple=None) -> tuple:
+	# Cuts roi (x, y, w, h, clamped to the frame) out and scales it to size
+	# (w, h). The crop is made contiguous, 0MQ sends buffers as they are.
+	height, width = frame.shape[:2]
+	x, y, w, h = roi if roi is not None else (0, 0, width, height)
+	x, y = min(max(0, x), width - 1), min(max(0, y), height - 1)
+	w, h = max(1, min(w, width - x)), max(1, min(h, height - y))
+	view = frame[y:y + h, x:x + w]
+	if size is not None and tuple(size) != (w, h):
+		return cv2.resize(view, tuple(size), interpolation=cv2.INTER_AREA), (x, y, w, h)
+	return np.ascontiguousarray(view), (x, y, w, h)
+
+def send_frame(zmq_socket: zmq.Socket, metadata: dict, frame, topic: bytes=None):
+	# Capture to sent covers waiting for the frame and encoding it
+	metadata['sent'] = time.time()
+	if topic is not None:
+		zmq_socket.send(topic, flags=zmq.SNDMORE)
+	zmq_socket.send_json(metadata, flags=zmq.SNDMORE)
+	zmq_socket.send(frame, flags=0, copy=True, track=False)
+
+def error_reply(error: str) -> list:
+	# Same two parts as a frame, the client finds the error in the metadata
+	return [json.dumps(dict(error=error)).encode(), b'']
+
+def negotiate_codec(request: dict, codec: str, quality: int):
+	requested = request.get('codec')
+	if requested is None:
+		return codec, quality
+	if requested not in CODECS:
+		logger.warning('Unsupported codec requested: %s', requested)
+		return codec, quality
+	if not quality_is_valid(requested, request.get('quality')):
+		# The codec is fine, only its default quality is used
+		logger.warning('Invalid %s quality requested: %s', requested, request.get('quality'))
+		return requested, None
+	return requested, request.get('quality')
+
+def negotiate_region(request: dict) -> tuple:
+	# roi and size asked for, see crop_frame. Malformed ones are ignored and
+	# the whole frame is sent, like an unsupported codec falls back.
+	roi, size = request.get('roi'), request.get('size')
+	if roi is not None and not (isinstance(roi, list) and len(roi) == 4 and all(isinstance(v, int) for v in roi) and roi[2] > 0 and roi[3] > 0):
+		logger.warning('Invalid roi requested: %s', roi)
+		roi = None
+	if size is not None and not (isinstance(size, list) and len(size) == 2 and all(isinstance(v, int) and v > 0 for v in size)):
+		logger.warning('Invalid size requested: %s', size)
+		size = None
+	return roi, size
 
 def request_is_valid(request: dict):
 	token = request.get('token')
 	if token != TOKEN:
-		logger.warning('Invalid token: ', token)
+		logger.warning('Invalid token: %s', token)
 		return False
 	request_string = request.get('request_string')
 	if request_string != MAGIC_WORD:
-		logger.warning('Invalid request: ', request_string)
+		logger.warning('Invalid request: %s', request_string)
 		return False
 	return True
 
@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
+import argparse
+import json
 import logging
+import time
 import traceback
+from contextlib import nullcontext
 
 import gpiozero
 import zmq
 
+from turret.metrics import (STAGE_CAPTURE_TO_APPLIED, STAGE_COMMAND_TO_APPLIED,
+                            Metrics, MetricsServer)
+from turret.motion import PULSE_WIDTH, MotionPlanner, StepGenerator
+from turret.protocol import (STATUS_BAD_TOKEN, STATUS_INVALID, STATUS_OK,
+                             STATUS_SUPERSEDED, TOKEN, ProtocolError,
+                             SteeringCommand, pack_ack, sequence_gap)
+
 ZMQ_INTERFACE = 'tcp://0.0.0.0:42001'
-TOKEN = 'dupa'
+MAX_BATCH = 64 # commands coalesced at most, so replies are never held up for long
+LEGACY_VERSION = 0 # JSON requests, answered with text
+STEERING_TIMEOUT = 2.0 # seconds without a command before the motors sleep, a few PC heartbeats
 
 logging.basicConfig(
 	format='[%(asctime)s] %(levelname)s-> %(message)s',
@@ -27,10 +40,18 @@ def create_mapping_function(input_min: int, input_max: int, output_min: int, out
 
 	return mapper
 
-percent_to_on_time = create_mapping_function(0, 100, -0.1, -0.02)
+# Slow end as before for fine aiming. Jumping straight to the top rate used to
+# stall the motors, ramped it can go up to 500 steps/s like stepper.py.
+percent_to_on_time = create_mapping_function(0, 100, -0.1, -0.0018)
+ACCELERATION = 1000 # steps/s²
+
+def speed_to_rate(speed):
+	if speed <= 1:
+		return 0.0
+	return 1 / (abs(percent_to_on_time(speed)) + PULSE_WIDTH)
 
 class StepperMotor():
-	def __init__(self, reset_pin, sleep_pin, step_pin, dir_pin):
+	def __init__(self, reset_pin, sleep_pin, step_pin, dir_pin, planner: MotionPlanner=None):
 		self._reset = gpiozero.DigitalOutputDevice(reset_pin)
 		self._reset.on()
 		self._sleep = gpiozero.DigitalOutputDevice(sleep_pin)
@@ -39,9 +60,16 @@ class StepperMotor():
 		self._step.on()
 		self._dir = gpiozero.DigitalOutputDevice(dir_pin)
 		self._dir.on()
-		self._speed = 0
+		# Speed changes ramp through step interval tables, all computed here so
+		# no command waits for one
+		planner = planner or MotionPlanner(speed_to_rate, ACCELERATION)
+		planner.precompute()
+		self._generator = StepGenerator(self._step, self._dir, planner)
+		self._generator.dir = self._dir.value
+		self._generator.start()
 
 	def sleep(self):
+		self._generator.stop()
 		self._sleep.off()
 		self._reset.off()
 
@@ -51,91 +79,220 @@ class StepperMotor():
 
 	def steps(self, dir, count):
 		self.wake()
-		self._dir.value = dir
-		self._step.blink(0.005, 0.005, count)
+		self._generator.move(dir, count)
 
 	def speed(self, dir, speed):
-		if speed == self._speed:
-			return
 		if not 0 <= speed <= 100:
 			logger.warning('Invalid speed value: %d', speed)
 			return
 		self.wake()
-		if 0 <= speed <= 1:
-			#avoid floating
-			self._dir.value = 0
-			self._step.value = 0
-			return
-		on_time = abs(percent_to_on_time(speed))
-		logger.info('ON TIME: %s', on_time)
-		self._dir.value = dir
-		self._step.blink(on_time, 0.0002)
-		self._speed = speed
+		# 0 and 1 ramp down to a stop, the generator leaves the pins driven
+		self._generator.set(dir, speed if speed > 1 else 0)
+
+	def close(self):
+		self._generator.quit()
+		self._generator.join()
+		for device in (self._reset, self._sleep, self._step, self._dir):
+			device.close()
 
 def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--metrics-port', type=int, default=None, help='serve command latency histograms on this port')
+	parser.add_argument('--metrics-host', default='127.0.0.1')
+	args = parser.parse_args()
+	metrics = None
+	if args.metrics_port:
+		metrics = Metrics()
+		MetricsServer(metrics, args.metrics_port, args.metrics_host).start()
 	try:
-		#horizontal
-		motor_yaw = StepperMotor(12, 16, 20, 21)
-		motor_yaw.sleep()
-		#vertical
-		motor_pitch = StepperMotor(5, 6, 13, 19)
-		motor_pitch.sleep()
-		listen_for_requests(motor_yaw, motor_pitch)
+		motor_yaw, motor_pitch = create_motors()
+		listen_for_requests(motor_yaw, motor_pitch, metrics)
 	except:
 		logger.error(traceback.format_exc())
 	finally:
 		motor_yaw.sleep()
 		motor_pitch.sleep()
 
-def listen_for_requests(motor_yaw: StepperMotor, motor_pitch: StepperMotor):
+def create_motors():
+	#horizontal
+	motor_yaw = StepperMotor(12, 16, 20, 21)
+	motor_yaw.sleep()
+	#vertical
+	motor_pitch = StepperMotor(5, 6, 13, 19)
+	motor_pitch.sleep()
+	return motor_yaw, motor_pitch
+
+def listen_for_requests(motor_yaw: StepperMotor, motor_pitch: StepperMotor, metrics: Metrics=None):
 	zmq_context = zmq.Context()
-	zmq_socket:zmq.Socket = zmq_context.socket(zmq.REP)
+	# ROUTER instead of REP, so queued commands can be drained and coalesced.
+	# Existing REQ clients talk to it unchanged.
+	zmq_socket:zmq.Socket = zmq_context.socket(zmq.ROUTER)
 	zmq_socket.bind(ZMQ_INTERFACE)
 	try:
-		process_requests(zmq_socket, motor_yaw, motor_pitch)
+		process_requests(zmq_socket, motor_yaw, motor_pitch, metrics)
 	except:
 		logger.error('Something went wrong when processing requests: %s', traceback.format_exc())
 	zmq_socket.close()
 	zmq_context.destroy()
 
-def process_requests(zmq_socket: zmq.Socket, motor_yaw: StepperMotor, motor_pitch: StepperMotor):
+def process_requests(zmq_socket: zmq.Socket, motor_yaw: StepperMotor, motor_pitch: StepperMotor, metrics: Metrics=None):
+	last_sequence = {}
+	silent = True # the motors start asleep
 	while True:
-		request = zmq_socket.recv_json()
-		logger.debug(request)
-		if not request_is_valid(request):
-			zmq_socket.send_string('BAD TOKEN')
+		if not zmq_socket.poll(STEERING_TIMEOUT * 1000, zmq.POLLIN):
+			# Dead man's switch, a PC that died mid-slew must not leave the motors running
+			if not silent:
+				logger.warning('No steering command for %.1fs, putting the motors to sleep', STEERING_TIMEOUT)
+				motor_yaw.sleep()
+				motor_pitch.sleep()
+				silent = True
 			continue
-		yaw = request.get('yaw')
-		pitch = request.get('pitch')
-		sleep = request.get('sleep')
-		if sleep:
-			motor_yaw.sleep()
-			motor_pitch.sleep()
-			zmq_socket.send_string('OK')
-			continue
-		if yaw is not None:
-			update_motor(motor_yaw, yaw)
-		if pitch is not None:
-			update_motor(motor_pitch, pitch)
-		zmq_socket.send_string('OK')
-
-def request_is_valid(request: dict):
-	token = request.get('token')
-	if token != TOKEN:
-		logger.warning('Invalid token: ', token)
+		silent = False
+		batch = [zmq_socket.recv_multipart()]
+		# Whatever queued up meanwhile is stale but for its newest values
+		while len(batch) < MAX_BATCH and zmq_socket.poll(0, zmq.POLLIN):
+			batch.append(zmq_socket.recv_multipart())
+		replies, sequences = handle_requests([frames[-1] for frames in batch], motor_yaw, motor_pitch, metrics)
+		for frames, reply, sequence in zip(batch, replies, sequences):
+			if sequence is not None:
+				client = frames[0]
+				if gap := sequence_gap(sequence, last_sequence.get(client)):
+					logger.debug('Sequence jumped by %d commands', gap)
+				last_sequence[client] = sequence
+			zmq_socket.send_multipart([*frames[:-1], reply])
+
+def handle_requests(messages: list, motor_yaw: StepperMotor, motor_pitch: StepperMotor, metrics: Metrics=None, override=None):
+	# Applies a batch of requests as the few commands coalesce_commands merges
+	# them into. Returns a reply and the sequence number (None when malformed)
+	# for every message, in order. override, EdgeTracker.override when the Pi
+	# tracks, wraps applying the batch.
+	parsed = [parse_request(message) for message in messages]
+	commands = [command for command, reply in parsed if reply is None]
+	superseded = set()
+	if commands:
+		merged, superseded = coalesce_commands(commands)
+		with override(commands[-1]) if override is not None else nullcontext():
+			for command in merged:
+				logger.debug(command)
+				apply_command(command, motor_yaw, motor_pitch)
+	applied = time.time()
+	if commands and metrics is not None:
+		# The frame was captured on this clock, so this one is skew free
+		metrics.observe_between(STAGE_CAPTURE_TO_APPLIED, commands[-1].captured, applied)
+		metrics.observe_between(STAGE_COMMAND_TO_APPLIED, commands[-1].sent, applied)
+	replies = []
+	sequences = []
+	index = 0
+	for command, reply in parsed:
+		sequence = None
+		if reply is None:
+			if command.version == LEGACY_VERSION:
+				reply = b'OK'
+			else:
+				status = STATUS_SUPERSEDED if index in superseded else STATUS_OK
+				reply = pack_ack(command.sequence, status, applied, command.version)
+				sequence = command.sequence
+			index += 1
+		replies.append(reply)
+		sequences.append(sequence)
+	return replies, sequences
+
+def parse_request(message: bytes):
+	# Returns the command and, when it must not be applied, the reply for it
+	if message.startswith(b'{'):
+		try:
+			request = json.loads(message)
+		except ValueError:
+			logger.warning('Invalid request: %s', message)
+			return None, b'BAD REQUEST'
+		return parse_legacy_request(request)
+	try:
+		command = SteeringCommand.unpack(message)
+	except ProtocolError as e:
+		logger.warning('Invalid command: %s', e)
+		return None, pack_ack(0, STATUS_INVALID)
+	if not command_is_valid(command):
+		return command, pack_ack(command.sequence, STATUS_BAD_TOKEN, version=command.version)
+	return command, None
+
+def parse_legacy_request(request: dict):
+	# JSON payloads from senders that predate the binary protocol
+	logger.debug(request)
+	if request.get('token') != TOKEN.decode():
+		logger.warning('Invalid token: %s', request.get('token'))
+		return None, b'BAD TOKEN'
+	yaw = request.get('yaw')
+	pitch = request.get('pitch')
+	try:
+		command = SteeringCommand(
+			yaw=None if yaw is None else int(yaw),
+			pitch=None if pitch is None else int(pitch),
+			yaw_steps=isinstance(yaw, str),
+			pitch_steps=isinstance(pitch, str),
+			sleep=bool(request.get('sleep')),
+			version=LEGACY_VERSION
+		)
+	except (ValueError, TypeError, OverflowError):
+		# Infinity is valid JSON too, int() overflows on it
+		logger.warning('Invalid command: %s', request)
+		return None, b'BAD REQUEST'
+	return command, None
+
+def coalesce_commands(commands: list):
+	# Merges a batch in arrival order. A sleep stops whatever came before it,
+	# so only the commands after the last sleep are merged, and applied once
+	# the motors are asleep. Per axis the newest speed wins, step counts are
+	# relative moves and add up until a speed replaces them. Returns the
+	# commands to apply, in order, and the indices of commands none of whose
+	# values made it.
+	sleeps = [index for index, command in enumerate(commands) if command.sleep]
+	merged = SteeringCommand()
+	yaw_sources, pitch_sources = set(), set()
+	for index in range(sleeps[-1] + 1 if sleeps else 0, len(commands)):
+		command = commands[index]
+		if command.yaw is not None:
+			if command.yaw_steps and merged.yaw_steps and merged.yaw is not None:
+				merged.yaw += command.yaw
+				yaw_sources.add(index)
+			else:
+				merged.yaw, merged.yaw_steps = command.yaw, command.yaw_steps
+				yaw_sources = {index}
+		if command.pitch is not None:
+			if command.pitch_steps and merged.pitch_steps and merged.pitch is not None:
+				merged.pitch += command.pitch
+				pitch_sources.add(index)
+			else:
+				merged.pitch, merged.pitch_steps = command.pitch, command.pitch_steps
+				pitch_sources = {index}
+	newest = commands[-1]
+	merged.sequence, merged.captured, merged.sent = newest.sequence, newest.captured, newest.sent
+	applied = [commands[sleeps[-1]]] if sleeps else []
+	if merged.yaw is not None or merged.pitch is not None:
+		applied.append(merged)
+	used = set(sleeps) | yaw_sources | pitch_sources | {len(commands) - 1}
+	return applied, set(range(len(commands))) - used
+
+def command_is_valid(command: SteeringCommand):
+	if command.token != TOKEN:
+		logger.warning('Invalid token: %s', command.token)
 		return False
 	return True
 
-def update_motor(motor: StepperMotor, command):
-	if isinstance(command, int):
-		motor.speed(0 if command >= 0 else 1, abs(command))
+def apply_command(command: SteeringCommand, motor_yaw: StepperMotor, motor_pitch: StepperMotor):
+	if command.sleep:
+		motor_yaw.sleep()
+		motor_pitch.sleep()
 		return
-	try:
-		steps = int(command)
-		motor.steps(0 if steps >= 0 else 1, abs(steps))
-	except ValueError:
-		logger.warning('Invalid command: %s', command)
+	if command.yaw is not None:
+		update_motor(motor_yaw, command.yaw, command.yaw_steps)
+	if command.pitch is not None:
+		update_motor(motor_pitch, command.pitch, command.pitch_steps)
+
+def update_motor(motor: StepperMotor, value: int, steps: bool=False):
+	if steps:
+		motor.steps(0 if value >= 0 else 1, abs(value))
 		return
+	motor.speed(0 if value >= 0 else 1, abs(value))
 
 if __name__ == '__main__':
 	main()
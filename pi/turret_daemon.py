@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# Single process replacement for frame_service.py, pin_service.py and the TCP
+# loop in src/turret/stepper.py. Every endpoint runs on one asyncio loop and
+# accepts any number of clients, blocking work (capture waits, encoding) is
+# pushed to worker threads so steering is never queued behind a frame.
+import argparse
+import asyncio
+import json
+import logging
+import time
+import traceback
+from contextlib import nullcontext
+from functools import partial
+
+import zmq
+import zmq.asyncio
+
+from edge_tracking import EdgeTracker, parse_edge_request
+from edge_tracking import ZMQ_INTERFACE_CONTROL as ZMQ_INTERFACE_EDGE_CONTROL
+from frame_service import (DEFAULT_CAMERA, STATS_INTERVAL, STREAM_HWM,
+                           Camera, FanOut, error_reply, negotiate_codec,
+                           negotiate_region, open_cameras, parse_camera,
+                           print_camera_stats, read_frame_message,
+                           request_is_valid, select_camera)
+from frame_service import ZMQ_INTERFACE as ZMQ_INTERFACE_FRAMES
+from frame_service import ZMQ_INTERFACE_STREAM
+from pin_service import ZMQ_INTERFACE as ZMQ_INTERFACE_STEERING
+from pin_service import (MAX_BATCH, STEERING_TIMEOUT, StepperMotor,
+                         apply_command, command_is_valid, create_motors,
+                         handle_requests)
+from turret.codec import CODECS, quality_is_valid
+from turret.exceptions import VideoCaptureError
+from turret.metrics import Metrics, MetricsServer
+from turret.protocol import (COMMAND_PREFIX_SIZE, ProtocolError,
+                             SteeringCommand, command_size, sequence_gap)
+from turret.tracking import (DEFAULT_TRACKER, DEFAULT_TRACKING_SCALE, TRACKERS,
+                             parse_tracking_scale)
+
+# 42000 is taken by the frame endpoint, which stepper.py used to share
+TCP_STEPPER_HOST = '0.0.0.0'
+TCP_STEPPER_PORT = 42003
+
+logging.basicConfig(
+	format='[%(asctime)s] %(levelname)s-> %(message)s',
+	datefmt='%T',
+	level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--stream', action='store_true', help='also publish frames as soon as they are captured')
+	parser.add_argument('--codec', choices=CODECS, default='raw', help='frame encoding, requests may ask for another one')
+	parser.add_argument('--quality', type=int, default=None, help='JPEG quality or PNG compression level')
+	parser.add_argument('--camera', action='append', type=parse_camera, help=f'NAME=DEVICE to capture from, repeatable (default: {DEFAULT_CAMERA}=0)')
+	parser.add_argument('--edge', action='store_true', help='also track here and steer from the results, the PC only picks and drops targets')
+	parser.add_argument('--edge-tracker', choices=TRACKERS, default=DEFAULT_TRACKER, help='tracker backend for --edge')
+	parser.add_argument('--edge-tracking-scale', type=parse_tracking_scale, default=DEFAULT_TRACKING_SCALE, help='scale of the captured frame the --edge tracker runs on')
+	parser.add_argument('--edge-tracking-roi', type=float, default=None, help='only track inside a window padded by this many target sizes around the target')
+	parser.add_argument('--edge-keyframes', action='store_true', help='run the --edge tracker only every few frames and follow the target with optical flow in between')
+	parser.add_argument('--metrics-port', type=int, default=None, help='serve command latency histograms on this port')
+	parser.add_argument('--metrics-host', default='127.0.0.1')
+	args = parser.parse_args()
+	if not quality_is_valid(args.codec, args.quality):
+		parser.error(f'--quality out of range for {args.codec}')
+	metrics = None
+	if args.metrics_port:
+		metrics = Metrics()
+		MetricsServer(metrics, args.metrics_port, args.metrics_host).start()
+	edge = None
+	if args.edge:
+		edge = dict(backend=args.edge_tracker, scale=args.edge_tracking_scale, roi_margin=args.edge_tracking_roi, keyframes=args.edge_keyframes)
+	try:
+		asyncio.run(run(args.stream, args.codec, args.quality, metrics, dict(args.camera or [(DEFAULT_CAMERA, 0)]), edge))
+	except KeyboardInterrupt:
+		pass
+	except:
+		logger.error(traceback.format_exc())
+
+async def run(stream: bool, codec: str, quality: int, metrics: Metrics=None, devices: dict=None, edge: dict=None):
+	# edge holds the EdgeTracker options, None leaves tracking to the PC
+	motor_yaw, motor_pitch = create_motors()
+	cameras = open_cameras(devices or {DEFAULT_CAMERA: 0})
+	zmq_context = zmq.asyncio.Context()
+	# ROUTER instead of REP, so a slow client does not hold up the others.
+	# Existing REQ clients talk to it unchanged.
+	frame_socket = zmq_context.socket(zmq.ROUTER)
+	frame_socket.bind(ZMQ_INTERFACE_FRAMES)
+	steering_socket = zmq_context.socket(zmq.ROUTER)
+	steering_socket.bind(ZMQ_INTERFACE_STEERING)
+	edge_tracker = edge_socket = None
+	if edge is not None:
+		edge_tracker = EdgeTracker(cameras, (motor_yaw, motor_pitch), metrics=metrics, **edge)
+		edge_tracker.start()
+		edge_socket = zmq_context.socket(zmq.ROUTER)
+		edge_socket.bind(ZMQ_INTERFACE_EDGE_CONTROL)
+	# Stick steering pauses the Pi's own
+	override = edge_tracker.override if edge_tracker is not None else None
+	stepper_server = await asyncio.start_server(
+		partial(serve_stepper_client, motors=(motor_yaw, motor_pitch), override=override),
+		TCP_STEPPER_HOST,
+		TCP_STEPPER_PORT
+	)
+	tasks = [
+		serve_frames(frame_socket, cameras, codec, quality),
+		serve_steering(steering_socket, motor_yaw, motor_pitch, metrics, override),
+		stepper_server.serve_forever(),
+		report_camera_stats(cameras),
+	]
+	if edge_tracker is not None:
+		tasks.append(serve_edge_control(edge_socket, edge_tracker))
+	stream_socket = None
+	if stream:
+		# XPUB, so subscriptions tell which variants to publish
+		stream_socket = zmq_context.socket(zmq.XPUB)
+		stream_socket.setsockopt(zmq.SNDHWM, STREAM_HWM)
+		stream_socket.setsockopt(zmq.LINGER, 0)
+		stream_socket.bind(ZMQ_INTERFACE_STREAM)
+		fan_out = FanOut(codec, quality)
+		tasks.append(track_subscriptions(stream_socket, fan_out))
+		tasks.extend(stream_frames(stream_socket, camera, fan_out) for camera in cameras.values())
+	logger.info('Turret daemon running')
+	try:
+		await asyncio.gather(*tasks)
+	finally:
+		if edge_tracker is not None:
+			edge_tracker.quit()
+			edge_tracker.join()
+		motor_yaw.sleep()
+		motor_pitch.sleep()
+		stepper_server.close()
+		for camera in cameras.values():
+			camera.close()
+		for zmq_socket in (frame_socket, steering_socket, stream_socket, edge_socket):
+			if zmq_socket is not None:
+				zmq_socket.close()
+		zmq_context.destroy()
+
+async def serve_frames(zmq_socket: zmq.asyncio.Socket, cameras: dict, codec: str, quality: int):
+	pending = set()
+	while True:
+		*envelope, message = await zmq_socket.recv_multipart()
+		task = asyncio.create_task(reply_with_frame(zmq_socket, envelope, message, cameras, codec, quality))
+		pending.add(task)
+		task.add_done_callback(pending.discard)
+
+async def reply_with_frame(zmq_socket: zmq.asyncio.Socket, envelope: list, message: bytes, cameras: dict, codec: str, quality: int):
+	# Every request is answered, a REQ client would wait forever otherwise
+	try:
+		request = json.loads(message)
+	except ValueError:
+		await zmq_socket.send_multipart([*envelope, *error_reply('invalid json')])
+		return
+	if not isinstance(request, dict) or not request_is_valid(request):
+		await zmq_socket.send_multipart([*envelope, *error_reply('bad request')])
+		return
+	camera = select_camera(request, cameras)
+	try:
+		loop = asyncio.get_running_loop()
+		metadata, frame = await loop.run_in_executor(None, read_frame_message, camera, *negotiate_codec(request, codec, quality), False, *negotiate_region(request))
+	except VideoCaptureError as e:
+		logger.warning('Camera %s: %s', camera.name, e)
+		await zmq_socket.send_multipart([*envelope, *error_reply(str(e))])
+		return
+	except Exception:
+		logger.error('Something went wrong when serving a frame: %s', traceback.format_exc())
+		await zmq_socket.send_multipart([*envelope, *error_reply('internal error')])
+		return
+	metadata['sent'] = time.time()
+	await zmq_socket.send_multipart([*envelope, json.dumps(metadata).encode(), frame], copy=False)
+	camera.observe(metadata)
+
+async def track_subscriptions(zmq_socket: zmq.asyncio.Socket, fan_out: FanOut):
+	while True:
+		fan_out.subscription(await zmq_socket.recv())
+
+async def stream_frames(zmq_socket: zmq.asyncio.Socket, camera: Camera, fan_out: FanOut):
+	# Same fan-out as frame_service.publish_frames, subscriptions are tracked
+	# on the loop and only resizing and encoding go to a worker thread. A
+	# failing camera only ends its own stream, steering and the other
+	# endpoints keep running.
+	loop = asyncio.get_running_loop()
+	while camera.capture.is_alive():
+		try:
+			captured = await loop.run_in_executor(None, partial(camera.read, wait_for_new=True))
+			variants = fan_out.due(camera.name, captured.timestamp)
+			if not variants:
+				continue
+			messages = await loop.run_in_executor(None, fan_out.render, camera.name, captured.frame, captured.timestamp, captured.sequence, variants)
+			for topics, metadata, payload in messages:
+				metadata['sent'] = time.time()
+				message = json.dumps(metadata).encode()
+				for topic in topics:
+					await zmq_socket.send_multipart([topic, message, payload], copy=False)
+			camera.observe(metadata)
+		except VideoCaptureError as e:
+			logger.warning('Camera %s: %s', camera.name, e)
+		except Exception:
+			logger.error('Something went wrong when streaming %s: %s', camera.name, traceback.format_exc())
+	logger.error('Camera %s stopped, no longer streaming it', camera.name)
+
+async def report_camera_stats(cameras: dict):
+	while True:
+		await asyncio.sleep(STATS_INTERVAL)
+		for camera in cameras.values():
+			print_camera_stats(camera)
+
+async def serve_steering(zmq_socket: zmq.asyncio.Socket, motor_yaw: StepperMotor, motor_pitch: StepperMotor, metrics: Metrics=None, override=None):
+	last_sequence = {}
+	silent = True
+	while True:
+		if not await zmq_socket.poll(STEERING_TIMEOUT * 1000, zmq.POLLIN):
+			# Same dead man's switch as pin_service.process_requests
+			if not silent:
+				logger.warning('No steering command for %.1fs, putting the motors to sleep', STEERING_TIMEOUT)
+				motor_yaw.sleep()
+				motor_pitch.sleep()
+				silent = True
+			continue
+		silent = False
+		batch = [await zmq_socket.recv_multipart()]
+		# Same coalescing as pin_service.process_requests
+		while len(batch) < MAX_BATCH and await zmq_socket.poll(0, zmq.POLLIN):
+			batch.append(await zmq_socket.recv_multipart())
+		replies, sequences = handle_requests([frames[-1] for frames in batch], motor_yaw, motor_pitch, metrics, override)
+		for frames, reply, sequence in zip(batch, replies, sequences):
+			if sequence is not None:
+				client = frames[0]
+				if gap := sequence_gap(sequence, last_sequence.get(client)):
+					logger.debug('Sequence jumped by %d commands', gap)
+				last_sequence[client] = sequence
+			await zmq_socket.send_multipart([*frames[:-1], reply])
+
+async def serve_edge_control(zmq_socket: zmq.asyncio.Socket, edge_tracker: EdgeTracker):
+	# Commands are only queued here, the tracking thread picks them up
+	while True:
+		*envelope, message = await zmq_socket.recv_multipart()
+		request, error = parse_edge_request(message)
+		if request is not None:
+			edge_tracker.command(request)
+		await zmq_socket.send_multipart([*envelope, json.dumps(dict(status=error or 'ok')).encode()])
+
+async def serve_stepper_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, motors: tuple, override=None):
+	peer = writer.get_extra_info('peername')
+	logger.info('Stepper client connected: %s', peer)
+	try:
+		while True:
+			prefix = await reader.readexactly(COMMAND_PREFIX_SIZE)
+			rest = await reader.readexactly(command_size(prefix[4]) - COMMAND_PREFIX_SIZE)
+			command = SteeringCommand.unpack(prefix + rest)
+			if command_is_valid(command):
+				with override(command) if override is not None else nullcontext():
+					apply_command(command, *motors)
+	except asyncio.IncompleteReadError:
+		pass
+	except ProtocolError as e:
+		# Framing is lost, the peer has to reconnect
+		logger.warning('Invalid command from %s: %s', peer, e)
+	finally:
+		logger.info('Stepper client disconnected: %s', peer)
+		writer.close()
+		await writer.wait_closed()
+		# Same dead man's switch as stepper.py
+		for motor in motors:
+			motor.sleep()
+
+if __name__ == '__main__':
+	main()
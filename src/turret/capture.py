@@ -0,0 +1,144 @@
+import logging
+import time
+from dataclasses import dataclass
+from threading import Condition, Thread
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from turret.exceptions import VideoCaptureError
+
+logger = logging.getLogger()
+
+
+@dataclass()
+class CapturedFrame():
+	frame: np.ndarray
+	timestamp: float # time.time() right after the driver handed the frame over
+	sequence: int
+
+
+# Drains the device as fast as it delivers and keeps only the newest frame, so
+# readers never wait on exposure or the driver queue. Frames overwritten before
+# anyone read them count as dropped, frames handed out twice as duplicates.
+# Once capturing stopped reads return None, never the last frame again.
+class CaptureThread(Thread):
+	def __init__(self, capture: cv2.VideoCapture, name: str="Capture Thread") -> None:
+		super().__init__(name=name, daemon=True)
+		self.capture = capture
+		self.keep_running = True
+		self.error = None
+		self.captured = 0
+		self.dropped = 0
+		self.duplicates = 0
+		self._condition = Condition()
+		self._latest: Optional[CapturedFrame] = None
+		self._last_read = -1
+		self._last_read_after = -1
+
+	def run(self) -> None:
+		try:
+			self._run()
+		finally:
+			with self._condition:
+				self.keep_running = False
+				self._condition.notify_all()
+
+	def _run(self) -> None:
+		while self.keep_running:
+			ret, frame = self.capture.read()
+			timestamp = time.time()
+			if not ret:
+				self.error = VideoCaptureError('Failed to read a frame of video')
+				return
+			with self._condition:
+				if self._latest is not None and self._latest.sequence not in (self._last_read, self._last_read_after):
+					self.dropped += 1
+				self._latest = CapturedFrame(frame, timestamp, self.captured)
+				self.captured += 1
+				self._condition.notify_all()
+
+	def read(self, wait_for_new: bool=False, timeout: Optional[float]=None) -> Optional[CapturedFrame]:
+		with self._condition:
+			if wait_for_new:
+				ready = lambda: not self.keep_running or (self._latest is not None and self._latest.sequence != self._last_read)
+			else:
+				ready = lambda: not self.keep_running or self._latest is not None
+			self._condition.wait_for(ready, timeout)
+			if not self.keep_running or self._latest is None or (wait_for_new and self._latest.sequence == self._last_read):
+				return None
+			if self._latest.sequence == self._last_read:
+				self.duplicates += 1
+			self._last_read = self._latest.sequence
+			return self._latest
+
+	def read_after(self, sequence: int, timeout: Optional[float]=None) -> Optional[CapturedFrame]:
+		# For readers keeping their own place, so they neither take frames from
+		# read() callers nor count as duplicates. None when nothing newer than
+		# `sequence` came within the timeout.
+		with self._condition:
+			self._condition.wait_for(lambda: not self.keep_running or (self._latest is not None and self._latest.sequence != sequence), timeout)
+			if not self.keep_running or self._latest is None or self._latest.sequence == sequence:
+				return None
+			self._last_read_after = self._latest.sequence
+			return self._latest
+
+	def stats(self) -> dict:
+		return dict(captured=self.captured, dropped=self.dropped, duplicates=self.duplicates)
+
+	def quit(self) -> None:
+		with self._condition:
+			self.keep_running = False
+			self._condition.notify_all()
+
+
+class VideoCapture():
+	def __init__(self, device_id: int=0, threaded: bool=True) -> None:
+		self.cap = cv2.VideoCapture(device_id)
+		# self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
+		# self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+		# self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+		# self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+		self.cap.set(cv2.CAP_PROP_FPS, 30)
+		# Keep the V4L2 queue short, otherwise the driver hands out frames several periods old
+		self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+		self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+		self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+		self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+		logger.debug('Initiated capture device %dx%d@%dfps', self.width, self.height, self.fps)
+		self.thread = None
+		self._sequence = 0
+		if threaded and self.cap.isOpened():
+			self.thread = CaptureThread(self.cap)
+			self.thread.start()
+
+	def is_valid(self):
+		return self.cap.isOpened()
+
+	def get_frame_dimensions(self):
+		return (self.width, self.height)
+
+	def read(self):
+		if self.thread is None:
+			return self.cap.read()
+		captured = self.read_captured()
+		if captured is None:
+			return False, None
+		return True, captured.frame
+
+	def read_captured(self, wait_for_new: bool=False, timeout: Optional[float]=None) -> Optional[CapturedFrame]:
+		if self.thread is None:
+			ret, frame = self.cap.read()
+			if not ret:
+				return None
+			self._sequence += 1
+			return CapturedFrame(frame, time.time(), self._sequence - 1)
+		return self.thread.read(wait_for_new, timeout)
+
+	def close(self):
+		if self.thread is not None:
+			self.thread.quit()
+			self.thread.join()
+			logger.debug('Capture stats: %s', self.thread.stats())
+		self.cap.release()
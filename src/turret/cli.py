@@ -1,4 +1,5 @@
 import logging
+import time
 import traceback
 from enum import Enum
 
@@ -6,13 +7,23 @@ import click
 import cv2
 import numpy as np
 import zmq
-from PIL import Image, ImageDraw, ImageFont
 from ulid import ULID
 
+from turret.capture import VideoCapture
+from turret.codec import CODEC_RAW, CODECS, quality_is_valid
 from turret.common import Controls
-from turret.communication import TurretClient, TurretServer
+from turret.communication import (TRANSPORT_JSON, TRANSPORTS, TurretClient,
+                                  TurretServer, configure_publisher,
+                                  configure_subscriber)
 from turret.config import CROSSHAIR_RESIZE_STEP, WINDOW_NAME, Button
 from turret.exceptions import VideoCaptureError
+from turret.hud import HUD_BLUE, HUD_PINK, Hud
+from turret.metrics import STAGE_RECEIVE_TO_TRACKED, Metrics, MetricsServer
+from turret.recording import (REPLAY_MAX, REPLAY_RECORDED, REPLAY_SPEEDS,
+                              FrameRecorder, FrameReplay)
+from turret.render import RenderThread
+from turret.tracking import (DEFAULT_TRACKER, DEFAULT_TRACKING_SCALE, TRACKERS,
+                             ScaledTracker, next_tracker)
 
 logging.basicConfig(
 	format='[%(asctime)s] %(levelname)s-> %(message)s',
@@ -20,6 +31,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+STATS_REFRESH = 0.5 # seconds between stats line updates
 
 
 class TRACKER_STATE(Enum):
@@ -28,58 +40,48 @@ class TRACKER_STATE(Enum):
 	TRACKING = 2
 
 
-class VideoCapture():
-	def __init__(self, device_id: int=0) -> None:
-		self.cap = cv2.VideoCapture(device_id)
-		# self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-		# self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-		# self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-		# self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-		self.cap.set(cv2.CAP_PROP_FPS, 30)
-		self.fps = self.cap.get(cv2.CAP_PROP_FPS)
-		self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-		self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-		logger.debug('Initiated capture device %dx%d@%dfps', self.width, self.height, self.fps)
-
-	def is_valid(self):
-		return self.cap.isOpened()
-
-	def get_frame_dimensions(self):
-		return (self.width, self.height)
-
-	def read(self):
-		return self.cap.read()
-
-	def close(self):
-		self.cap.release()
-
 class Turret():
-	def __init__(self, comm: TurretClient, debug: bool=False) -> None:
+	def __init__(self, comm: TurretClient, debug: bool=False, tracking_scale: float=DEFAULT_TRACKING_SCALE, tracking_roi: float=None, tracker: str=DEFAULT_TRACKER, keyframes: bool=False, recorder: FrameRecorder=None, metrics: Metrics=None, show_stats: bool=False, headless: bool=False) -> None:
 		logger.info('Initiating turret%s', ' in debug mode' if debug else '')
 		self.debug = debug
+		# Headless runs open no window and draw nothing. Without a keyboard the
+		# target is whatever is under the crosshair in the first frame.
+		self.headless = headless
 		self.running = True
 		self.comm = comm
-		self.tracker = cv2.TrackerCSRT_create()
-		self.tracker_state = TRACKER_STATE.WAITING
+		self.tracker = ScaledTracker(tracker, tracking_scale, tracking_roi, keyframes)
+		self.tracker_state = TRACKER_STATE.INITIALIZING if headless else TRACKER_STATE.WAITING
 		self.xhair_width = 100
 		self.xhair_height = 100
+		self.hud = Hud()
+		self.recorder = recorder
+		self.metrics = metrics
+		self.show_stats = show_stats and metrics is not None
+		self.stats = ''
+		self.stats_updated = 0
 
 	def run(self):
+		# Display runs on its own thread at monitor rate, see RenderThread
+		renderer = None if self.headless else RenderThread(WINDOW_NAME)
+		if renderer is not None:
+			renderer.start()
 		try:
-			cv2.namedWindow(WINDOW_NAME)
-			cv2.setWindowProperty(WINDOW_NAME, cv2.WND_PROP_AUTOSIZE, cv2.WINDOW_AUTOSIZE)
 			while self.running:
-				controls = self._process_keys()
+				controls = self._process_keys(renderer.keys() if renderer is not None else [])
 				self.comm.send_input(controls)
 				frame = self.comm.recv_frame()
-				self._process_frame(frame)
+				if self.recorder is not None:
+					self.recorder.write(frame, self.comm.last_timestamp, self.comm.last_sequence)
+				bbox = self._process_frame(frame)
+				if renderer is None:
+					continue
+				# Drawn after tracking, so the tracker never sees the overlays
+				self._draw_overlays(frame, bbox)
 				frame = cv2.resize(frame, (1280, 720))
-				font = ImageFont.truetype("resources/fonts/roboto.ttf", 16)
-				image = Image.fromarray(frame)
-				draw = ImageDraw.Draw(image)
-				draw.text((10, 10), "This is just a test", (255, 0, 0), font)
-				frame = np.array(image)
-				cv2.imshow(WINDOW_NAME, frame)
+				self.hud.text(frame, 'status', "This is just a test", (10, 10), HUD_BLUE)
+				if self.show_stats:
+					self._draw_stats(frame)
+				renderer.show(frame)
 				if controls.screenshot:
 					filename = f'{ULID()}.jpg'
 					cv2.imwrite(filename, frame)
@@ -87,54 +89,78 @@ class Turret():
 		except KeyboardInterrupt:
 			logger.info('Stopping Turret')
 		finally:
-			pass
-			cv2.destroyAllWindows()
+			if self.recorder is not None:
+				self.recorder.close()
+			if renderer is not None:
+				renderer.quit()
+				renderer.join()
 
-	def _process_frame(self, frame):
+	def _xhair_rect(self):
 		top_left = ((self.comm.dimensions[0] - self.xhair_width) // 2, (self.comm.dimensions[1] - self.xhair_height) // 2)
 		bottom_right = ((self.comm.dimensions[0] + self.xhair_width) // 2, (self.comm.dimensions[1] + self.xhair_height) // 2)
-		cv2.rectangle(frame, top_left, bottom_right, (255, 0, 255), 2)
+		return top_left, bottom_right
 
+	def _process_frame(self, frame):
+		# Returns the target's bbox, None when there is none
 		if self.tracker_state == TRACKER_STATE.TRACKING:
 			ret, bbox = self.tracker.update(frame)
 			if not ret:
 				logger.debug('Target lost')
 				self.tracker_state = TRACKER_STATE.WAITING
-				return
-			tl = bbox[:2]
-			br = (bbox[0] + bbox[2], bbox[1] + bbox[3])
-			cv2.rectangle(frame, tl, br, (255, 0, 0), 2)
-
-			vector_x_0 = self.comm.dimensions[0] // 2
-			vector_y_0 = self.comm.dimensions[1] // 2
-			cap_center = (vector_x_0, vector_y_0)
-			vector_x_1 = bbox[0] + bbox[2] // 2
-			vector_y_1 = bbox[1] + bbox[3] // 2
-			track_center = (vector_x_1, vector_y_1)
-			logger.debug('X: %d   Y: %d', vector_x_0 - vector_x_1, vector_y_0 - vector_y_1)
-			cv2.arrowedLine(frame, cap_center, track_center, (255, 0, 0), 2)
-
-		elif self.tracker_state == TRACKER_STATE.INITIALIZING:
+				return None
+			if self.metrics is not None:
+				self.metrics.observe_between(STAGE_RECEIVE_TO_TRACKED, self.comm.last_received, time.time())
+			logger.debug('X: %d   Y: %d', self.comm.dimensions[0] // 2 - (bbox[0] + bbox[2] // 2), self.comm.dimensions[1] // 2 - (bbox[1] + bbox[3] // 2))
+			return bbox
+
+		if self.tracker_state == TRACKER_STATE.INITIALIZING:
+			top_left, _ = self._xhair_rect()
 			self.tracker.init(frame, (*top_left, self.xhair_width, self.xhair_height))
 			self.tracker_state = TRACKER_STATE.TRACKING
-
-	def _process_keys(self):
-		controls = get_input()
+		return None
+
+	def _draw_overlays(self, frame, bbox):
+		self.hud.crosshair(frame, *self._xhair_rect(), HUD_PINK)
+		if bbox is None:
+			return
+		self.hud.bbox(frame, bbox, HUD_BLUE)
+		cap_center = (self.comm.dimensions[0] // 2, self.comm.dimensions[1] // 2)
+		track_center = (bbox[0] + bbox[2] // 2, bbox[1] + bbox[3] // 2)
+		self.hud.vector(frame, cap_center, track_center, HUD_BLUE)
+
+	def _draw_stats(self, frame):
+		# Percentiles are only recomputed now and then, the sprite is cached in between
+		if time.monotonic() - self.stats_updated > STATS_REFRESH:
+			self.stats = self.metrics.stats_line()
+			self.stats_updated = time.monotonic()
+		if self.stats:
+			self.hud.text(frame, 'stats', self.stats, (10, frame.shape[0] - 30), HUD_PINK)
+
+	def _process_keys(self, keys: list):
+		controls = get_input(keys)
 		self.running = controls.client_running
 		if controls.init_tracker:
 			self.tracker_state = TRACKER_STATE.INITIALIZING
 		elif controls.init_tracker is not None:
 			self.tracker_state = TRACKER_STATE.WAITING
+		if controls.switch_tracker:
+			self.tracker.set_backend(next_tracker(self.tracker.backend))
 		self.xhair_height += controls.dy
 		self.xhair_width += controls.dx
 		return controls
 
 
-def get_input() -> Controls:
+def get_input(keys: list) -> Controls:
+	# keys as queued by RenderThread, the window's event loop runs there
 	controls = Controls()
-	key = cv2.waitKeyEx(1)
-	if key != -1:
-		logger.debug('Key pressed (code=%d), (repr=%s)', key, chr(key))
+	for key in keys:
+		apply_key(controls, key)
+	if controls != Controls():
+		logger.debug('Got input %s', controls)
+	return controls
+
+def apply_key(controls: Controls, key: int) -> None:
+	logger.debug('Key pressed (code=%d), (repr=%s)', key, chr(key))
 	if key == ord('q'):
 		controls.client_running = False
 	elif key == ord('x'):
@@ -146,6 +172,8 @@ def get_input() -> Controls:
 		controls.init_tracker = False
 	elif key == ord(' '):
 		controls.screenshot = True
+	elif key == ord('t'):
+		controls.switch_tracker = True
 	elif key in [ord('w'), Button.ARROW_UP]:
 		controls.dy += CROSSHAIR_RESIZE_STEP
 	elif key in [ord('s'), Button.ARROW_DOWN]:
@@ -154,9 +182,6 @@ def get_input() -> Controls:
 		controls.dx -= CROSSHAIR_RESIZE_STEP
 	elif key in [ord('d'), Button.ARROW_RIGHT]:
 		controls.dx += CROSSHAIR_RESIZE_STEP
-	if controls != Controls():
-		logger.debug('Got input %s', controls)
-	return controls
 
 
 @click.group()
@@ -168,66 +193,170 @@ def cli():
 @click.option('-h', '--host', type=str, default='0.0.0.0')
 @click.option('-p', '--port', type=int, default=42999)
 @click.option('-d', '--device', type=int, default=0)
-def server(debug: bool, host: str, port: int, device: int):
+@click.option('--stream', is_flag=True, help='Publish frames as they are captured instead of waiting for requests')
+@click.option('--codec', type=click.Choice(CODECS), default=CODEC_RAW, help='Default frame encoding, clients may request another one')
+@click.option('--quality', type=int, default=None, help='JPEG quality or PNG compression level')
+@click.option('--transport', type=click.Choice(TRANSPORTS), default=TRANSPORT_JSON, help='Frame header format, must match the client')
+@click.option('--record', type=click.Path(file_okay=False), default=None, help='Also write every captured frame to this recording directory')
+@click.option('--replay', type=click.Path(exists=True, file_okay=False), default=None, help='Serve frames from a recording instead of the camera')
+@click.option('--replay-speed', type=click.Choice(REPLAY_SPEEDS), default=REPLAY_RECORDED)
+def server(debug: bool, host: str, port: int, device: int, stream: bool, codec: str, quality: int, transport: str, record: str, replay: str, replay_speed: str):
+	if not quality_is_valid(codec, quality):
+		raise click.BadParameter(f'out of range for {codec}', param_hint='--quality')
 	if debug:
 		logger.setLevel(logging.DEBUG)
 		logger.debug('Debug logging enabled')
 
+	input_socket = None
+	recorder = None
 	try:
-		cap = VideoCapture(device)
+		cap = FrameReplay(replay, replay_speed) if replay else VideoCapture(device)
+		if record:
+			recorder = FrameRecorder(record)
 
 		context = zmq.Context()
-		socket = context.socket(zmq.REP)
 		interface = f'tcp://{host}:{port}'
-		socket.bind(interface)
-		logger.info('Server bound to interface %s', interface)
-		server = TurretServer(socket)
+		if stream:
+			socket = configure_publisher(context.socket(zmq.PUB))
+			socket.bind(interface)
+			input_socket = context.socket(zmq.PULL)
+			input_socket.bind(f'tcp://{host}:{port + 1}')
+		else:
+			socket = context.socket(zmq.REP)
+			socket.bind(interface)
+		logger.info('Server bound to interface %s%s', interface, ' (streaming)' if stream else '')
+		server = TurretServer(socket, input_socket, codec, quality, transport)
 		running = True
 		while running:
-			msg = server.recv_input()
-			running = msg.server_running
-
-			ret, frame = cap.read()
-			if not ret:
+			if stream:
+				while (msg := server.poll_input()) is not None:
+					running = msg.server_running
+			else:
+				msg = server.recv_input()
+				running = msg.server_running
+
+			captured = cap.read_captured(wait_for_new=stream, timeout=1)
+			if captured is None:
+				if replay:
+					logger.info('Replay finished')
+					break
 				raise VideoCaptureError('Failed to read a frame of video')
-			server.send_frame(frame)
+			if recorder is not None:
+				recorder.write(captured.frame, captured.timestamp, captured.sequence)
+			server.send_frame(captured.frame, timestamp=captured.timestamp)
 	except KeyboardInterrupt:
 		logger.info('Stopping server')
 	except Exception:
 		logger.error('Unknown error occured')
 		logger.error(traceback.format_exc())
 	finally:
+		cap.close()
+		if recorder is not None:
+			recorder.close()
 		socket.close()
+		if input_socket is not None:
+			input_socket.close()
 		logger.info('Socket closed')
 		context.destroy()
 		logger.info('0MQ context destroyed')
 
 @cli.command()
 @click.argument('server_address')
-@click.argument('server_port')
-def client(server_address: str, server_port: int):
+@click.argument('server_port', type=int)
+@click.option('--stream', is_flag=True, help='Subscribe to a streaming server')
+@click.option('--codec', type=click.Choice(CODECS), default=None, help='Frame encoding to request from the server')
+@click.option('--quality', type=int, default=None, help='JPEG quality or PNG compression level')
+@click.option('--transport', type=click.Choice(TRANSPORTS), default=TRANSPORT_JSON, help='Frame header format, must match the server')
+@click.option('--tracker', type=click.Choice(TRACKERS), default=DEFAULT_TRACKER, help='Tracker backend, t cycles through them at runtime')
+@click.option('--tracking-scale', type=click.FloatRange(0, 1, min_open=True), default=DEFAULT_TRACKING_SCALE, help='Scale of the received frame the tracker runs on')
+@click.option('--tracking-roi', type=float, default=None, help='Only track inside a window padded by this many target sizes')
+@click.option('--keyframes', is_flag=True, help='Run the tracker only every few frames and follow the target with optical flow in between')
+@click.option('--record', type=click.Path(file_okay=False), default=None, help='Write every received frame to this recording directory')
+@click.option('--metrics-port', type=int, default=None, help='Serve per-stage latency histograms on this local port')
+@click.option('--stats', is_flag=True, help='Show median per-stage latencies on screen')
+@click.option('--headless', is_flag=True, help='Open no window and draw nothing, tracks what is under the crosshair from the start')
+def client(server_address: str, server_port: int, stream: bool, codec: str, quality: int, transport: str, tracker: str, tracking_scale: float, tracking_roi: float, keyframes: bool, record: str, metrics_port: int, stats: bool, headless: bool):
 	logger.setLevel(logging.DEBUG)
 	logger.info('Creating 0MQ context')
 	context = zmq.Context()
 	logger.info('Constructing socket')
-	socket = context.socket(zmq.REQ)
-	socket.connect(f'tcp://{server_address}:{server_port}')
-	client = TurretClient(socket)
+	input_socket = None
+	if stream:
+		socket = configure_subscriber(context.socket(zmq.SUB))
+		socket.connect(f'tcp://{server_address}:{server_port}')
+		input_socket = context.socket(zmq.PUSH)
+		# Queued input is worthless once the client quits, don't block on it
+		input_socket.setsockopt(zmq.LINGER, 0)
+		input_socket.connect(f'tcp://{server_address}:{server_port + 1}')
+	else:
+		socket = context.socket(zmq.REQ)
+		# A request still queued for a server that is gone would block the
+		# context from terminating
+		socket.setsockopt(zmq.LINGER, 0)
+		socket.connect(f'tcp://{server_address}:{server_port}')
+	metrics = Metrics() if metrics_port or stats else None
+	if metrics_port:
+		MetricsServer(metrics, metrics_port).start()
+	client = TurretClient(socket, input_socket, latest_only=stream, codec=codec, quality=quality, transport=transport, metrics=metrics)
 
 	logger.info('CLIENT')
 	try:
-		turret = Turret(client)
+		recorder = FrameRecorder(record) if record else None
+		turret = Turret(client, tracking_scale=tracking_scale, tracking_roi=tracking_roi, tracker=tracker, keyframes=keyframes, recorder=recorder, metrics=metrics, show_stats=stats, headless=headless)
 		turret.run()
 	except Exception:
 		logger.error('Unknown error occured')
 		logger.error(traceback.format_exc())
 	finally:
 		socket.close()
+		if input_socket is not None:
+			input_socket.close()
 		logger.info('Socket closed')
 		context.destroy()
 		logger.info('0MQ context destroyed')
-		cv2.destroyAllWindows()
-		logger.info('CV2 windows destroyed')
+		if not headless:
+			cv2.destroyAllWindows()
+			logger.info('CV2 windows destroyed')
+
+@cli.command('bench-tracking')
+@click.argument('recording', type=click.Path(exists=True, file_okay=False))
+@click.option('--tracker', type=click.Choice(TRACKERS), default=DEFAULT_TRACKER)
+@click.option('--tracking-scale', type=click.FloatRange(0, 1, min_open=True), default=DEFAULT_TRACKING_SCALE)
+@click.option('--tracking-roi', type=float, default=None)
+@click.option('--keyframes', is_flag=True)
+@click.option('--keyframe-budget', type=float, default=1 / 30, help='Seconds per frame keyframes are scheduled for, frames are replayed back to back')
+@click.option('--bbox', type=(int, int, int, int), default=None, help='Initial target x y w h, defaults to the 100x100 crosshair')
+def bench_tracking(recording: str, tracker: str, tracking_scale: float, tracking_roi: float, keyframes: bool, keyframe_budget: float, bbox: tuple):
+	# Runs the tracker over a recording as fast as it goes, no camera or network involved
+	logger.setLevel(logging.INFO)
+	replay = FrameReplay(recording, REPLAY_MAX)
+	if not replay.is_valid():
+		raise click.ClickException(f'{recording} holds no frames')
+	width, height = replay.get_frame_dimensions()
+	if bbox is None:
+		bbox = ((width - 100) // 2, (height - 100) // 2, 100, 100)
+	scaled_tracker = ScaledTracker(tracker, tracking_scale, tracking_roi, keyframes)
+	if keyframes:
+		scaled_tracker.schedule.budget = keyframe_budget
+	_, frame = replay.read()
+	scaled_tracker.init(frame, bbox)
+	timings = []
+	lost = 0
+	while (captured := replay.read_captured()) is not None:
+		start = time.perf_counter()
+		ret, _ = scaled_tracker.update(captured.frame)
+		timings.append(time.perf_counter() - start)
+		lost += not ret
+	replay.close()
+	if not timings:
+		raise click.ClickException(f'{recording} is too short to benchmark')
+	timings = np.array(timings) * 1000
+	click.echo(f'{tracker} scale={tracking_scale} roi={tracking_roi}: {len(timings)} frames, lost on {lost}')
+	click.echo(f'update ms: mean {timings.mean():.2f}  p50 {np.percentile(timings, 50):.2f}  p95 {np.percentile(timings, 95):.2f}  max {timings.max():.2f}')
+	click.echo(f'throughput: {1000 / timings.mean():.1f} fps')
+	if keyframes:
+		schedule = scaled_tracker.schedule
+		click.echo(f'keyframes: {schedule.keyframes} of {schedule.frames} frames, interval {schedule.interval} at the end')
 
 
 
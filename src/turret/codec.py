@@ -0,0 +1,42 @@
+import cv2
+import numpy as np
+
+CODEC_RAW = 'raw'
+CODEC_JPEG = 'jpeg'
+CODEC_PNG = 'png'
+CODECS = (CODEC_RAW, CODEC_JPEG, CODEC_PNG)
+DEFAULT_JPEG_QUALITY = 80
+DEFAULT_PNG_COMPRESSION = 1 # lossless anyway, favour speed over size
+QUALITY_RANGES = {CODEC_JPEG: (0, 100), CODEC_PNG: (0, 9)} # JPEG quality, PNG compression level
+
+
+def encode_frame(frame: np.ndarray, codec: str=CODEC_RAW, quality: int=None):
+	if codec == CODEC_RAW:
+		return frame
+	if codec == CODEC_JPEG:
+		params = [cv2.IMWRITE_JPEG_QUALITY, DEFAULT_JPEG_QUALITY if quality is None else quality]
+		ret, buffer = cv2.imencode('.jpg', frame, params)
+	elif codec == CODEC_PNG:
+		params = [cv2.IMWRITE_PNG_COMPRESSION, DEFAULT_PNG_COMPRESSION if quality is None else quality]
+		ret, buffer = cv2.imencode('.png', frame, params)
+	else:
+		raise ValueError(f'Unknown codec: {codec}')
+	if not ret:
+		raise ValueError(f'Failed to encode frame as {codec}')
+	return buffer
+
+def quality_is_valid(codec: str, quality) -> bool:
+	# None picks the codec's default, raw has nothing to tune
+	if quality is None or codec not in QUALITY_RANGES:
+		return True
+	low, high = QUALITY_RANGES[codec]
+	return isinstance(quality, int) and not isinstance(quality, bool) and low <= quality <= high
+
+def decode_frame(buffer, metadata: dict) -> np.ndarray:
+	codec = metadata.get('codec', CODEC_RAW)
+	if codec == CODEC_RAW:
+		np_array = np.frombuffer(buffer, dtype=metadata['dtype'])
+		return np_array.reshape(metadata['shape'])
+	if codec not in CODECS:
+		raise ValueError(f'Unknown codec: {codec}')
+	return cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
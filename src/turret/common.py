@@ -9,4 +9,7 @@ class Controls():
 	init_tracker: Optional[bool]=None
 	dy: int=0
 	dx: int=0
-	screenshot: bool=False
\ No newline at end of file
+	screenshot: bool=False
+	switch_tracker: bool=False
+	codec: Optional[str]=None # requested frame encoding, the server decides
+	quality: Optional[int]=None
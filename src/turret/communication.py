@@ -1,38 +1,214 @@
+import logging
+import struct
+import time
 from dataclasses import asdict
 
 import numpy as np
 import zmq
 
+from turret.codec import (CODEC_RAW, CODECS, decode_frame, encode_frame,
+                          quality_is_valid)
 from turret.common import Controls
+from turret.metrics import (STAGE_CAPTURE_TO_SEND, STAGE_SEND_TO_RECEIVE,
+                            Metrics)
+
+logger = logging.getLogger()
 
 # https://pyzmq.readthedocs.io/en/latest/howto/serialization.html
 
+# HWMs count whole multipart messages, not parts, so this keeps at most one
+# frame queued per socket. Anything beyond that is dropped by 0MQ.
+STREAM_HWM = 1
+
+TRANSPORT_JSON = 'json'
+TRANSPORT_BINARY = 'binary'
+TRANSPORTS = (TRANSPORT_JSON, TRANSPORT_BINARY)
+
+# Binary transport: one fixed-size header part followed by the payload part.
+# version, dtype, codec, ndim, height, width, channels, payload size, sequence,
+# capture timestamp, send timestamp
+FRAME_HEADER = struct.Struct('<BBBBHHHIQdd')
+FRAME_HEADER_VERSION = 2
+FRAME_DTYPES = ('uint8', 'uint16', 'float32')
+FRAME_BUFFER_POOL_SIZE = 3
+
+
+def configure_publisher(zmq_socket: zmq.Socket) -> zmq.Socket:
+	zmq_socket.setsockopt(zmq.SNDHWM, STREAM_HWM)
+	zmq_socket.setsockopt(zmq.LINGER, 0)
+	return zmq_socket
+
+def configure_subscriber(zmq_socket: zmq.Socket) -> zmq.Socket:
+	# Must be called before connect, otherwise the HWM is not applied
+	zmq_socket.setsockopt(zmq.RCVHWM, STREAM_HWM)
+	zmq_socket.setsockopt(zmq.LINGER, 0)
+	zmq_socket.setsockopt(zmq.SUBSCRIBE, b'')
+	return zmq_socket
+
+
+class FrameBufferPool():
+	# Ring of preallocated frame buffers, reallocated only when the frame format
+	# changes. A frame handed out stays valid until `size` more frames have been
+	# received into the pool, so consumers must not hold on to it longer.
+	def __init__(self, size: int=FRAME_BUFFER_POOL_SIZE) -> None:
+		self.size = size
+		self._format = None
+		self._buffers = []
+		self._index = 0
+
+	def acquire(self, dtype: str, shape: tuple) -> np.ndarray:
+		if self._format != (dtype, shape):
+			self._buffers = [np.empty(shape, dtype) for _ in range(self.size)]
+			self._format = (dtype, shape)
+			self._index = 0
+		buffer = self._buffers[self._index]
+		self._index = (self._index + 1) % self.size
+		return buffer
+
+
 class TurretServer():
-	def __init__(self, zmq_socket: zmq.Socket) -> None:
+	def __init__(self, zmq_socket: zmq.Socket, input_socket: zmq.Socket=None, codec: str=CODEC_RAW, quality: int=None, transport: str=TRANSPORT_JSON) -> None:
 		self.socket = zmq_socket
+		self.input_socket = input_socket if input_socket is not None else zmq_socket
+		self.codec = codec
+		self.quality = quality
+		self.transport = transport
+		self.sequence = 0
 
-	def send_frame(self, np_array: np.ndarray, flags=0, copy=True, track=False):
+	def send_frame(self, np_array: np.ndarray, flags=0, copy=True, track=False, timestamp: float=None):
+		if self.transport == TRANSPORT_BINARY:
+			return self._send_frame_binary(np_array, flags, timestamp)
 		metadata = dict(
 			dtype=str(np_array.dtype),
-			shape=np_array.shape
+			shape=np_array.shape,
+			sequence=self.sequence
 		)
+		if timestamp is not None:
+			metadata['timestamp'] = timestamp
+		self.sequence += 1
+		if self.codec != CODEC_RAW:
+			metadata['codec'] = self.codec
+			np_array = encode_frame(np_array, self.codec, self.quality)
+		metadata['sent'] = time.time()
 		self.socket.send_json(metadata, flags | zmq.SNDMORE)
 		return self.socket.send(np_array, flags, copy, track)
 
-	def recv_input(self) -> Controls:
-		return Controls(**self.socket.recv_json())
+	def _send_frame_binary(self, np_array: np.ndarray, flags=0, timestamp: float=None):
+		shape = np_array.shape + (0,) * (3 - np_array.ndim)
+		payload = np.ascontiguousarray(np_array)
+		if self.codec != CODEC_RAW:
+			payload = encode_frame(payload, self.codec, self.quality)
+		sent = time.time()
+		header = FRAME_HEADER.pack(
+			FRAME_HEADER_VERSION,
+			FRAME_DTYPES.index(str(np_array.dtype)),
+			CODECS.index(self.codec),
+			np_array.ndim,
+			*shape,
+			payload.nbytes,
+			self.sequence,
+			sent if timestamp is None else timestamp,
+			sent
+		)
+		self.sequence += 1
+		self.socket.send(header, flags | zmq.SNDMORE)
+		# 0MQ keeps a reference to the payload until it is on the wire. Captured
+		# frames are never written to afterwards, so nobody has to wait for that.
+		return self.socket.send(payload, flags, copy=False)
+
+	def recv_input(self, flags=0) -> Controls:
+		controls = Controls(**self.input_socket.recv_json(flags))
+		self._negotiate_codec(controls)
+		return controls
+
+	def _negotiate_codec(self, controls: Controls):
+		if controls.codec is None or (controls.codec, controls.quality) == (self.codec, self.quality):
+			return
+		if controls.codec not in CODECS:
+			logger.warning('Client requested unsupported codec %s, keeping %s', controls.codec, self.codec)
+			return
+		if not quality_is_valid(controls.codec, controls.quality):
+			logger.warning('Client requested invalid %s quality %s, keeping %s', controls.codec, controls.quality, self.codec)
+			return
+		logger.info('Switching frame codec to %s (quality=%s)', controls.codec, controls.quality)
+		self.codec = controls.codec
+		self.quality = controls.quality
+
+	def poll_input(self):
+		# Non-blocking variant of recv_input, None when nothing is queued
+		try:
+			return self.recv_input(zmq.NOBLOCK)
+		except zmq.Again:
+			return None
 
 class TurretClient():
-	def __init__(self, zmq_socket: zmq.Socket) -> None:
+	def __init__(self, zmq_socket: zmq.Socket, input_socket: zmq.Socket=None, latest_only: bool=False, codec: str=None, quality: int=None, transport: str=TRANSPORT_JSON, metrics: Metrics=None) -> None:
 		self.socket = zmq_socket
+		self.input_socket = input_socket if input_socket is not None else zmq_socket
+		self.latest_only = latest_only
+		self.codec = codec
+		self.quality = quality
+		self.transport = transport
 		self.dimensions = None
+		self.last_sequence = None
+		self.last_timestamp = None # capture time
+		self.last_sent = None
+		self.last_received = None
+		self.metrics = metrics
+		self.pool = FrameBufferPool()
+
+	def send_input(self, controls: Controls, flags=0):
+		if controls.codec is None:
+			controls.codec = self.codec
+			controls.quality = self.quality
+		self.input_socket.send_json(asdict(controls), flags)
 
 	def recv_frame(self, flags=0, copy=True, track=False):
+		np_array = self._recv_frame(flags, copy, track)
+		if self.latest_only:
+			# Skip frames that piled up while we were busy, only the newest matters
+			while self.socket.poll(0, zmq.POLLIN):
+				np_array = self._recv_frame(flags, copy, track)
+		self.last_received = time.time()
+		if self.metrics is not None:
+			self.metrics.observe_between(STAGE_CAPTURE_TO_SEND, self.last_timestamp, self.last_sent)
+			# Spans both machines, only meaningful with synchronised clocks
+			self.metrics.observe_between(STAGE_SEND_TO_RECEIVE, self.last_sent, self.last_received)
+		return np_array
+
+	def _recv_frame(self, flags=0, copy=True, track=False):
+		if self.transport == TRANSPORT_BINARY:
+			return self._recv_frame_binary(flags)
 		metadata = self.socket.recv_json(flags)
 		if not self.dimensions: # Let's assume it's const
 			h, w, _ = metadata['shape']
 			self.dimensions = (w, h)
+		self.last_sequence = metadata.get('sequence')
+		self.last_timestamp = metadata.get('timestamp')
+		self.last_sent = metadata.get('sent')
 		message = self.socket.recv(flags, copy, track)
-		buffer = memoryview(message)
-		np_array = np.frombuffer(buffer, dtype=metadata['dtype'])
-		return np_array.reshape(metadata['shape'])
+		return decode_frame(memoryview(message), metadata)
+
+	def _recv_frame_binary(self, flags=0):
+		header = self.socket.recv(flags)
+		if len(header) != FRAME_HEADER.size:
+			raise ValueError(f'Invalid frame header size: {len(header)}')
+		version, dtype, codec, ndim, *shape, payload_size, sequence, timestamp, sent = FRAME_HEADER.unpack(header)
+		if version != FRAME_HEADER_VERSION:
+			raise ValueError(f'Unsupported frame header version: {version}')
+		shape = tuple(shape[:ndim])
+		if not self.dimensions:
+			self.dimensions = (shape[1], shape[0])
+		self.last_sequence = sequence
+		self.last_timestamp = timestamp
+		self.last_sent = sent
+		# Not copied out of 0MQ, raw frames are copied once into the pool so
+		# they stay writable and valid after the message is released
+		payload = self.socket.recv(flags, copy=False).buffer
+		if len(payload) != payload_size:
+			raise ValueError(f'Frame payload size mismatch: expected {payload_size}, got {len(payload)}')
+		if CODECS[codec] == CODEC_RAW:
+			np_array = self.pool.acquire(FRAME_DTYPES[dtype], shape)
+			np.copyto(np_array, np.frombuffer(payload, FRAME_DTYPES[dtype]).reshape(shape))
+			return np_array
+		return decode_frame(payload, dict(codec=CODECS[codec]))
@@ -0,0 +1,12 @@
+from enum import IntEnum
+
+WINDOW_NAME = 'the-turret'
+CROSSHAIR_RESIZE_STEP = 10 # pixels per key press
+
+
+class Button(IntEnum):
+	# cv2.waitKeyEx codes
+	ARROW_LEFT = 65361
+	ARROW_UP = 65362
+	ARROW_RIGHT = 65363
+	ARROW_DOWN = 65364
@@ -0,0 +1,78 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_PATH = 'resources/fonts/roboto.ttf'
+FONT_SIZE = 16
+# Colors are in frame (BGR) order
+HUD_BLUE = (255, 0, 0)
+HUD_RED = (0, 0, 255)
+HUD_PINK = (255, 0, 255)
+
+
+@lru_cache(maxsize=None)
+def load_font(path: str=FONT_PATH, size: int=FONT_SIZE) -> ImageFont.FreeTypeFont:
+	return ImageFont.truetype(path, size)
+
+
+@dataclass()
+class TextSprite():
+	text: str
+	color: tuple
+	font_size: int
+	inverse_alpha: np.ndarray # 255 - alpha, (h, w, 1) uint16
+	premultiplied: np.ndarray # color * alpha, (h, w, 3) uint16
+
+	@classmethod
+	def render(cls, text: str, color: tuple, font_size: int=FONT_SIZE) -> 'TextSprite':
+		font = load_font(FONT_PATH, font_size)
+		_, _, right, bottom = font.getbbox(text)
+		mask = Image.new('L', (max(right, 1), max(bottom, 1)))
+		ImageDraw.Draw(mask).text((0, 0), text, 255, font)
+		alpha = np.asarray(mask, dtype=np.uint16)[..., np.newaxis]
+		return cls(
+			text=text,
+			color=color,
+			font_size=font_size,
+			inverse_alpha=255 - alpha,
+			premultiplied=alpha * np.array(color, dtype=np.uint16)
+		)
+
+	def blend(self, frame: np.ndarray, position: tuple) -> None:
+		x, y = position
+		roi = frame[y:y + self.inverse_alpha.shape[0], x:x + self.inverse_alpha.shape[1]]
+		h, w = roi.shape[:2]
+		if not h or not w:
+			return
+		# Both terms sum up to at most 255 * 255, so uint16 never overflows
+		blended = roi * self.inverse_alpha[:h, :w]
+		blended += self.premultiplied[:h, :w]
+		blended //= 255
+		roi[:] = blended
+
+
+class Hud():
+	# Overlays drawn straight into the frame. Text is rasterised once and only
+	# rendered again when the text (or its style) in a given slot changes.
+	def __init__(self) -> None:
+		self._sprites = {}
+
+	def text(self, frame: np.ndarray, slot: str, text: str, position: tuple, color: tuple=HUD_BLUE, font_size: int=FONT_SIZE) -> None:
+		sprite = self._sprites.get(slot)
+		if sprite is None or (sprite.text, sprite.color, sprite.font_size) != (text, color, font_size):
+			sprite = TextSprite.render(text, color, font_size)
+			self._sprites[slot] = sprite
+		sprite.blend(frame, position)
+
+	def crosshair(self, frame: np.ndarray, top_left: tuple, bottom_right: tuple, color: tuple=HUD_PINK) -> None:
+		cv2.rectangle(frame, top_left, bottom_right, color, 2)
+
+	def bbox(self, frame: np.ndarray, bbox: tuple, color: tuple=HUD_BLUE) -> None:
+		x, y, w, h = (int(v) for v in bbox)
+		cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+
+	def vector(self, frame: np.ndarray, start: tuple, end: tuple, color: tuple=HUD_BLUE, thickness: int=2) -> None:
+		cv2.arrowedLine(frame, start, end, color, thickness)
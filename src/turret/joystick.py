@@ -0,0 +1,95 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from pathlib import Path
+
+# Linux joystick API, see Documentation/input/joydev/joystick-api.rst
+# time (ms), value, type, number
+JS_EVENT_STRUCT = struct.Struct('IhBB')
+JS_EVENT_BUTTON = 0x01
+JS_EVENT_AXIS = 0x02
+JS_EVENT_INIT = 0x80 # synthetic events describing the initial state
+JS_READ_EVENTS = 64 # events read per syscall
+JOYSTICK_PREFIX = 'js'
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT_STRUCT = struct.Struct('iIII') # wd, mask, cookie, name length
+INOTIFY_BUFFER_SIZE = 4096
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+
+class Inotify():
+	# Minimal inotify binding, the fd is non-blocking and meant for epoll
+	def __init__(self) -> None:
+		self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		self._buffer = bytearray(INOTIFY_BUFFER_SIZE)
+
+	def fileno(self) -> int:
+		return self.fd
+
+	def add_watch(self, path, mask: int) -> int:
+		wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+		return wd
+
+	def read(self) -> list:
+		# Returns (mask, name) of every queued event
+		events = []
+		while True:
+			try:
+				nbytes = os.readv(self.fd, [self._buffer])
+			except BlockingIOError:
+				return events
+			offset = 0
+			while offset < nbytes:
+				_, mask, _, length = INOTIFY_EVENT_STRUCT.unpack_from(self._buffer, offset)
+				offset += INOTIFY_EVENT_STRUCT.size
+				name = bytes(self._buffer[offset:offset + length]).rstrip(b'\0').decode()
+				offset += length
+				events.append((mask, name))
+
+	def close(self) -> None:
+		os.close(self.fd)
+
+
+class Joystick():
+	# Non-blocking reader for /dev/input/js* devices, drains every queued event
+	# with one syscall per JS_READ_EVENTS
+	def __init__(self, path) -> None:
+		self.path = Path(path)
+		self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+		self._buffer = bytearray(JS_EVENT_STRUCT.size * JS_READ_EVENTS)
+
+	def fileno(self) -> int:
+		return self.fd
+
+	def read(self) -> list:
+		# Returns (time, value, type, number) of every queued event, raises
+		# OSError(ENODEV) once the device is unplugged
+		events = []
+		while True:
+			try:
+				nbytes = os.readv(self.fd, [self._buffer])
+			except BlockingIOError:
+				return events
+			if not nbytes:
+				raise OSError(errno.ENODEV, 'Joystick closed', str(self.path))
+			events.extend(JS_EVENT_STRUCT.iter_unpack(memoryview(self._buffer)[:nbytes - nbytes % JS_EVENT_STRUCT.size]))
+			if nbytes < len(self._buffer):
+				return events
+
+	def close(self) -> None:
+		os.close(self.fd)
+
+
+def is_joystick(name: str) -> bool:
+	return name.startswith(JOYSTICK_PREFIX) and name[len(JOYSTICK_PREFIX):].isdigit()
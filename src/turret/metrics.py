@@ -0,0 +1,119 @@
+import logging
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+import numpy as np
+
+logger = logging.getLogger()
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PATH = '/metrics'
+METRIC_NAME = 'turret_stage_seconds'
+# Seconds, tuned for a 60fps pipeline: sub-frame stages up to whole backlogs
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5)
+WINDOW = 512 # samples kept per stage for rolling percentiles
+
+# Stage names, each is the time between two timestamps carried along with a
+# frame or a command. Stages spanning the PC and the Pi rely on their clocks
+# being in sync (NTP), the rest are measured on a single clock.
+STAGE_CAPTURE_TO_SEND = 'capture_to_send'
+STAGE_SEND_TO_RECEIVE = 'send_to_receive'
+STAGE_RECEIVE_TO_TRACKED = 'receive_to_tracked'
+STAGE_TRACKED_TO_COMMAND = 'tracked_to_command'
+STAGE_COMMAND_TO_APPLIED = 'command_to_applied'
+STAGE_COMMAND_ROUND_TRIP = 'command_round_trip'
+STAGE_CAPTURE_TO_APPLIED = 'capture_to_applied'
+
+
+class StageHistogram():
+	def __init__(self, buckets: tuple=BUCKETS) -> None:
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.recent = deque(maxlen=WINDOW)
+
+	def observe(self, seconds: float) -> None:
+		index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+		self.counts[index] += 1
+		self.sum += seconds
+		self.count += 1
+		self.recent.append(seconds)
+
+	def percentile(self, q: float) -> float:
+		if not self.recent:
+			return float('nan')
+		return float(np.percentile(self.recent, q))
+
+
+class Metrics():
+	def __init__(self) -> None:
+		self._lock = Lock()
+		self._stages = {}
+
+	def observe(self, stage: str, seconds: float) -> None:
+		with self._lock:
+			histogram = self._stages.get(stage)
+			if histogram is None:
+				histogram = self._stages[stage] = StageHistogram()
+			histogram.observe(seconds)
+
+	def observe_between(self, stage: str, start: float, end: float) -> None:
+		# Timestamps missing on older peers are sent as None or 0
+		if start and end:
+			self.observe(stage, end - start)
+
+	def percentiles(self, q: float=50) -> dict:
+		with self._lock:
+			return {stage: histogram.percentile(q) for stage, histogram in self._stages.items()}
+
+	def stats_line(self, q: float=50) -> str:
+		return '  '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in self.percentiles(q).items())
+
+	def render(self) -> str:
+		# Prometheus text exposition format
+		lines = [
+			f'# HELP {METRIC_NAME} Time spent between two stages of the turret pipeline',
+			f'# TYPE {METRIC_NAME} histogram',
+		]
+		with self._lock:
+			for stage, histogram in self._stages.items():
+				cumulative = 0
+				for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+					cumulative += count
+					lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+				lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {histogram.sum}')
+				lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {histogram.count}')
+		return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(Thread):
+	def __init__(self, metrics: Metrics, port: int, host: str=METRICS_HOST) -> None:
+		super().__init__(name="Metrics Thread", daemon=True)
+		self.metrics = metrics
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(handler):
+				if handler.path != METRICS_PATH:
+					handler.send_error(404)
+					return
+				body = metrics.render().encode()
+				handler.send_response(200)
+				handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+				handler.send_header('Content-Length', str(len(body)))
+				handler.end_headers()
+				handler.wfile.write(body)
+
+			def log_message(handler, format, *args):
+				pass
+
+		self.server = ThreadingHTTPServer((host, port), Handler)
+		logger.info('Serving metrics on http://%s:%d%s', host, port, METRICS_PATH)
+
+	def run(self) -> None:
+		self.server.serve_forever()
+
+	def quit(self) -> None:
+		self.server.shutdown()
+		self.server.server_close()
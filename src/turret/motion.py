@@ -0,0 +1,190 @@
+import logging
+import time
+from functools import lru_cache
+from threading import Condition, Thread
+from typing import Callable
+
+import numpy as np
+
+logger = logging.getLogger()
+
+PROFILE_TRAPEZOIDAL = 'trapezoidal' # constant acceleration
+PROFILE_S_CURVE = 's-curve' # acceleration eases in and out, no jerk spikes
+PROFILES = (PROFILE_TRAPEZOIDAL, PROFILE_S_CURVE)
+DEFAULT_ACCELERATION = 200.0 # steps/s²
+MIN_RATE = 1.0 # steps/s, anything slower counts as stopped
+PULSE_WIDTH = 0.0002 # s the step pin stays low between steps
+MOVE_RATE = 100.0 # steps/s a relative move cruises at
+RAMP_SAMPLES = 4096
+MAX_SPEED = 100
+
+
+@lru_cache(maxsize=None)
+def ramp_intervals(start_rate: float, target_rate: float, acceleration: float=DEFAULT_ACCELERATION, profile: str=PROFILE_TRAPEZOIDAL) -> tuple:
+	# Time between consecutive steps taking the motor from start_rate to
+	# target_rate (steps/s). Position over time is integrated in closed form
+	# and each step fires when it crosses the next whole step.
+	if profile not in PROFILES:
+		raise ValueError(f'Unknown motion profile: {profile}')
+	delta = target_rate - start_rate
+	if abs(delta) < MIN_RATE:
+		return ()
+	duration = abs(delta) / acceleration
+	if profile == PROFILE_S_CURVE:
+		# Smoothstep velocity peaks at 1.5x the mean acceleration
+		duration *= 1.5
+	t = np.linspace(0, duration, RAMP_SAMPLES)
+	s = t / duration
+	if profile == PROFILE_S_CURVE:
+		position = start_rate * t + delta * duration * (s ** 3 - s ** 4 / 2)
+	else:
+		position = start_rate * t + delta * duration * s ** 2 / 2
+	steps = np.arange(1, int(position[-1]) + 1)
+	times = np.interp(steps, position, t)
+	return tuple(np.diff(times, prepend=0.0).tolist())
+
+
+class MotionPlanner():
+	# Maps speed percentages to step rates and hands out the step interval
+	# table for every (start, target) speed pair, computed once per pair.
+	def __init__(self, rate_for_speed: Callable[[int], float], acceleration: float=DEFAULT_ACCELERATION, profile: str=PROFILE_TRAPEZOIDAL) -> None:
+		if profile not in PROFILES:
+			raise ValueError(f'Unknown motion profile: {profile}')
+		self.acceleration = acceleration
+		self.profile = profile
+		self.rates = np.array([rate_for_speed(speed) for speed in range(MAX_SPEED + 1)])
+
+	def rate(self, speed: int) -> float:
+		return float(self.rates[speed])
+
+	def speed_for_rate(self, rate: float) -> int:
+		# Nearest speed, used to re-plan from the middle of a ramp
+		return int(np.argmin(np.abs(self.rates - rate)))
+
+	def plan(self, start: int, target: int) -> tuple:
+		return ramp_intervals(self.rate(start), self.rate(target), self.acceleration, self.profile)
+
+	def precompute(self) -> None:
+		for start in range(MAX_SPEED + 1):
+			for target in range(MAX_SPEED + 1):
+				self.plan(start, target)
+
+
+class StepGenerator(Thread):
+	# Pulses a stepper driver's step pin at the planned intervals. A new target
+	# speed is reached through a ramp from the current rate, a direction change
+	# ramps down to a stop before flipping the direction pin. Only this thread
+	# drives the step and direction pins.
+	def __init__(self, step_device, dir_device, planner: MotionPlanner) -> None:
+		super().__init__(name="Step Generator Thread", daemon=True)
+		self.keep_running = True
+		self.step_device = step_device
+		self.dir_device = dir_device
+		self.planner = planner
+		self.rate = 0.0
+		self.dir = 0
+		self.target = (0, 0) # dir, speed
+		self._move = None # step count of a relative move not planned yet
+		self._version = 0
+		self._condition = Condition()
+
+	def set(self, dir: int, speed: int) -> None:
+		with self._condition:
+			# A relative move still running is always cancelled
+			if self._move is None and ((dir, speed) == self.target or (speed == 0 and self.target[1] == 0)):
+				return
+			self.target = (dir, speed)
+			self._move = None
+			self._version += 1
+			self._condition.notify()
+
+	def stop(self) -> None:
+		# Immediate stop without ramping, for sleep and emergencies
+		with self._condition:
+			self.target = (self.dir, 0)
+			self.rate = 0.0
+			self._move = None
+			self._version += 1
+			self._condition.notify()
+
+	def move(self, dir: int, count: int) -> None:
+		# Ramps down whatever runs now, then takes count steps and holds
+		with self._condition:
+			self.target = (dir, 0)
+			self._move = count
+			self._version += 1
+			self._condition.notify()
+
+	def run(self) -> None:
+		version = None
+		steps = iter(())
+		deadline = time.perf_counter()
+		while self.keep_running:
+			with self._condition:
+				if self._version == version and self.rate == 0:
+					self._condition.wait()
+					deadline = time.perf_counter()
+					continue
+				if self._version != version:
+					version = self._version
+					steps = self._plan(*self.target) if self._move is None else self._plan_move(self.target[0], self._move)
+			step = next(steps, None)
+			if step is None:
+				with self._condition:
+					if self._version == version:
+						self._move = None
+				self.rate = 0.0
+				continue
+			dir, interval = step
+			if dir != self.dir:
+				self.dir = dir
+				self.dir_device.value = dir
+			deadline += interval
+			with self._condition:
+				# A new target interrupts the wait and is planned from the current
+				# rate. The pulse is under the lock too, so nothing steps after
+				# stop() returned.
+				self._condition.wait_for(lambda: self._version != version or not self.keep_running, max(0, deadline - time.perf_counter() - PULSE_WIDTH))
+				if self._version != version or not self.keep_running:
+					deadline = time.perf_counter()
+					continue
+				self.step_device.off()
+				time.sleep(PULSE_WIDTH)
+				self.step_device.on()
+				self.rate = 1 / interval
+
+	def _plan(self, dir: int, speed: int):
+		start = self.planner.speed_for_rate(self.rate)
+		if self.rate and dir != self.dir:
+			for interval in self.planner.plan(start, 0):
+				yield self.dir, interval
+			start = 0
+		for interval in self.planner.plan(start, speed):
+			yield dir, interval
+		rate = self.planner.rate(speed)
+		if rate < MIN_RATE:
+			return
+		logger.debug('Cruising at %.1f steps/s', rate)
+		while True:
+			yield dir, 1 / rate
+
+	def _plan_move(self, dir: int, count: int):
+		# The steps ramping down the current motion don't count. A move too
+		# short to reach MOVE_RATE turns around halfway through the ramps.
+		for interval in self.planner.plan(self.planner.speed_for_rate(self.rate), 0):
+			yield self.dir, interval
+		speed = self.planner.speed_for_rate(MOVE_RATE)
+		up = self.planner.plan(0, speed)[:count // 2]
+		down = self.planner.plan(speed, 0)
+		down = down[max(0, len(down) - (count - len(up))):]
+		for interval in up:
+			yield dir, interval
+		for _ in range(count - len(up) - len(down)):
+			yield dir, 1 / self.planner.rate(speed)
+		for interval in down:
+			yield dir, interval
+
+	def quit(self) -> None:
+		with self._condition:
+			self.keep_running = False
+			self._condition.notify()
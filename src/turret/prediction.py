@@ -0,0 +1,81 @@
+from threading import Lock
+from typing import Optional
+
+import numpy as np
+
+# Tuned in display pixels: a person walking across the frame accelerates by a
+# couple thousand px/s², trackers jitter by a few px.
+ACCELERATION_NOISE = 2000.0 # px/s², std of the unmodelled acceleration
+MEASUREMENT_NOISE = 4.0 # px, std of the tracker's centre estimate
+INITIAL_VELOCITY_STD = 500.0 # px/s
+MAX_HORIZON = 0.5 # s, extrapolating further mostly amplifies noise
+
+
+class TargetPredictor():
+	# Constant velocity Kalman filter over the target centre. Updated from the
+	# tracking thread with capture timestamps, so network jitter does not show
+	# up as target motion, and read from the steering loop, which asks where
+	# the target will be once the command reaches the motors.
+	#
+	# state: x, y, vx, vy
+	H = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=np.float64)
+
+	def __init__(self, acceleration_noise: float=ACCELERATION_NOISE, measurement_noise: float=MEASUREMENT_NOISE) -> None:
+		self.acceleration_noise = acceleration_noise
+		self.R = np.eye(2) * measurement_noise ** 2
+		self._lock = Lock()
+		self.reset()
+
+	def reset(self) -> None:
+		with self._lock:
+			self.state = None
+			self.P = None
+			self.timestamp = None
+
+	def update(self, position: tuple, timestamp: float) -> None:
+		z = np.array(position, dtype=np.float64)
+		with self._lock:
+			if self.state is None:
+				self.state = np.array([z[0], z[1], 0.0, 0.0])
+				self.P = np.diag([self.R[0, 0], self.R[1, 1], INITIAL_VELOCITY_STD ** 2, INITIAL_VELOCITY_STD ** 2])
+				self.timestamp = timestamp
+				return
+			dt = timestamp - self.timestamp
+			if dt > 0:
+				F, Q = self._transition(dt)
+				self.state = F @ self.state
+				self.P = F @ self.P @ F.T + Q
+				self.timestamp = timestamp
+			innovation = z - self.H @ self.state
+			S = self.H @ self.P @ self.H.T + self.R
+			K = self.P @ self.H.T @ np.linalg.inv(S)
+			self.state = self.state + K @ innovation
+			self.P = (np.eye(4) - K @ self.H) @ self.P
+
+	def predict(self, horizon: float) -> Optional[tuple]:
+		# Position `horizon` seconds after the latest update, None before the first one
+		with self._lock:
+			if self.state is None:
+				return None
+			horizon = min(max(horizon, 0.0), MAX_HORIZON)
+			x, y, vx, vy = self.state
+		return (x + vx * horizon, y + vy * horizon)
+
+	@property
+	def velocity(self) -> tuple:
+		with self._lock:
+			if self.state is None:
+				return (0.0, 0.0)
+			return tuple(self.state[2:])
+
+	def _transition(self, dt: float) -> tuple:
+		F = np.array([
+			[1, 0, dt, 0],
+			[0, 1, 0, dt],
+			[0, 0, 1, 0],
+			[0, 0, 0, 1],
+		], dtype=np.float64)
+		# Piecewise constant white noise acceleration
+		G = np.array([[dt * dt / 2, 0], [0, dt * dt / 2], [dt, 0], [0, dt]])
+		Q = G @ G.T * self.acceleration_noise ** 2
+		return F, Q
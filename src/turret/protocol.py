@@ -0,0 +1,157 @@
+import socket
+import struct
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+# Steering protocol shared by the pin service, the TCP stepper and the PC
+# controllers. Every message of a given version has the same size and the
+# version follows the token, so a byte stream can be split into messages
+# without any delimiter. Version 2 appends the timestamps used for latency
+# metrics, version 1 messages are still accepted and answered in kind.
+#
+# token, version, flags, sequence, yaw, pitch[, captured, sent]
+COMMAND_STRUCTS = {
+	1: struct.Struct('<4sBBIii'),
+	2: struct.Struct('<4sBBIiidd'),
+}
+COMMAND_PREFIX_SIZE = 5 # token, version
+# version, status, sequence[, applied]
+ACK_STRUCTS = {
+	1: struct.Struct('<BBI'),
+	2: struct.Struct('<BBId'),
+}
+PROTOCOL_VERSION = 2
+COMMAND_STRUCT = COMMAND_STRUCTS[PROTOCOL_VERSION]
+ACK_STRUCT = ACK_STRUCTS[PROTOCOL_VERSION]
+TOKEN = b'dupa'
+SEQUENCE_MASK = 0xFFFFFFFF
+
+FLAG_YAW = 0x01 # yaw value present
+FLAG_PITCH = 0x02 # pitch value present
+FLAG_YAW_STEPS = 0x04 # yaw value is a step count, not a speed percentage
+FLAG_PITCH_STEPS = 0x08 # as above
+FLAG_SLEEP = 0x10 # emergency shutdown
+
+STATUS_OK = 0
+STATUS_BAD_TOKEN = 1
+STATUS_INVALID = 2 # wrong size or protocol version
+STATUS_SUPERSEDED = 3 # a newer command set the same axes before this one was applied
+
+
+class ProtocolError(ValueError):
+	pass
+
+
+@dataclass()
+class SteeringCommand():
+	yaw: Optional[int] = None # None leaves the motor alone
+	pitch: Optional[int] = None # as above
+	yaw_steps: bool = False # yaw is a step count instead of a speed
+	pitch_steps: bool = False # as above
+	sleep: bool = False # emergency shutdown
+	sequence: int = 0
+	token: bytes = TOKEN
+	captured: float = 0.0 # capture time of the frame the command follows, 0 if none
+	sent: float = 0.0 # stamped by pack when left at 0
+	version: int = PROTOCOL_VERSION
+
+	def pack(self) -> bytes:
+		flags = 0
+		if self.yaw is not None:
+			flags |= FLAG_YAW
+		if self.pitch is not None:
+			flags |= FLAG_PITCH
+		if self.yaw_steps:
+			flags |= FLAG_YAW_STEPS
+		if self.pitch_steps:
+			flags |= FLAG_PITCH_STEPS
+		if self.sleep:
+			flags |= FLAG_SLEEP
+		if self.version not in COMMAND_STRUCTS:
+			raise ProtocolError(f'Unsupported protocol version: {self.version}')
+		values = [self.token, self.version, flags, self.sequence & SEQUENCE_MASK, self.yaw or 0, self.pitch or 0]
+		if self.version >= 2:
+			values += [self.captured, self.sent or time.time()]
+		return COMMAND_STRUCTS[self.version].pack(*values)
+
+	@classmethod
+	def unpack(cls, buffer) -> 'SteeringCommand':
+		if len(buffer) < COMMAND_PREFIX_SIZE:
+			raise ProtocolError(f'Invalid command size: {len(buffer)}')
+		version = buffer[4]
+		if len(buffer) != command_size(version):
+			raise ProtocolError(f'Invalid command size: {len(buffer)}')
+		token, version, flags, sequence, yaw, pitch, *timestamps = COMMAND_STRUCTS[version].unpack(buffer)
+		captured, sent = timestamps or (0.0, 0.0)
+		return cls(
+			yaw=yaw if flags & FLAG_YAW else None,
+			pitch=pitch if flags & FLAG_PITCH else None,
+			yaw_steps=bool(flags & FLAG_YAW_STEPS),
+			pitch_steps=bool(flags & FLAG_PITCH_STEPS),
+			sleep=bool(flags & FLAG_SLEEP),
+			sequence=sequence,
+			token=token,
+			captured=captured,
+			sent=sent,
+			version=version
+		)
+
+
+class SequenceCounter():
+	def __init__(self) -> None:
+		self.value = 0
+
+	def next(self) -> int:
+		value = self.value
+		self.value = (self.value + 1) & SEQUENCE_MASK
+		return value
+
+
+def command_size(version: int) -> int:
+	try:
+		return COMMAND_STRUCTS[version].size
+	except KeyError:
+		raise ProtocolError(f'Unsupported protocol version: {version}') from None
+
+def pack_ack(sequence: int, status: int=STATUS_OK, applied: float=0.0, version: int=PROTOCOL_VERSION) -> bytes:
+	# Answer in the version of the command, older senders expect the short ack
+	if version == 1:
+		return ACK_STRUCTS[1].pack(version, status, sequence & SEQUENCE_MASK)
+	return ACK_STRUCT.pack(PROTOCOL_VERSION, status, sequence & SEQUENCE_MASK, applied)
+
+def unpack_ack(buffer) -> tuple:
+	# Returns status, sequence and the time the command was applied (0 if unknown)
+	if not len(buffer):
+		raise ProtocolError('Empty ack')
+	version = buffer[0]
+	if version not in ACK_STRUCTS:
+		raise ProtocolError(f'Unsupported protocol version: {version}')
+	if len(buffer) != ACK_STRUCTS[version].size:
+		raise ProtocolError(f'Invalid ack size: {len(buffer)}')
+	version, status, sequence, *applied = ACK_STRUCTS[version].unpack(buffer)
+	return status, sequence, applied[0] if applied else 0.0
+
+def sequence_gap(sequence: int, last_sequence: Optional[int]) -> int:
+	# Number of commands missed between the two, 0 when consecutive
+	if last_sequence is None:
+		return 0
+	return ((sequence - last_sequence) & SEQUENCE_MASK) - 1
+
+def recv_command(sock: socket.socket, buffer: bytearray=None) -> Optional[SteeringCommand]:
+	# Reads exactly one command from a stream socket, None once the peer closed.
+	# TCP may split or coalesce messages, so never rely on a single recv.
+	# The prefix tells the version and with it the size of the rest.
+	if buffer is None:
+		buffer = bytearray(COMMAND_STRUCT.size) # the current version is the largest
+	view = memoryview(buffer)
+	received = 0
+	size = COMMAND_PREFIX_SIZE
+	while received < size:
+		nbytes = sock.recv_into(view[received:], size - received)
+		if not nbytes:
+			return None
+		received += nbytes
+		if size == COMMAND_PREFIX_SIZE and received >= COMMAND_PREFIX_SIZE:
+			size = command_size(buffer[4])
+	return SteeringCommand.unpack(view[:size])
@@ -0,0 +1,133 @@
+import json
+import logging
+import struct
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from turret.capture import CapturedFrame
+
+logger = logging.getLogger()
+
+# A recording is a directory holding raw frames back to back (memory-mappable,
+# every frame has the same dtype and shape), an index of capture timestamps
+# and sequence numbers, and the frame format. Both data files are append-only,
+# so a recording cut short by a crash is still readable.
+RECORDING_FRAMES = 'frames.raw'
+RECORDING_INDEX = 'index.bin'
+RECORDING_META = 'meta.json'
+INDEX_STRUCT = struct.Struct('<Qd') # sequence, timestamp
+INDEX_DTYPE = np.dtype([('sequence', '<u8'), ('timestamp', '<f8')])
+REPLAY_RECORDED = 'recorded' # keep the recorded frame timing
+REPLAY_MAX = 'max' # as fast as the consumer reads
+REPLAY_SPEEDS = (REPLAY_RECORDED, REPLAY_MAX)
+
+
+class FrameRecorder():
+	def __init__(self, path) -> None:
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self._frames = open(self.path / RECORDING_FRAMES, 'wb')
+		self._index = open(self.path / RECORDING_INDEX, 'wb')
+		self.format = None
+		self.count = 0
+		logger.info('Recording frames to %s', self.path)
+
+	def write(self, frame: np.ndarray, timestamp: float=None, sequence: int=None) -> None:
+		frame_format = (str(frame.dtype), frame.shape)
+		if self.format is None:
+			self.format = frame_format
+			meta = dict(dtype=frame_format[0], shape=frame_format[1], created=time.time())
+			(self.path / RECORDING_META).write_text(json.dumps(meta))
+		elif frame_format != self.format:
+			raise ValueError(f'Frame format changed mid-recording: {self.format} -> {frame_format}')
+		self._frames.write(np.ascontiguousarray(frame).data)
+		self._index.write(INDEX_STRUCT.pack(
+			self.count if sequence is None else sequence,
+			time.time() if timestamp is None else timestamp
+		))
+		self.count += 1
+
+	def close(self) -> None:
+		self._frames.close()
+		self._index.close()
+		logger.info('Recorded %d frames to %s', self.count, self.path)
+
+
+class FrameReplay():
+	# Stands in for VideoCapture. Frames come from a memory map, so replay at
+	# REPLAY_MAX costs little more than a copy and runs are repeatable.
+	def __init__(self, path, speed: str=REPLAY_RECORDED, loop: bool=False) -> None:
+		if speed not in REPLAY_SPEEDS:
+			raise ValueError(f'Unknown replay speed: {speed}')
+		self.path = Path(path)
+		self.speed = speed
+		self.loop = loop
+		meta = json.loads((self.path / RECORDING_META).read_text())
+		dtype = np.dtype(meta['dtype'])
+		shape = tuple(meta['shape'])
+		frame_size = dtype.itemsize * int(np.prod(shape))
+		index = np.fromfile(self.path / RECORDING_INDEX, dtype=INDEX_DTYPE)
+		count = min(len(index), (self.path / RECORDING_FRAMES).stat().st_size // frame_size)
+		self.index = index[:count]
+		self.frames = np.memmap(self.path / RECORDING_FRAMES, dtype=dtype, mode='r', shape=(count, *shape)) if count else None
+		self.height, self.width = shape[:2]
+		duration = self.index['timestamp'][-1] - self.index['timestamp'][0] if count > 1 else 0
+		self.fps = (count - 1) / duration if duration > 0 else 0
+		self.position = 0
+		self._clock = None
+		logger.debug('Opened recording %s: %d frames %dx%d@%.1ffps', self.path, count, self.width, self.height, self.fps)
+
+	def __len__(self) -> int:
+		return len(self.index)
+
+	def is_valid(self):
+		return self.frames is not None
+
+	def get_frame_dimensions(self):
+		return (self.width, self.height)
+
+	def read(self):
+		captured = self.read_captured()
+		if captured is None:
+			return False, None
+		return True, captured.frame
+
+	def read_captured(self, wait_for_new: bool=False, timeout: Optional[float]=None) -> Optional[CapturedFrame]:
+		if self.frames is None:
+			return None
+		if self.position >= len(self.index):
+			if not self.loop:
+				return None
+			self.position = 0
+			self._clock = None
+		sequence, timestamp = self.index[self.position]
+		if self.speed == REPLAY_RECORDED:
+			self._wait_until(timestamp)
+		# Copy out of the map, consumers draw into the frames they get
+		frame = np.array(self.frames[self.position])
+		self.position += 1
+		return CapturedFrame(frame, float(timestamp), int(sequence))
+
+	def delay(self) -> Optional[float]:
+		# Seconds until the next frame is due, for callers that schedule reads
+		# themselves instead of letting read_captured sleep. None once over.
+		if self.frames is None or (self.position >= len(self.index) and not self.loop):
+			return None
+		if self.speed != REPLAY_RECORDED or self._clock is None or self.position >= len(self.index):
+			return 0.0
+		timestamp = self.index['timestamp'][self.position]
+		return max(0.0, float(timestamp - self._clock[1]) - (time.monotonic() - self._clock[0]))
+
+	def _wait_until(self, timestamp: float) -> None:
+		if self._clock is None:
+			self._clock = (time.monotonic(), timestamp)
+			return
+		delay = (timestamp - self._clock[1]) - (time.monotonic() - self._clock[0])
+		if delay > 0:
+			time.sleep(delay)
+
+	def close(self):
+		self.frames = None
@@ -0,0 +1,75 @@
+import logging
+import time
+from collections import deque
+from threading import Condition, Thread
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger()
+
+RENDER_FPS = 60 # redraws per second at most, about what a monitor shows
+
+
+# Owns the window: shows the latest frame handed to show() at most `fps`
+# times a second and pumps the window system's events in between, so neither
+# redraws nor the event loop ever hold up whoever produces the frames. A frame
+# handed in while another one waits replaces it. Frames are not copied, so the
+# caller must not draw into them afterwards. Keys pressed in the window are
+# queued for keys().
+class RenderThread(Thread):
+	def __init__(self, window_name: str, fps: float=RENDER_FPS) -> None:
+		super().__init__(name="Render Thread", daemon=True)
+		self.window_name = window_name
+		self.period = 1 / fps
+		self.keep_running = True
+		self.rendered = 0
+		self.skipped = 0 # frames replaced before they were shown
+		self._condition = Condition()
+		self._frame = None
+		self._keys = deque()
+
+	def show(self, frame: np.ndarray) -> None:
+		with self._condition:
+			if self._frame is not None:
+				self.skipped += 1
+			self._frame = frame
+			self._condition.notify()
+
+	def keys(self) -> list:
+		# Keys pressed since the last call, oldest first
+		keys = []
+		while self._keys:
+			keys.append(self._keys.popleft())
+		return keys
+
+	def run(self) -> None:
+		# HighGUI wants the window created, drawn and pumped on one thread
+		cv2.namedWindow(self.window_name)
+		cv2.setWindowProperty(self.window_name, cv2.WND_PROP_AUTOSIZE, cv2.WINDOW_AUTOSIZE)
+		try:
+			self._run()
+		finally:
+			cv2.destroyWindow(self.window_name)
+			logger.debug('Rendered %d frames, skipped %d', self.rendered, self.skipped)
+
+	def _run(self) -> None:
+		shown = time.monotonic()
+		while self.keep_running:
+			with self._condition:
+				self._condition.wait_for(lambda: self._frame is not None or not self.keep_running, self.period)
+				frame, self._frame = self._frame, None
+			if frame is not None:
+				cv2.imshow(self.window_name, frame)
+				self.rendered += 1
+				shown = time.monotonic()
+			# Sleeps out the rest of the frame period in the event loop, which
+			# also caps the redraw rate
+			key = cv2.waitKeyEx(max(1, round((shown + self.period - time.monotonic()) * 1000)))
+			if key != -1:
+				self._keys.append(key)
+
+	def quit(self) -> None:
+		with self._condition:
+			self.keep_running = False
+			self._condition.notify()
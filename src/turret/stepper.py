@@ -12,12 +12,14 @@
 # 20 STEP
 # 21 DIR
 
-import json
 import socket
 from threading import Thread
 
 from gpiozero import DigitalOutputDevice
 
+from turret.motion import PULSE_WIDTH, MotionPlanner, StepGenerator
+from turret.protocol import COMMAND_STRUCT, TOKEN, ProtocolError, recv_command
+
 
 def create_mapping_function(input_min: int, input_max: int, output_min: int, output_max: int):
 	input_span = input_max - input_min
@@ -32,6 +34,12 @@ def create_mapping_function(input_min: int, input_max: int, output_min: int, out
 	return mapper
 
 percent_to_on_time = create_mapping_function(0, 100, -0.05, -0.0018)
+ACCELERATION = 1000 # steps/s²
+
+def speed_to_rate(speed):
+	if speed == 0:
+		return 0.0
+	return 1 / (abs(percent_to_on_time(speed)) + PULSE_WIDTH)
 
 
 class Stepper():
@@ -44,8 +52,11 @@ class Stepper():
 		self._step.off()
 		self._dir = DigitalOutputDevice(dir_pin)
 		self._dir.off()
+		self._generator = StepGenerator(self._step, self._dir, MotionPlanner(speed_to_rate, ACCELERATION))
+		self._generator.start()
 
 	def sleep(self):
+		self._generator.stop()
 		self._sleep.off()
 
 	def wake(self):
@@ -53,26 +64,19 @@ class Stepper():
 
 	def steps(self, dir, count):
 		self.wake()
-		self._dir.value = dir
-		self._step.blink(0.0001, 0.0005, count)
+		self._generator.move(dir, count)
 
 	def set(self, dir, speed):
 		if not 0 <= speed <= 100:
 			print("Received invalid speed value", speed)
 			return
-		if speed == 0:
-			self.stop()
-			return
-		on_time = abs(percent_to_on_time(speed))
+		# Ramps to the new speed, 0 ramps down to a stop
 		self.wake()
-		self._dir.value = dir
-		self._step.blink(on_time, 0.0002)
-		print(on_time)
+		self._generator.set(dir, speed)
+		print(speed_to_rate(speed))
 
 	def stop(self):
-		self.wake()
-		self._dir.value = 0
-		self._step.value = 0
+		self._generator.stop()
 
 motor_1 = Stepper(5, 6, 13, 19)
 
@@ -103,11 +107,27 @@ while True:
 	print('waiting for connection')
 	(client, addr) = serversocket.accept()
 	print('got connection')
-	while payload := client.recv(1024):
-		payload = json.loads(payload.decode())
-
-		h_dir = payload['horizontal'] < 0
-		h_spd = abs(payload['horizontal'])
+	buffer = bytearray(COMMAND_STRUCT.size)
+	while True:
+		try:
+			command = recv_command(client, buffer)
+		except ProtocolError as e:
+			# Framing is lost, the peer has to reconnect
+			print("Invalid command:", e)
+			break
+		if command is None:
+			break
+		if command.token != TOKEN:
+			print("Invalid token", command.token)
+			continue
+		if command.sleep:
+			motor_1.sleep()
+			continue
+		if command.yaw is None:
+			continue
+
+		h_dir = command.yaw < 0
+		h_spd = abs(command.yaw)
 
 		motor_1.set(h_dir, h_spd)
 
@@ -127,4 +147,5 @@ while True:
 		# prev_up = up
 		# prev_down = down
 		# prev_cross = cross
+	client.close()
 	motor_1.sleep()
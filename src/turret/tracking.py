@@ -0,0 +1,392 @@
+import argparse
+import logging
+import time
+from functools import partial
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger()
+
+DEFAULT_TRACKING_SCALE = 1.0
+DEFAULT_TRACKER = 'csrt'
+KEYFRAME_LOAD = 0.5 # share of the frame budget tracking may take on average
+MAX_KEYFRAME_INTERVAL = 8 # frames, flow drifts too far beyond this
+SMOOTHING = 0.1 # weight of the newest sample in the running averages
+MAX_FRAME_GAP = 1.0 # seconds between frames that are a pause rather than the frame period
+
+
+def parse_tracking_scale(value: str) -> float:
+	# argparse type, ScaledTracker refuses anything else
+	scale = float(value)
+	if not 0 < scale <= 1:
+		raise argparse.ArgumentTypeError(f'tracking scale must fit between 0 and 1, got {value}')
+	return scale
+
+def scale_bbox(bbox, scale_x: float, scale_y: float) -> tuple:
+	x, y, w, h = bbox
+	return (round(x * scale_x), round(y * scale_y), round(w * scale_x), round(h * scale_y))
+
+
+class LucasKanadeTracker():
+	# Follows sparse feature points inside the bbox with pyramidal Lucas-Kanade
+	# optical flow. Much cheaper than the correlation filters, but drifts and
+	# has no notion of the target's appearance. Points failing the
+	# forward-backward check are discarded, the bbox moves by the median
+	# displacement and scales by the median change of point spread.
+	MAX_POINTS = 50
+	MIN_POINTS = 5
+	MAX_FB_ERROR = 1.0
+	LK_PARAMS = dict(
+		winSize=(15, 15),
+		maxLevel=3,
+		criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+	)
+
+	def __init__(self) -> None:
+		self.bbox = None
+		self.points = None
+		self.gray = None
+
+	def init(self, frame: np.ndarray, bbox) -> bool:
+		self.gray = self._to_gray(frame)
+		self.bbox = tuple(float(v) for v in bbox)
+		self.points = self._find_points(self.gray, self.bbox)
+		return self.points is not None
+
+	def update(self, frame: np.ndarray):
+		gray = self._to_gray(frame)
+		if self.points is None or len(self.points) < self.MIN_POINTS:
+			return False, self._int_bbox()
+		points, status, _ = cv2.calcOpticalFlowPyrLK(self.gray, gray, self.points, None, **self.LK_PARAMS)
+		back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.gray, points, None, **self.LK_PARAMS)
+		fb_error = np.linalg.norm((self.points - back).reshape(-1, 2), axis=1)
+		good = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < self.MAX_FB_ERROR)
+		self.gray = gray
+		if good.sum() < self.MIN_POINTS:
+			self.points = None
+			return False, self._int_bbox()
+		old = self.points[good].reshape(-1, 2)
+		new = points[good].reshape(-1, 2)
+		dx, dy = np.median(new - old, axis=0)
+		old_spread = np.linalg.norm(old - old.mean(axis=0), axis=1)
+		new_spread = np.linalg.norm(new - new.mean(axis=0), axis=1)
+		valid = old_spread > 1e-3
+		scale = float(np.median(new_spread[valid] / old_spread[valid])) if valid.any() else 1.0
+		x, y, w, h = self.bbox
+		cx = x + w / 2 + dx
+		cy = y + h / 2 + dy
+		w *= scale
+		h *= scale
+		self.bbox = (cx - w / 2, cy - h / 2, w, h)
+		self.points = new.reshape(-1, 1, 2)
+		if len(self.points) < self.MAX_POINTS // 2:
+			# Top up with fresh features so the tracker doesn't starve
+			fresh = self._find_points(gray, self.bbox)
+			if fresh is not None:
+				self.points = fresh
+		return True, self._int_bbox()
+
+	def _find_points(self, gray: np.ndarray, bbox):
+		x, y, w, h = (int(round(v)) for v in bbox)
+		x0, y0 = max(0, x), max(0, y)
+		roi = gray[y0:y + h, x0:x + w]
+		if roi.size == 0:
+			return None
+		points = cv2.goodFeaturesToTrack(roi, self.MAX_POINTS, 0.01, 3)
+		if points is None:
+			return None
+		points += np.array([x0, y0], dtype=np.float32)
+		return points
+
+	def _int_bbox(self) -> tuple:
+		return tuple(int(round(v)) for v in self.bbox)
+
+	@staticmethod
+	def _to_gray(frame: np.ndarray) -> np.ndarray:
+		if frame.ndim == 2:
+			return frame
+		return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def create_opencv_tracker(name: str):
+	# Depending on the OpenCV build some trackers only live in cv2.legacy
+	for module in (cv2, getattr(cv2, 'legacy', None)):
+		factory = getattr(module, f'Tracker{name}_create', None)
+		if factory is not None:
+			return factory()
+	raise ValueError(f'This OpenCV build has no {name} tracker')
+
+TRACKER_BACKENDS = {
+	'csrt': partial(create_opencv_tracker, 'CSRT'),
+	'kcf': partial(create_opencv_tracker, 'KCF'),
+	'mosse': partial(create_opencv_tracker, 'MOSSE'),
+	'lk': LucasKanadeTracker,
+}
+TRACKERS = tuple(TRACKER_BACKENDS)
+
+def create_tracker(name: str=DEFAULT_TRACKER):
+	try:
+		return TRACKER_BACKENDS[name]()
+	except KeyError:
+		raise ValueError(f'Unknown tracker: {name}') from None
+
+def next_tracker(name: str) -> str:
+	return TRACKERS[(TRACKERS.index(name) + 1) % len(TRACKERS)]
+
+
+class AppearanceCheck():
+	# Confidence in a tracker's bbox, which the OpenCV trackers don't report:
+	# normalised cross-correlation of the patch under the bbox with the one
+	# it was initialised on, both shrunk to a small grey thumbnail.
+	# Cheap enough for every frame. 1 is a perfect match, 0 no resemblance.
+	SIZE = (32, 32)
+
+	def __init__(self) -> None:
+		self.template = None
+
+	def init(self, frame: np.ndarray, bbox) -> None:
+		self.template = self._patch(frame, bbox)
+
+	def score(self, frame: np.ndarray, bbox) -> float:
+		patch = self._patch(frame, bbox)
+		if patch is None or self.template is None:
+			return 0.0
+		score = cv2.matchTemplate(patch, self.template, cv2.TM_CCOEFF_NORMED)[0, 0]
+		# Flat patches have no variance to correlate
+		return float(np.clip(np.nan_to_num(score), 0.0, 1.0))
+
+	def _patch(self, frame: np.ndarray, bbox):
+		height, width = frame.shape[:2]
+		x, y, w, h = (int(round(v)) for v in bbox)
+		x0, y0 = max(0, x), max(0, y)
+		x1, y1 = min(width, x + w), min(height, y + h)
+		if x1 <= x0 or y1 <= y0:
+			return None
+		patch = cv2.resize(frame[y0:y1, x0:x1], self.SIZE, interpolation=cv2.INTER_AREA)
+		return LucasKanadeTracker._to_gray(patch)
+
+
+def smooth(average, value: float) -> float:
+	return value if average is None else average + SMOOTHING * (value - average)
+
+
+class KeyframeSchedule():
+	# How often the heavy tracker runs: the smallest interval that keeps the
+	# average cost per frame within KEYFRAME_LOAD of the frame budget, going by
+	# running averages of what keyframes and flow frames cost. The budget is
+	# the time between frames unless one is given.
+	def __init__(self, budget: float=None, max_interval: int=MAX_KEYFRAME_INTERVAL) -> None:
+		self.budget = budget
+		self.max_interval = max_interval
+		self.interval = 1
+		self.period = None
+		self.costs = {True: None, False: None} # keyframe or not -> seconds
+		self.frames = 0
+		self.keyframes = 0
+		self._last_frame = None
+
+	def frame(self) -> None:
+		# Called as every frame comes in
+		now = time.perf_counter()
+		if self._last_frame is not None and now - self._last_frame < MAX_FRAME_GAP:
+			self.period = smooth(self.period, now - self._last_frame)
+		self._last_frame = now
+		self.frames += 1
+
+	def observe(self, keyframe: bool, cost: float) -> None:
+		self.keyframes += keyframe
+		self.costs[keyframe] = smooth(self.costs[keyframe], cost)
+		heavy, light = self.costs[True], self.costs[False]
+		budget = self.budget or self.period
+		if budget is None:
+			return
+		if light is None:
+			# Nothing to compare with until a flow frame was timed
+			self.interval = 1 if heavy <= budget * KEYFRAME_LOAD else 2
+			return
+		allowed = budget * KEYFRAME_LOAD
+		if allowed <= light:
+			self.interval = self.max_interval
+			return
+		# (heavy + (n - 1) * light) / n <= allowed
+		self.interval = int(min(self.max_interval, max(1, np.ceil((heavy - light) / (allowed - light)))))
+
+
+class KeyframeTracker():
+	# Runs the heavy tracker on keyframes only and carries the bbox over the
+	# frames in between with LucasKanadeTracker, re-seeded on every keyframe.
+	# A flow frame that loses its points, or whose bbox no longer looks like
+	# the target did on the last keyframe, is handed to the heavy tracker.
+	MIN_CONFIDENCE = 0.5
+
+	def __init__(self, heavy, schedule: KeyframeSchedule) -> None:
+		self.heavy = heavy
+		self.schedule = schedule
+		self.flow = LucasKanadeTracker()
+		self.check = AppearanceCheck()
+		self.since_keyframe = 0
+
+	def init(self, frame: np.ndarray, bbox) -> None:
+		self.heavy.init(frame, bbox)
+		self._reseed(frame, bbox)
+
+	def update(self, frame: np.ndarray):
+		self.schedule.frame()
+		if self.since_keyframe + 1 < self.schedule.interval:
+			start = time.perf_counter()
+			ret, bbox = self.flow.update(frame)
+			ret = ret and self.check.score(frame, bbox) >= self.MIN_CONFIDENCE
+			self.schedule.observe(False, time.perf_counter() - start)
+			if ret:
+				self.since_keyframe += 1
+				return True, bbox
+		start = time.perf_counter()
+		ret, bbox = self.heavy.update(frame)
+		if ret:
+			self._reseed(frame, bbox)
+		self.schedule.observe(True, time.perf_counter() - start)
+		return ret, bbox
+
+	def _reseed(self, frame: np.ndarray, bbox) -> None:
+		self.flow.init(frame, bbox)
+		self.check.init(frame, bbox)
+		self.since_keyframe = 0
+
+
+class ScaledTracker():
+	# Runs a tracker on a downscaled copy of the frame, optionally limited to a
+	# window around the target, and reports bboxes in the coordinates of the
+	# frame it was given. Tracker cost grows with pixel count, so this is where
+	# most of the per-frame CPU goes.
+	#
+	# roi_margin is the window padding on each side of the target, in multiples
+	# of the target size. The window stays put while tracking so the tracker's
+	# motion model is not disturbed, and is re-centred (re-initialising the
+	# tracker) only when the target gets close to its edge.
+	#
+	# Instead of whole frames, update() also takes just the window, cut out and
+	# scaled down by the frame service as asked for by region(). A window due
+	# to move is then only asked for and takes over once it arrives, frames
+	# still cut out for the old one are tracked in it meanwhile.
+	#
+	# With keyframes the backend only runs every few frames, see
+	# KeyframeTracker. The schedule outlives re-initialisations, and with it
+	# what was learnt about the costs.
+	def __init__(self, backend: str=DEFAULT_TRACKER, scale: float=DEFAULT_TRACKING_SCALE, roi_margin: float=None, keyframes: bool=False) -> None:
+		if not 0 < scale <= 1:
+			raise ValueError(f'Tracking scale must fit between 0 and 1, got {scale}')
+		if backend not in TRACKER_BACKENDS:
+			raise ValueError(f'Unknown tracker: {backend}')
+		self.backend = backend
+		self.scale = scale
+		self.roi_margin = roi_margin
+		self.schedule = KeyframeSchedule() if keyframes else None
+		self.tracker = None
+		self.window = None
+		self.requested = None # window the next cut out frames should cover
+		self.frame_size = None
+		self.bbox = None
+		self._scaled = None
+		self._reinit = False
+
+	def set_backend(self, backend: str) -> None:
+		# Takes effect on the next update, which re-initialises on the last bbox
+		if backend not in TRACKER_BACKENDS:
+			raise ValueError(f'Unknown tracker: {backend}')
+		logger.info('Switching tracker to %s', backend)
+		self.backend = backend
+		self._reinit = self.tracker is not None
+
+	def init(self, frame: np.ndarray, bbox) -> None:
+		frame_h, frame_w = frame.shape[:2]
+		self.frame_size = (frame_w, frame_h)
+		self._init(frame, bbox, self._window_around(bbox, frame_w, frame_h) if self.roi_margin else (0, 0, frame_w, frame_h))
+
+	def _init(self, frame: np.ndarray, bbox, window: tuple, cut_out: bool=False) -> None:
+		self.bbox = tuple(int(v) for v in bbox)
+		self.window = self.requested = tuple(window)
+		self.tracker = create_tracker(self.backend)
+		if self.schedule is not None and not isinstance(self.tracker, LucasKanadeTracker):
+			self.tracker = KeyframeTracker(self.tracker, self.schedule)
+		self.tracker.init(self._prepare(frame, cut_out), self._to_tracker(self.bbox))
+		self._reinit = False
+
+	def region(self):
+		# Window and tracker input size the next frame may be cut down to,
+		# None before the first init
+		if self.requested is None:
+			return None
+		return self.requested, self._scaled_size(*self.requested[2:])
+
+	def update(self, frame: np.ndarray, window: tuple=None):
+		# window is set when frame is only that part of the whole frame
+		cut_out = window is not None
+		if cut_out and tuple(window) != self.window:
+			if tuple(window) != self.requested:
+				# Cut out for a window given up on since, nothing to track in
+				return True, self.bbox
+			# The window asked for arrived, move over to it
+			self._init(frame, self.bbox, window, cut_out)
+			return True, self.bbox
+		if self._reinit:
+			self._init(frame, self.bbox, window or self.window, cut_out)
+			return True, self.bbox
+		ret, bbox = self.tracker.update(self._prepare(frame, cut_out))
+		if not ret:
+			return False, self.bbox
+		self.bbox = self._to_frame(bbox)
+		if self.roi_margin and self._near_window_edge(self.bbox, *self.frame_size):
+			if cut_out:
+				# The pixels around the target are not here, ask for them once
+				# and keep tracking in this window until they arrive
+				if self.requested == self.window:
+					self.requested = self._window_around(self.bbox, *self.frame_size)
+			else:
+				self._init(frame, self.bbox, self._window_around(self.bbox, *self.frame_size))
+		return True, self.bbox
+
+	def _scaled_size(self, w: int, h: int) -> tuple:
+		return (max(1, round(w * self.scale)), max(1, round(h * self.scale)))
+
+	def _prepare(self, frame: np.ndarray, cut_out: bool=False) -> np.ndarray:
+		x, y, w, h = self.window
+		view = frame if cut_out else frame[y:y + h, x:x + w]
+		size = self._scaled_size(w, h)
+		if view.shape[:2] == (size[1], size[0]):
+			return view
+		if self._scaled is None or self._scaled.shape[:2] != (size[1], size[0]):
+			self._scaled = np.empty((size[1], size[0]) + frame.shape[2:], frame.dtype)
+		cv2.resize(view, size, dst=self._scaled, interpolation=cv2.INTER_AREA)
+		return self._scaled
+
+	def _to_tracker(self, bbox) -> tuple:
+		x, y, w, h = bbox
+		return scale_bbox((x - self.window[0], y - self.window[1], w, h), self.scale, self.scale)
+
+	def _to_frame(self, bbox) -> tuple:
+		x, y, w, h = scale_bbox(bbox, 1 / self.scale, 1 / self.scale)
+		return (x + self.window[0], y + self.window[1], w, h)
+
+	def _window_around(self, bbox, frame_w: int, frame_h: int) -> tuple:
+		x, y, w, h = bbox
+		pad_x = round(w * self.roi_margin)
+		pad_y = round(h * self.roi_margin)
+		left = max(0, x - pad_x)
+		top = max(0, y - pad_y)
+		right = min(frame_w, x + w + pad_x)
+		bottom = min(frame_h, y + h + pad_y)
+		return (left, top, max(1, right - left), max(1, bottom - top))
+
+	def _near_window_edge(self, bbox, frame_w: int, frame_h: int) -> bool:
+		x, y, w, h = bbox
+		left, top, width, height = self.window
+		# Half of the original padding left, edges on the frame border don't count
+		slack_x = w * self.roi_margin / 2
+		slack_y = h * self.roi_margin / 2
+		return (
+			(left > 0 and x - left < slack_x)
+			or (top > 0 and y - top < slack_y)
+			or (left + width < frame_w and left + width - (x + w) < slack_x)
+			or (top + height < frame_h and top + height - (y + h) < slack_y)
+		)
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The turret package is not installed, see pc/.env. The Pi services are
+# scripts next to each other.
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / 'src'), str(ROOT / 'pi')]
+
+
+class FakeMotor():
+	# Records what a StepperMotor was told to do
+	def __init__(self) -> None:
+		self.calls = []
+
+	def sleep(self):
+		self.calls.append('sleep')
+
+	def speed(self, dir, speed):
+		self.calls.append(('speed', dir, speed))
+
+@pytest.fixture()
+def motors():
+	return FakeMotor(), FakeMotor()
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from edge_tracking import EdgeTracker
+from pin_service import apply_command
+from turret.protocol import SteeringCommand
+
+
+# Textured target left of and above the centre
+FRAME = np.full((240, 320, 3), 40, dtype=np.uint8)
+FRAME[40:100, 40:100] = np.random.default_rng(0).integers(0, 255, (60, 60, 3), dtype=np.uint8)
+
+
+class FakeSocket():
+	def send_multipart(self, parts, copy=True):
+		pass
+
+@pytest.fixture()
+def edge_tracker(motors):
+	camera = SimpleNamespace(name='main', observe=lambda state: None)
+	edge_tracker = EdgeTracker({'main': camera}, motors, backend='csrt')
+	edge_tracker._init_bbox = (40, 40, 60, 60)
+	return edge_tracker
+
+def track(edge_tracker: EdgeTracker) -> None:
+	edge_tracker._track(FakeSocket(), FRAME, 0.0, 0)
+
+def steer(edge_tracker: EdgeTracker, command: SteeringCommand) -> None:
+	# What the steering paths do with a command
+	with edge_tracker.override(command):
+		apply_command(command, *edge_tracker.motors)
+
+def test_stick_pauses_tracker_steering(edge_tracker):
+	motor_yaw, _ = edge_tracker.motors
+	track(edge_tracker)
+	tracked = motor_yaw.calls[-1]
+	assert tracked[2] > 0
+	steer(edge_tracker, SteeringCommand(yaw=-30))
+	track(edge_tracker)
+	assert motor_yaw.calls[-1] == ('speed', 1, 30)
+
+def test_released_stick_hands_steering_back(edge_tracker):
+	motor_yaw, _ = edge_tracker.motors
+	track(edge_tracker)
+	tracked = motor_yaw.calls[-1]
+	steer(edge_tracker, SteeringCommand(yaw=-30))
+	steer(edge_tracker, SteeringCommand(yaw=0))
+	steer(edge_tracker, SteeringCommand())
+	assert motor_yaw.calls[-1] == ('speed', 0, 0)
+	# The tracker's speed did not change, it is applied again all the same
+	track(edge_tracker)
+	assert motor_yaw.calls[-1] == tracked
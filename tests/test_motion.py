@@ -0,0 +1,89 @@
+import time
+
+import numpy as np
+import pytest
+from gpiozero import Device, DigitalOutputDevice
+from gpiozero.pins.mock import MockFactory
+
+from turret.motion import MOVE_RATE, MotionPlanner, StepGenerator
+
+
+@pytest.fixture()
+def generator():
+	Device.pin_factory = MockFactory()
+	step = DigitalOutputDevice(20, initial_value=True)
+	direction = DigitalOutputDevice(21)
+	generator = StepGenerator(step, direction, MotionPlanner(lambda speed: speed * 10.0, acceleration=100000.0))
+	generator.start()
+	yield generator
+	generator.quit()
+	generator.join()
+	step.close()
+	direction.close()
+	Device.pin_factory.reset()
+
+def pulses(generator: StepGenerator) -> int:
+	return sum(1 for state in generator.step_device.pin.states if not state.state)
+
+def test_plan_is_cached():
+	planner = MotionPlanner(lambda speed: speed * 10.0)
+	assert planner.plan(0, 50) is planner.plan(0, 50)
+	assert planner.plan(50, 50) == ()
+
+def test_ramps_up_to_the_target_rate(generator):
+	generator.set(0, 100)
+	time.sleep(0.5)
+	intervals = generator.planner.plan(0, 100)
+	assert intervals[0] > intervals[-1]
+	assert generator.rate == pytest.approx(1000.0, rel=0.01)
+
+def test_no_pulse_after_stop(generator):
+	generator.set(0, 100)
+	for _ in range(50):
+		time.sleep(0.01)
+		generator.stop()
+		stopped = pulses(generator)
+		time.sleep(0.02)
+		assert pulses(generator) == stopped
+		assert generator.rate == 0
+		generator.set(0, 100)
+
+def record_pulses(generator: StepGenerator) -> list:
+	# Direction pin value and time of every pulse
+	pulsed = []
+	off = generator.step_device.off
+	def record():
+		pulsed.append((generator.dir_device.value, time.perf_counter()))
+		off()
+	generator.step_device.off = record
+	return pulsed
+
+def test_move_takes_exactly_count_steps(generator):
+	pulsed = record_pulses(generator)
+	generator.set(0, 100)
+	time.sleep(0.1)
+	generator.move(1, 5)
+	time.sleep(10 / MOVE_RATE)
+	assert [dir for dir, _ in pulsed].count(1) == 5
+	assert generator.dir_device.value == 1
+	assert generator.rate == 0
+
+def test_move_ramps_up_and_down(generator):
+	generator.planner.acceleration = 500.0
+	pulsed = record_pulses(generator)
+	generator.move(1, 40)
+	time.sleep(80 / MOVE_RATE)
+	intervals = np.diff([at for _, at in pulsed])
+	assert len(pulsed) == 40
+	assert intervals[0] > intervals.min() * 1.5
+	assert intervals[-1] > intervals.min() * 1.5
+
+def test_speed_zero_cancels_move(generator):
+	generator.move(1, 1000)
+	time.sleep(0.05)
+	generator.set(1, 0)
+	time.sleep(0.05)
+	stopped = pulses(generator)
+	time.sleep(0.05)
+	assert pulses(generator) == stopped
+	assert stopped < 20
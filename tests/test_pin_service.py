@@ -0,0 +1,78 @@
+import time
+from threading import Thread
+
+import zmq
+
+import pin_service
+from pin_service import coalesce_commands, handle_requests, process_requests
+from turret.protocol import STATUS_INVALID, TOKEN, SteeringCommand, unpack_ack
+
+
+def test_newest_speed_wins():
+	applied, superseded = coalesce_commands([
+		SteeringCommand(yaw=10, pitch=5, sequence=1),
+		SteeringCommand(yaw=20, sequence=2),
+		SteeringCommand(yaw=30, sequence=3),
+	])
+	assert [(command.yaw, command.pitch) for command in applied] == [(30, 5)]
+	assert superseded == {1}
+
+def test_step_counts_add_up():
+	applied, superseded = coalesce_commands([
+		SteeringCommand(yaw=5, yaw_steps=True),
+		SteeringCommand(yaw=-2, yaw_steps=True),
+		SteeringCommand(yaw=4, yaw_steps=True),
+	])
+	assert [(command.yaw, command.yaw_steps) for command in applied] == [(7, True)]
+	assert superseded == set()
+
+def test_speed_replaces_queued_steps():
+	applied, superseded = coalesce_commands([
+		SteeringCommand(yaw=5, yaw_steps=True),
+		SteeringCommand(yaw=40),
+		SteeringCommand(yaw=3, yaw_steps=True),
+	])
+	assert [(command.yaw, command.yaw_steps) for command in applied] == [(3, True)]
+	assert superseded == {0, 1}
+
+def test_commands_after_a_sleep_are_applied_after_it():
+	applied, superseded = coalesce_commands([
+		SteeringCommand(yaw=50, sequence=1),
+		SteeringCommand(sleep=True, sequence=2),
+		SteeringCommand(yaw=20, sequence=3),
+	])
+	assert [command.sleep for command in applied] == [True, False]
+	assert applied[1].yaw == 20
+	assert superseded == {0}
+
+def test_malformed_requests_are_answered():
+	token = TOKEN.decode()
+	replies, sequences = handle_requests([
+		b'{oops',
+		f'{{"token": "{token}", "yaw": [1]}}'.encode(),
+		f'{{"token": "{token}", "pitch": Infinity}}'.encode(),
+		b'\x00',
+	], None, None)
+	assert replies[:3] == [b'BAD REQUEST'] * 3
+	assert unpack_ack(replies[3])[0] == STATUS_INVALID
+	assert sequences == [None] * 4
+
+
+def test_motors_sleep_when_steering_goes_silent(monkeypatch, motors):
+	monkeypatch.setattr(pin_service, 'STEERING_TIMEOUT', 0.1)
+	motor_yaw, motor_pitch = motors
+	context = zmq.Context()
+	server = context.socket(zmq.ROUTER)
+	server.bind('inproc://steering')
+	Thread(target=process_requests, args=(server, motor_yaw, motor_pitch), daemon=True).start()
+	client = context.socket(zmq.REQ)
+	client.connect('inproc://steering')
+	time.sleep(0.3)
+	assert motor_yaw.calls == [] # asleep from the start, nothing to stop
+	client.send(SteeringCommand(yaw=50, token=TOKEN).pack())
+	client.recv()
+	time.sleep(0.05)
+	assert motor_yaw.calls == [('speed', 0, 50)]
+	time.sleep(0.3)
+	assert motor_yaw.calls == [('speed', 0, 50), 'sleep']
+	assert motor_pitch.calls == ['sleep']